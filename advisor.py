@@ -0,0 +1,144 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from annotation import Annotator
+from lexer import column_references
+
+# columns of the given relations, which are resolved through the search path like the relation names in plans
+COLUMNS_QUERY = """
+SELECT c.relname, a.attname
+FROM pg_attribute a JOIN pg_class c ON c.oid = a.attrelid
+WHERE c.oid = ANY(ARRAY(SELECT to_regclass(quote_ident(name)) FROM unnest(%s::text[]) AS name))
+  AND a.attnum > 0 AND NOT a.attisdropped
+"""
+
+def quote_identifier(name):
+    return '"' + name.replace('"', '""') + '"'
+
+# class to propose indexes for a query from its annotated plan, and to check them against the planner:
+class IndexAdvisor:
+
+    def __init__(self, processor, hypothetical=None):
+        '''
+        :param processor: QueryProcessor the candidates are explained with
+        :param hypothetical: use hypopg's hypothetical indexes; None to use them only if the extension is installed.
+        Without them, each candidate index is really built inside a transaction that is rolled back,
+        which holds a SHARE lock on its table (blocking writes) while it is built
+        '''
+        self.processor = processor
+        self.hypothetical = hypothetical
+
+    def uses_hypopg(self):
+        if self.hypothetical is None:
+            self.hypothetical = self.processor.execute("SELECT count(*) FROM pg_extension WHERE extname = 'hypopg'")[0][0] > 0
+        return self.hypothetical
+
+    def candidates(self, query_plan):
+        '''
+        Collects candidate indexes from the annotator's view of the plan: the filters of sequential scans,
+        the conditions of joins on sequentially scanned tables, and sort keys
+        :returns: list of {"table", "columns", "reason"}, without duplicates
+        '''
+        annotator = Annotator()
+        annotator.reset()
+        annotator.generate_annotations(query_plan)
+        scans = annotator.scans_dict  # {alias: scan annotation}
+        relations = {alias: scan["name"] for alias, scan in scans.items()}
+
+        columns = {}  # {relation: set of column names}
+        for relation, column in self.processor.execute(COLUMNS_QUERY, (sorted(set(relations.values())),)):
+            columns.setdefault(relation, set()).add(column)
+
+        def resolve(qualifier, column, default=None):
+            '''
+            :returns: the relation the column belongs to, or None if it is unknown or ambiguous
+            '''
+            if qualifier is not None:
+                relation = relations.get(qualifier, qualifier)
+                return relation if column in columns.get(relation, ()) else None
+            if default is not None:
+                return default if column in columns.get(default, ()) else None
+            owners = [relation for relation in set(relations.values()) if column in columns.get(relation, ())]
+            return owners[0] if len(owners) == 1 else None
+
+        found = {}
+        def add(relation, index_columns, reason):
+            key = (relation, tuple(index_columns))
+            if relation is not None and len(index_columns) != 0 and key not in found:
+                found[key] = {"table": relation, "columns": list(index_columns), "reason": reason}
+
+        def group_by_relation(references, default=None):
+            '''
+            :returns: {relation: [columns]} in order of appearance, unresolved references left out
+            '''
+            grouped = {}
+            for qualifier, column in references:
+                relation = resolve(qualifier, column, default)
+                if relation is not None and column not in grouped.setdefault(relation, []):
+                    grouped[relation].append(column)
+            return grouped
+
+        for alias, scan in scans.items():
+            if scan["scan_type"] == "Seq Scan" and "filter" in scan:
+                reason = f"filter \"{scan['filter']}\" of the Seq Scan on {scan['name']}"
+                filter_columns = group_by_relation(column_references(scan["filter"]), scan["name"]).get(scan["name"], [])
+                for column in filter_columns:
+                    add(scan["name"], [column], reason)
+                if len(filter_columns) > 1:
+                    add(scan["name"], filter_columns, reason)
+
+        sequential = {scan["name"] for scan in scans.values() if scan["scan_type"] == "Seq Scan"}
+        for join in annotator.joins_arr:
+            for condition in join["conditions"]:
+                for relation, join_columns in group_by_relation(column_references(condition)).items():
+                    if relation in sequential:  # an index could let the join look rows up instead
+                        add(relation, join_columns, f"join condition \"{condition}\"")
+
+        for sort_keys in annotator.sort_keys_arr:
+            grouped = group_by_relation(reference for key in sort_keys for reference in column_references(key))
+            if len(grouped) == 1:  # an index can only provide the order if all keys are on one table
+                relation, sort_columns = next(iter(grouped.items()))
+                add(relation, sort_columns, f"sort key(s) \"{', '.join(sort_keys)}\"")
+        return list(found.values())
+
+    def index_statement(self, candidate):
+        return f"CREATE INDEX ON {quote_identifier(candidate['table'])} ({', '.join(quote_identifier(column) for column in candidate['columns'])})"
+
+    def evaluate(self, query, candidate, timeout=None):
+        '''
+        :returns: total cost of the query's plan with the candidate index in place
+        '''
+        statement = self.index_statement(candidate)
+        if self.uses_hypopg():
+            setup = [("SELECT * FROM hypopg_create_index(%s)", (statement,))]
+            return self.processor.explain(query, timeout=timeout, rollback=True, setup=setup, teardown="SELECT hypopg_reset()")["Total Cost"]
+        return self.processor.explain(query, timeout=timeout, rollback=True, setup=[statement])["Total Cost"]
+
+    def advise(self, query, query_plan=None, timeout=None):
+        '''
+        Proposes indexes for query and checks each one by explaining the query again with the index in place.
+        The candidates are explained concurrently over the processor's connections.
+        :param query_plan: plan of the query, retrieved with processor.process_query if not given
+        :returns: list of {"table", "columns", "reason", "statement", "cost_before", "cost_after", "reduction"}
+        for the indexes that lower the estimated cost, largest reduction first
+        '''
+        if query_plan is None:
+            query_plan = self.processor.process_query(query)
+        cost_before = query_plan["Total Cost"]
+        candidates = self.candidates(query_plan)
+        if len(candidates) == 0:
+            return []
+        self.uses_hypopg()  # checked once, before the candidates are spread over threads
+
+        with ThreadPoolExecutor(max_workers=min(len(candidates), self.processor.pool_size)) as executor:
+            costs = list(executor.map(lambda candidate: self.evaluate(query, candidate, timeout), candidates))
+
+        advice = []
+        for candidate, cost_after in zip(candidates, costs):
+            if cost_after < cost_before:
+                candidate["statement"] = self.index_statement(candidate)
+                candidate["cost_before"] = cost_before
+                candidate["cost_after"] = cost_after
+                candidate["reduction"] = cost_before - cost_after
+                advice.append(candidate)
+        advice.sort(key=lambda candidate: candidate["reduction"], reverse=True)
+        return advice
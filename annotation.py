@@ -1,8 +1,166 @@
+import json
 import re
-from collections import OrderedDict
+import threading
+from bisect import bisect_right
+from collections import deque
+
+from catalog import distinct_values, format_size
+from lexer import column_references
+from metrics import timed
+from plantree import as_plan
+
+# categories of annotations
+SCAN = "scan"
+JOIN = "join"
+AGGREGATE = "aggregate"
+SORT = "sort"
+SUBPLAN = "subplan"
+
+# class to hold one annotation and the part of the query it belongs to:
+class Annotation:
+    __slots__ = ("category", "token_start", "token_end", "char_start", "char_end", "nodes", "text")
+    FIELDS = __slots__  # order of the fields in serialized rows
+
+    def __init__(self, category, token_start, token_end, char_start, char_end, nodes, text):
+        self.category = category
+        self.token_start = token_start  # index of the first annotated token
+        self.token_end = token_end  # index after the last annotated token
+        self.char_start = char_start  # offsets of the annotated text in the query
+        self.char_end = char_end
+        self.nodes = nodes  # tuple of the ids of the plan nodes it describes (their positions in a pre-order walk of the plan)
+        self.text = text
+
+    @property
+    def tokens(self):
+        return range(self.token_start, self.token_end)
+
+    def to_row(self):
+        return [self.category, self.token_start, self.token_end, self.char_start, self.char_end, list(self.nodes), self.text]
+
+    @classmethod
+    def from_row(cls, row):
+        category, token_start, token_end, char_start, char_end, nodes, text = row
+        return cls(category, token_start, token_end, char_start, char_end, tuple(nodes), text)
+
+    def __repr__(self):
+        return f"Annotation({self.category!r}, tokens {self.token_start}-{self.token_end}, {self.text!r})"
+
+def max_tree(ends):
+    '''
+    :param ends: ends of intervals sorted by their starts
+    :returns: (size, tree): a segment tree in an array, where tree[size + i] is ends[i] and every other node holds the
+    largest end below it, so the intervals still open at a position can be found without visiting the ones already closed
+    '''
+    size = 1
+    while size < len(ends):
+        size *= 2
+    tree = [-1] * (2 * size)
+    tree[size:size + len(ends)] = ends
+    for node in range(size - 1, 0, -1):
+        tree[node] = max(tree[2 * node], tree[2 * node + 1])
+    return size, tree
+
+def containing(starts, size, tree, position):
+    '''
+    :param starts: sorted starts of the intervals, and size, tree: max_tree of their ends
+    :returns: indexes of the intervals with start <= position < end, in order; only the branches holding one of them
+    are visited, so this takes O((k + 1) log n) for k intervals found, however wide some intervals are
+    '''
+    high = bisect_right(starts, position)
+    found = []
+    stack = [(1, 0, size)]  # (node, index of its first leaf, number of leaves)
+    while len(stack) != 0:
+        node, first, count = stack.pop()
+        if first >= high or tree[node] <= position:
+            continue
+        if node >= size:
+            found.append(first)
+            continue
+        half = count // 2
+        stack.append((2 * node + 1, first + half, half))
+        stack.append((2 * node, first, half))
+    return found
+
+# class to hold the annotations of a query, sorted by position, with the summary of the whole plan:
+class AnnotationIndex:
+
+    def __init__(self, annotations, cost, aliases, planning=None):
+        '''
+        :param annotations: iterable of Annotation
+        :param cost: text describing the cost (and run time, plan changes) of the whole plan
+        :param aliases: dict of {alias: table} for the aliases given in the query
+        :param planning: text describing the time and buffers spent planning the query, None if the plan does not report them
+        '''
+        self.annotations = sorted(annotations, key=lambda annotation: (annotation.token_start, annotation.token_end))
+        self.cost = cost
+        self.aliases = aliases
+        self.planning = planning
+        # sorted starts for bisect, and trees of the ends (see max_tree), so a wide annotation does not slow down every lookup
+        self._token_starts = [annotation.token_start for annotation in self.annotations]
+        self._char_starts = [annotation.char_start for annotation in self.annotations]
+        self._token_tree = max_tree([annotation.token_end for annotation in self.annotations])
+        self._char_tree = max_tree([annotation.char_end for annotation in self.annotations])
+        self._by_node = {}
+        for annotation in self.annotations:
+            for node in annotation.nodes:
+                self._by_node.setdefault(node, []).append(annotation)
+
+    def __len__(self):
+        return len(self.annotations)
+
+    def __iter__(self):
+        return iter(self.annotations)
+
+    def __getitem__(self, i):
+        return self.annotations[i]
+
+    def at_token(self, token_index):
+        '''
+        :returns: the annotations whose token span contains token_index
+        '''
+        return [self.annotations[i] for i in containing(self._token_starts, *self._token_tree, token_index)]
+
+    def at_offset(self, offset):
+        '''
+        :returns: the annotations whose text contains the character at offset in the query
+        '''
+        return [self.annotations[i] for i in containing(self._char_starts, *self._char_tree, offset)]
+
+    def for_node(self, node):
+        '''
+        :returns: the annotations describing the plan node with this id
+        '''
+        return self._by_node.get(node, [])
+
+    def to_dict(self):
+        '''
+        :returns: JSON-serializable form, with each annotation as a row of Annotation.FIELDS
+        '''
+        return {"fields": list(Annotation.FIELDS), "annotations": [annotation.to_row() for annotation in self.annotations],
+                "cost": self.cost, "planning": self.planning, "aliases": self.aliases}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls([Annotation.from_row(row) for row in data["annotations"]], data["cost"], data["aliases"], data.get("planning"))
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), separators=(",", ":"))
+
+    @classmethod
+    def from_json(cls, text):
+        return cls.from_dict(json.loads(text))
+
 class Annotator:
 
-    def __init__(self):
+    def __init__(self, metrics=None, catalog=None):
+        '''
+        :param metrics: optional metrics.Metrics timing the generate and attach stages
+        :param catalog: optional catalog.CatalogCache; if set, scan annotations tell the table's size, the share of its rows
+        the scan is estimated to return and the indexes on the filtered columns that are not used, and join annotations
+        the number of distinct values of the joined columns
+        '''
+        self.metrics = metrics
+        self.catalog = catalog
         # list of supported operators
         self.join_operators = ["Nested Loop", "Hash Join", "Merge Join"]
         self.scan_operators = [
@@ -20,66 +178,167 @@ class Annotator:
 
         # SQL keywords to look out for
         self.sql_keywords = ["FROM", "SELECT", "ORDER", "GROUP", "UPDATE", "DELETE", "HAVING"]
-        self.aggregates = ("AVG", "COUNT", "MAX", "MIN", "SUM")  # need to be a tuple to use 'in'
+        self.aggregates = ("AVG", "COUNT", "MAX", "MIN", "SUM")  # aggregate functions, attached when followed by "("
 
     def annotate(self, query_plan, tokenized_query):
+        """
+        :param query_plan: plan as a tree of plantree.PlanNode (plans held as nested dicts are converted first)
+        :returns: AnnotationIndex of the annotations attached to the query's tokens
+        """
+        self.reset()
+        query_plan = as_plan(query_plan)
+        if self.catalog is not None:  # every relation of the plan at once
+            nodes = list(query_plan.walk())
+            self.relation_stats = self.catalog.lookup([node.relation_name for node in nodes if node.relation_name is not None])
+            self.used_indexes = set(node["Index Name"] for node in nodes if "Index Name" in node)
+        if "Actual Rows" in query_plan:  # plan from EXPLAIN ANALYZE
+            self.prepare_runtime(query_plan)
+
+        # generate the annotations - i.e. prepare annotations_dict
+        with timed(self.metrics, "generate"):
+            self.generate_annotations(query_plan)
+        with timed(self.metrics, "attach"):
+            self.attach_annotations(tokenized_query)
+        cost = "Total cost of the query plan is: " + str(query_plan["Total Cost"]) + "."
+        if self.execution_time is not None:
+            cost += self.describe_execution(query_plan)
+        if "Plan Changes" in query_plan:  # recorded by a PlanHistory
+            cost += " Compared with the last recorded plan of this query: " + " ".join(query_plan["Plan Changes"])
+        return AnnotationIndex(self.annotations_dict.values(), cost, self.alias_dict, self.describe_planning(query_plan))
+
+    def reset(self):
+        """
+        Clears the state kept from the previous query
+        """
         # holds generated annotations
         self.scans_dict = {}
-        self.joins_arr = []
-        self.aggregates_arr = []
-        self.sorts_arr = []
-        self.subplans_arr = []
+        # queues, consumed from the front as annotations are attached to tokens
+        self.joins_arr = deque()
+        self.aggregates_arr = deque()
+        self.sorts_arr = deque()
+        self.subplans_arr = deque()
+        # sort keys of each sort, e.g. for advisor.IndexAdvisor
+        self.sort_keys_arr = []
 
         # keep track of aliases and the table they belong to
         self.alias_dict = {}  
 
-        # dictionary of {token: annotation}; holds the attached annotations
-        self.annotations_dict = {}  
+        # dictionary of {(token_start, token_end): Annotation}; holds the attached annotations
+        self.annotations_dict = {}
+        self.tokenized_query = []
 
-        # generate the annotations - i.e. prepare annotations_dict
-        self.generate_annotations(query_plan)
-        self.attach_annotations(tokenized_query)
-        self.annotations_dict["cost"] = "Total cost of the query plan is: " + str([query_plan][0]["Total Cost"]) + "."
-        self.annotations_dict["alias"] = self.alias_dict
-        
-        # order annotations by token id
-        ordered = OrderedDict()  
-        token_ids = list(self.annotations_dict.keys())
-        token_ids.remove("cost")  # not involved in sorting
-        token_ids.remove("alias")  # not involved in sorting too
-        sort_key = lambda x: x if type(x) != tuple else x[0]  # if token_id is a tuple, then we compare using the 1st element of the tuple
-        for token_id in sorted(token_ids, key=sort_key):
-            ordered[token_id] = self.annotations_dict[token_id]
-        ordered["cost"] = self.annotations_dict["cost"]
-        ordered["alias"] = self.annotations_dict["alias"]
-        return ordered
+        # for plans from EXPLAIN ANALYZE: {id(plan): self time in ms}, and the costliest of them as {id(plan): share of execution time}
+        # and as plan nodes, costliest first
+        self.self_times = {}
+        self.costliest = {}
+        self.costliest_nodes = []
+        self.execution_time = None
+
+        # {relation name: catalog statistics} of the plan's relations, see catalog.CatalogCache.lookup
+        self.relation_stats = {}
+        self.used_indexes = set()  # names of the indexes scanned anywhere in the plan
+
+    def prepare_runtime(self, query_plan, flagged=3):
+        """
+        Computes the time spent in each operator itself (its total time over all loops, minus its children's),
+        and flags the `flagged` operators with the largest share of the execution time
+        """
+        nodes = {}
+        stack = [query_plan]
+        while len(stack) != 0:
+            curr_plan = stack.pop()
+            nodes[id(curr_plan)] = curr_plan
+            children = curr_plan.children
+            stack.extend(children)
+            total = curr_plan.get("Actual Total Time", 0) * curr_plan.get("Actual Loops", 1)
+            for child in children:
+                total -= child.get("Actual Total Time", 0) * child.get("Actual Loops", 1)
+            self.self_times[id(curr_plan)] = max(total, 0)
+
+        self.execution_time = query_plan.get("Execution Time", query_plan.get("Actual Total Time", 0))
+        if self.execution_time > 0:
+            for plan_id in sorted(self.self_times, key=self.self_times.get, reverse=True)[:flagged]:
+                self.costliest[plan_id] = self.self_times[plan_id] / self.execution_time
+                self.costliest_nodes.append(nodes[plan_id])
+
+    def describe_runtime(self, plan):
+        """
+        :returns: sentences on what actually happened in this operator, empty if the plan was not analyzed
+        """
+        if id(plan) not in self.self_times:
+            return ""
+        loops = plan.get("Actual Loops", 1)
+        if loops == 0:
+            return f" The {plan.node_type} was never executed."
+
+        rows = plan["Actual Rows"]
+        estimate = plan.plan_rows or 0
+        text = f" The {plan.node_type} returned {rows} rows per loop against {estimate} estimated, over {loops} loop(s), and took {self.self_times[id(plan)]:.3f} ms itself."
+        if max(rows, estimate) >= 10 * max(min(rows, estimate), 1):
+            text += f" The row estimate is off by a factor of {max(rows, estimate) / max(min(rows, estimate), 1):.0f}."
+        if "Shared Hit Blocks" in plan:
+            text += f" It hit {plan['Shared Hit Blocks']} and read {plan.get('Shared Read Blocks', 0)} buffer block(s)."
+        if id(plan) in self.costliest:
+            text += f" This is one of the costliest operators ({self.costliest[id(plan)]:.0%} of the execution time)."
+        return text
+
+    def describe_execution(self, query_plan):
+        """
+        :returns: sentences on the execution time of the whole query, for plans from EXPLAIN ANALYZE.
+        The costliest operators are listed here too, as some of them (e.g. a Hash or a Gather) have no annotation to flag them in
+        """
+        text = f" The query took {self.execution_time:.3f} ms to execute."
+        if len(self.costliest_nodes) != 0:
+            operators = []
+            for plan in self.costliest_nodes:
+                name = plan.node_type if plan.relation_name is None else f"{plan.node_type} on {plan.relation_name}"
+                operators.append(f"{name} ({self.costliest[id(plan)]:.0%})")
+            text += " The costliest operators are: " + ", ".join(operators) + "."
+        return text
+
+    def describe_planning(self, query_plan):
+        """
+        :returns: sentence on the time and buffers spent planning the query, None if the plan does not report them
+        (e.g. plans recorded without EXPLAIN's SUMMARY option)
+        """
+        if "Planning Time" not in query_plan:
+            return None
+        text = f"Planning the query took {query_plan['Planning Time']:.3f} ms"
+        buffers = query_plan.get("Planning", {})
+        if "Shared Hit Blocks" in buffers:
+            text += f", hitting {buffers['Shared Hit Blocks']} and reading {buffers.get('Shared Read Blocks', 0)} buffer block(s)"
+        text += "."
+        if query_plan.get("From Cache", False):
+            text += " The plan was served from the plan cache this time, without planning the query again."
+        return text
 
     def generate_annotations(self, query_plan):
         """
         Use DFS to prepare annotations for individual plans.
+        Each node's id is its position in this (pre-order) walk, and is kept in self.node_id while it is annotated.
         """
-        queue = [query_plan]
-        while len(queue) != 0:
-            curr_plan = queue.pop(0)
-            if "Plans" in curr_plan:  # this operator has child operations
-                for i in range(len(curr_plan["Plans"])):
-                    queue.insert(0, curr_plan["Plans"][len(curr_plan["Plans"]) - 1 - i]) # insert in reverse order, so first subplan is examined first
-
-            if "Subplan Name" in curr_plan:  # this plan creates a subplan
-                subplan_name = curr_plan["Subplan Name"]
+        stack = [as_plan(query_plan)]  # explicit stack, so deep plans don't hit the recursion limit
+        self.node_id = -1
+        while len(stack) != 0:
+            curr_plan = stack.pop()  # pop from the end is O(1)
+            self.node_id += 1
+            stack.extend(reversed(curr_plan.children))  # push in reverse order, so first subplan is examined first
+
+            subplan_name = curr_plan.subplan_name
+            if subplan_name is not None:  # this plan creates a subplan
                 match = re.search("\$\d+", subplan_name)
                 if match:  
                     # if match, subplan_name is e.g. "InitPlan 1 (returns $1)". Extract $1
                     # if no match, subplan_name is e.g. "SubPlan 1". Do nothing
                     subplan_name = match.group(0)
 
-                if "One-Time Filter" in curr_plan:  # add one-time filter condition
-                    self.subplans_arr.append({"name": subplan_name, "otf": curr_plan['One-Time Filter']})
+                if curr_plan.one_time_filter is not None:  # add one-time filter condition
+                    self.subplans_arr.append({"name": subplan_name, "otf": curr_plan.one_time_filter, "node": self.node_id})
                 else:
-                    self.subplans_arr.append({"name": subplan_name})
+                    self.subplans_arr.append({"name": subplan_name, "node": self.node_id})
 
             # add annotations for curr_plan
-            node_type = curr_plan["Node Type"]
+            node_type = curr_plan.node_type
             if node_type in self.join_operators:
                 self.annotate_joins(curr_plan)
             elif node_type in self.scan_operators:
@@ -89,193 +348,318 @@ class Annotator:
             else:
                 continue
         
+    def index_tokens(self, tokenized_query):
+        """
+        Single pass over the tokens that splits the query into clauses and records, per clause,
+        where scanned relations/aliases and aggregate functions appear
+        :returns: (clauses, brackets_arr, positions)
+        clauses: list of {keyword, index, end, relations, aggregates}, in query order
+        brackets_arr: array of (open, close) bracket indexes, in the order the brackets close
+        positions: dict of {token text: [indexes]}, unqualified column names of qualified tokens are keyed as ("column", name)
+        """
+        clauses = []
+        brackets_stack = []  # for tracking (closed) brackets
+        brackets_arr = []
+        positions = {}
+        clause = {"keyword": tokenized_query[0].upper, "index": 0, "relations": [], "aggregates": []}
+        last = len(tokenized_query) - 1
+        for i, token in enumerate(tokenized_query):
+            if token.upper in self.sql_keywords:
+                if i != 0:  # start of the next clause
+                    clause["end"] = i
+                    clauses.append(clause)
+                    clause = {"keyword": token.upper, "index": i, "relations": [], "aggregates": []}
+            elif token.text == '(':
+                brackets_stack.append(i)
+            elif token.text == ')' and len(brackets_stack) != 0:  # close an open bracket
+                brackets_arr.append((brackets_stack.pop(), i))
+
+            if token.text in self.scans_dict:
+                # table (or alias) whose scan can be attached here, unless the next token is its alias
+                if i == last or tokenized_query[i+1].text not in self.scans_dict:
+                    clause["relations"].append(i)
+            elif token.upper in self.aggregates and i != last and tokenized_query[i+1].text == '(':
+                clause["aggregates"].append(i)
+
+            positions.setdefault(token.text, []).append(i)
+            if "." in token.text:
+                positions.setdefault(("column", token.text.rsplit(".", 1)[1]), []).append(i)
+        clause["end"] = len(tokenized_query)
+        clauses.append(clause)
+        return clauses, brackets_arr, positions
+
     def attach_annotations(self, tokenized_query):
         """
         Attaches each annotation to the relevant token in the query
+        :param tokenized_query: list of lexer tokens, as returned by QueryProcessor.tokenize_query
         """
-        brackets_stack = []  # for tracking (closed) brackets
-        brackets_arr = []  # array of [index, index] 
+        self.tokenized_query = tokenized_query
+        clauses, brackets_arr, positions = self.index_tokens(tokenized_query)
+        closing = dict(brackets_arr)  # {open bracket: its closing bracket}
         appeared_tables = {}  # dict of {table: count}. Possible for same table (without alias) to appear multiple times in a query
-        current_clause = tokenized_query[0].upper()
-        table_counter = 0
-        clause_index = 0
-        i = 0
-        while i < len(tokenized_query):
-            token = tokenized_query[i]
-            if current_clause == "FROM": # inside a FROM clause
-                if token.upper() in self.sql_keywords or i == len(tokenized_query)-1: # Finish annotation for the FROM clause
-                    current_clause = token.upper()
-                    table_counter = 0
-                    if clause_index in self.annotations_dict.keys():
-                        self.annotations_dict[clause_index] = "This join is carried out with a " + self.annotations_dict[clause_index] + "."
-
-                # attach scans to the index of their alias names within FROM clause
-                if token in self.scans_dict.keys():
-                    # need to check the next token to see if this table has an alias
-                    if i+1 == len(tokenized_query) or tokenized_query[i+1] not in self.scans_dict.keys():                           
-                    # need to check if we are attaching annotations to repeated table name without alias
-                        if token not in appeared_tables.keys():
-                            annotation = self.scans_dict[token] # annotate current token with it's related scan annotation
-                            appeared_tables[token] = 1
-                        else:  # table name appeared twice - find postgres-added alias
-                            added_alias = f"{token}_{appeared_tables[token]}"  # postgres will add a counter to the (repeated) table name
-                            if added_alias in self.scans_dict.keys():  # without check, if update and where used same table, will crash
-                                annotation = self.scans_dict[added_alias]  
-                                appeared_tables[token] += 1
-                                self.alias_dict.pop(added_alias)  # not needed for annotation
-                        # attach scan annotations
-                        annotation_text = f"The table \"{annotation['name']}\"{annotation['alias']} is read using {annotation['scan_type']}."
-                        if "filter" in annotation.keys():
-                            annotation_text += f" The filter \"{annotation['filter']}\" is applied."
-                        elif "cond" in annotation.keys():
-                            annotation_text += f" The index condition \"{annotation['cond']}\" is applied."
-                        self.annotations_dict[i] = annotation_text
-                        # attach join annotations
-                        if table_counter == 1: # If 2 tables in the from clause, annotate it with a join
-                            self.annotations_dict[clause_index] = self.joins_arr.pop(0)["name"]
-                        elif table_counter > 1: # If more than 2 tables in the from clause, annotate with a join for each
-                            self.annotations_dict[clause_index] = self.joins_arr.pop(0)["name"] + ", followed by a " + self.annotations_dict[clause_index]
-                        table_counter += 1
-                
-                elif len(self.joins_arr) > 0:
-                    for condName in self.joins_arr[0]["conds"]:
-                        if (condName in token or token in condName) and table_counter == 1: # if part of a condition is found in a where clause and only one table in the from clause
-                            self.annotations_dict[clause_index] = self.joins_arr.pop(0)["name"]
-                            break
-
-            elif current_clause == "SELECT" or current_clause == "HAVING":  # attach aggregate annotations
-                if token.upper() in self.sql_keywords or i == len(tokenized_query) - 1: # Finish annotation for the SELECT clause
-                    current_clause = token.upper()
-                    for j in range(clause_index, i):  
-                        # check if tokens from the SELECT clause to this current token are aggregate functions
-                        # if so, attach them
-                        if tokenized_query[j].upper().startswith(self.aggregates):
-                            self.annotations_dict[j] = self.aggregates_arr.pop(0)
-
-            elif current_clause == "GROUP" or current_clause == "ORDER":  # attach sort annotations
+
+        for clause in clauses:
+            keyword = clause["keyword"]
+            clause_index = clause["index"]
+            if keyword == "FROM":  # attach scans to the index of their alias names, and joins to FROM
+                joins = []  # joins attached to this clause, the last one carried out first
+                relations = clause["relations"]
+                for n, i in enumerate(relations):
+                    self.attach_scan(tokenized_query[i].text, i, appeared_tables)
+                    if n == 1 and len(self.joins_arr) != 0:  # If 2 tables in the from clause, annotate it with a join
+                        joins = [self.joins_arr.popleft()]
+                    elif n > 1 and len(self.joins_arr) != 0:  # If more than 2 tables in the from clause, annotate with a join for each
+                        joins.insert(0, self.joins_arr.popleft())
+                    if n == 0:
+                        # only one table so far: the join may be found through its condition, between this table and the next one
+                        window_end = relations[1] if len(relations) > 1 else clause["end"]
+                        joins = self.find_condition_joins(positions, i, window_end, joins)
+                if len(joins) != 0:
+                    text = "This join is carried out with a " + ", followed by a ".join(join["name"] for join in joins) + "."
+                    text += "".join(join["runtime"] for join in joins)
+                    text += "".join(self.describe_join_columns(join) for join in joins)
+                    self.add_annotation(JOIN, clause_index, clause_index + 1, tuple(join["node"] for join in joins), text)
+
+            elif keyword == "SELECT" or keyword == "HAVING":  # attach aggregate annotations
+                for i in clause["aggregates"]:
+                    if len(self.aggregates_arr) != 0:
+                        aggregate = self.aggregates_arr.popleft()
+                        end = closing.get(i + 1, i + 1) + 1  # the whole call, up to its closing bracket
+                        self.add_annotation(AGGREGATE, i, end, (aggregate["node"],), aggregate["text"])
+
+            elif keyword == "GROUP" or keyword == "ORDER":  # attach sort annotations
                 # group by has priority over order by - so if both appear together, order by may not have any sorts to attach to
                 # group by may also appear without requiring any sorting to be performed
-                # we need to make sure still can attach annotation to group by if it's the last clause
-                if (token.upper() in self.sql_keywords or i == len(tokenized_query)-1) and len(self.sorts_arr) != 0: # Finish annotation for the GROUP BY clause
-                    if (tokenized_query[clause_index+1].upper() == "BY"):  # attach annotation to both group/order and by
-                        self.annotations_dict[(clause_index, clause_index+1)] = self.sorts_arr.pop(0)
+                if len(self.sorts_arr) != 0:
+                    if clause_index+1 < len(tokenized_query) and tokenized_query[clause_index+1].upper == "BY":  # attach annotation to both group/order and by
+                        sort = self.sorts_arr.popleft()
+                        self.add_annotation(SORT, clause_index, clause_index + 2, (sort["node"],), sort["text"])
                     else:
                         raise Exception("Found GROUP/ORDER without BY")
-            
-            elif current_clause == "UPDATE" or current_clause == "DELETE":  # for these, just attach scans, if any
-                # also need to check if the next token to see if this table has an alias
-                if token in self.scans_dict.keys() and tokenized_query[i+1] not in self.scans_dict.keys():
-                    # need to check if we are attaching annotations to repeated table name without alias
-                    if token not in appeared_tables.keys():
-                        annotation = self.scans_dict[token] # annotate current token with it's related scan annotation
-                        appeared_tables[token] = 1
-                    else:  # table name appeared twice - find postgres-added alias
-                        annotation = self.scans_dict[f"{token}_{appeared_tables[token]}"]  # postgres will add a counter to the (repeated) table name
-                        appeared_tables[token] += 1
-                    # attach annotations
-                    annotation_text = f"The table \"{annotation['name']}\"{annotation['alias']} is read using {annotation['scan_type']}."
-                    if "filter" in annotation.keys():
-                        annotation_text += f" The filter \"{annotation['filter']}\" is applied."
-                    elif "cond" in annotation.keys():
-                        annotation_text += f" The index condition \"{annotation['cond']}\" is applied."
-                    self.annotations_dict[i] = annotation_text
-                    
-            if token.upper() in self.sql_keywords:
-                current_clause = token.upper()
-                clause_index = i
-            else:  # track queries within a bracket
-                if token == '(':
-                    brackets_stack.append(i)
-                elif token == ')':  # close an open bracket
-                    open_bracket = brackets_stack.pop()
-                    brackets_arr.append((open_bracket, i))
-            i += 1
-        
+
+            elif keyword == "UPDATE" or keyword == "DELETE":  # for these, just attach scans, if any
+                for i in clause["relations"]:
+                    self.attach_scan(tokenized_query[i].text, i, appeared_tables)
+
         # annotate brackets
         while len(brackets_arr) != 0 and len(self.subplans_arr) != 0:
             bracket = brackets_arr.pop()  # outer most bracket is the 1st subplan
-            subplan = self.subplans_arr.pop(0)
+            subplan = self.subplans_arr.popleft()
             annotation = f"Results of this group are stored in \"{subplan['name']}\"."
             if "otf" in subplan:
                 annotation += f" A One-Time Filter \"{subplan['otf'][1:-1]}\" is applied."
-            self.annotations_dict[bracket] = annotation
+            self.add_annotation(SUBPLAN, bracket[0], bracket[1] + 1, (subplan["node"],), annotation)
+
+    def add_annotation(self, category, token_start, token_end, nodes, text):
+        """
+        Attaches an annotation to tokens token_start to token_end (exclusive), replacing any annotation of exactly those tokens
+        """
+        char_start = self.tokenized_query[token_start].start
+        char_end = self.tokenized_query[token_end - 1].end
+        self.annotations_dict[(token_start, token_end)] = Annotation(category, token_start, token_end, char_start, char_end, nodes, text)
+
+    def attach_scan(self, table, token_index, appeared_tables):
+        """
+        Attaches the scan annotation of a table (or alias) to its token
+        """
+        # need to check if we are attaching annotations to repeated table name without alias
+        if table not in appeared_tables:
+            annotation = self.scans_dict[table]  # annotate current token with it's related scan annotation
+            appeared_tables[table] = 1
+        else:  # table name appeared twice - find postgres-added alias
+            added_alias = f"{table}_{appeared_tables[table]}"  # postgres will add a counter to the (repeated) table name
+            if added_alias not in self.scans_dict:  # e.g. update and where used same table
+                return
+            annotation = self.scans_dict[added_alias]
+            appeared_tables[table] += 1
+            self.alias_dict.pop(added_alias, None)  # not needed for annotation
+
+        annotation_text = f"The table \"{annotation['name']}\"{annotation['alias']} is read using {annotation['scan_type']}."
+        if "filter" in annotation:
+            annotation_text += f" The filter \"{annotation['filter']}\" is applied."
+        elif "cond" in annotation:
+            annotation_text += f" The index condition \"{annotation['cond']}\" is applied."
+        annotation_text += annotation["catalog"]
+        token_start = token_index
+        if table in self.alias_dict:  # alias given in the query: annotate the table name (and AS) before it too
+            token_start = max(token_index - 1, 0)
+            if token_start > 0 and self.tokenized_query[token_start].upper == "AS":
+                token_start -= 1
+        self.add_annotation(SCAN, token_start, token_index + 1, (annotation["node"],), annotation_text + annotation["runtime"])
+
+    def find_condition_joins(self, positions, start, end, joins):
+        """
+        Looks up the tokens between start and end (exclusive) that take part in the condition of the next join.
+        Each match attaches that join to the clause, and the search continues with the following join after the match.
+        """
+        while len(self.joins_arr) != 0:
+            match = None
+            for cond_name in self.joins_arr[0]["conds"]:
+                if "." in cond_name:  # qualified, e.g. c.c_custkey also matches an unqualified c_custkey
+                    keys = (cond_name, cond_name.rsplit(".", 1)[1])
+                else:  # unqualified, also matches any qualified c.c_custkey
+                    keys = (cond_name, ("column", cond_name))
+                for key in keys:
+                    found = positions.get(key)
+                    if found is None:
+                        continue
+                    k = bisect_right(found, start)  # first occurrence after start
+                    if k < len(found) and found[k] < end and (match is None or found[k] < match):
+                        match = found[k]
+            if match is None:
+                break
+            joins = [self.joins_arr.popleft()]
+            start = match
+        return joins
 
     """ Methods to handle each node type """
     def annotate_joins(self, plan):
-        name = plan["Node Type"]
+        name = plan.node_type
         join_conds = []
         join_filter = ""
+        conditions = []  # raw condition texts, e.g. for advisor.IndexAdvisor
 
-        found_cond = False
-        found_filter = False
-        for key in plan.keys():
-            if "cond" in key.lower():
-                conds = plan[key].strip('()').split(' ') 
-                name += " with condition: \"" + re.sub('[()]', '', plan[key]) + "\""
-                join_conds = [conds[0], conds[-1]] # ignore operators
-                found_cond = True
-                if found_cond and found_filter:
-                    break
+        for key, condition in plan.conditions:  # e.g. Hash Cond, then Join Filter
             if "Join Filter" == key:
-                if name == plan["Node Type"]:  # no join cond (or not yet added)
-                    name += f" with join filter: \"{plan[key][1:-1]}\""  # remove enclosing brackets
+                conditions.append(condition)
+                if name == plan.node_type:  # no join cond (or not yet added)
+                    name += f" with join filter: \"{condition[1:-1]}\""  # remove enclosing brackets
                 else:  # join cond added
-                    name += f" and join filter: \"{plan[key][1:-1]}\""  # remove enclosing brackets
+                    name += f" and join filter: \"{condition[1:-1]}\""  # remove enclosing brackets
+            else:
+                conds = condition.strip('()').split(' ')
+                name += " with condition: \"" + re.sub('[()]', '', condition) + "\""
+                join_conds = [conds[0], conds[-1]] # ignore operators
+                conditions.append(condition)
 
         self.joins_arr.append({
                         "name": name, 
                         "conds": join_conds,
-                        "filter": join_filter
+                        "filter": join_filter,
+                        "conditions": conditions,
+                        "runtime": self.describe_runtime(plan),
+                        "node": self.node_id
                     })
 
     def annotate_scans(self, plan):
-        if "Relation Name" not in plan:  # to ignore subquery scans, etc
+        relation_name = plan.relation_name
+        if relation_name is None:  # to ignore subquery scans, etc
             return
         
         annotation = {}
-        annotation["scan_type"] = plan["Node Type"]
-        annotation["name"] = plan["Relation Name"]
+        annotation["scan_type"] = plan.node_type
+        annotation["name"] = relation_name
 
         # table with no alias specified still has an alias - the table's name itself
-        if plan["Alias"] != plan["Relation Name"]:
-            annotation["alias"] = f" (alias \"{plan['Alias']}\")"
-            self.alias_dict[plan["Alias"]] = plan["Relation Name"]
+        alias = plan.alias
+        if alias != relation_name:
+            annotation["alias"] = f" (alias \"{alias}\")"
+            self.alias_dict[alias] = relation_name
         else:
             annotation["alias"] = ""
         
-        if "Filter" in plan:
-            annotation["filter"] = plan['Filter'][1:-1]
+        scan_filter = plan.filter
+        if scan_filter is not None:
+            annotation["filter"] = scan_filter[1:-1]
         elif "Index Cond" in plan:
-            annotation["cond"] = plan['Index Cond'][1:-1]
-        self.scans_dict[plan["Alias"]] = annotation
+            annotation["cond"] = plan["Index Cond"][1:-1]
+        annotation["runtime"] = self.describe_runtime(plan)
+        annotation["catalog"] = self.describe_relation(plan)
+        annotation["node"] = self.node_id
+        self.scans_dict[alias] = annotation
+
+    def describe_relation(self, plan):
+        """
+        :returns: sentences on the scanned table from the catalog: its size, the share of its rows the scan is estimated to return,
+        and the indexes whose first column is filtered on but which the scan does not use. Empty without catalog statistics
+        """
+        stats = self.relation_stats.get(plan.relation_name)
+        if stats is None:
+            return ""
+        if stats["rows"] is None:  # never analyzed
+            text = f" The table takes {format_size(stats['bytes'])}."
+        else:
+            text = f" The table has about {stats['rows']:.0f} rows ({format_size(stats['bytes'])})"
+            if stats["rows"] > 0 and plan.plan_rows is not None:
+                text += f", of which the scan is estimated to return {min(plan.plan_rows / stats['rows'], 1) * 100:.3g}%"
+            text += "."
+
+        conditions = [condition for condition in (plan.filter, plan.get("Index Cond"), plan.get("Recheck Cond")) if condition is not None]
+        columns = set(column for condition in conditions for _, column in column_references(condition))
+        # a Bitmap Heap Scan's index is named by the Bitmap Index Scan below it, hence all indexes used in the plan are left out
+        unused = [index for index in stats["indexes"]
+                  if index["columns"] and index["columns"][0] in columns and index["name"] not in self.used_indexes]
+        if len(unused) != 0:
+            text += " Not used, though on filtered columns: " + ", ".join(f"index \"{index['name']}\" ({', '.join(index['columns'])})" for index in unused) + "."
+        return text
+
+    def describe_join_columns(self, join):
+        """
+        :returns: a sentence with the estimated number of distinct values of the join's columns, empty without catalog statistics
+        """
+        counts = []
+        for reference in join["conds"]:
+            reference = reference.strip("()").split("::")[0].strip("()")  # e.g. "(o.o_comment)::text"
+            qualifier, _, column = reference.rpartition(".")
+            scan = self.scans_dict.get(qualifier)
+            stats = self.relation_stats.get(scan["name"] if scan is not None else qualifier)
+            distinct = distinct_values(stats, column) if stats is not None else None
+            if distinct is not None:
+                counts.append(f"{reference} ~{distinct:.0f}")
+        if len(counts) == 0:
+            return ""
+        return " Distinct values of the join columns: " + ", ".join(counts) + "."
 
     """ Other Nodes """
     def annotate_sort(self, plan):
-        annotation = f"This sort is performed with sort key(s) \"{', '.join(plan['Sort Key'])}\"."
+        annotation = f"This sort is performed with sort key(s) \"{', '.join(plan.sort_key)}\"."
         if "Sort Method" in plan:
             annotation += f" The sort method is \"{plan['Sort Method']}\"."
-        self.sorts_arr.append(annotation)
+        self.sorts_arr.append({"text": annotation + self.describe_runtime(plan), "node": self.node_id})
+        self.sort_keys_arr.append(plan.sort_key)
 
     def annotate_incremental_sort(self, plan):
-        annotation = f"This sort is performed with sort key(s) \"{', '.join(plan['Sort Key'])}\"."
+        annotation = f"This sort is performed with sort key(s) \"{', '.join(plan.sort_key)}\"."
         if "Sort Method" in plan:
             annotation += f" The sort method is \"{plan['Sort Method']}\"."
-        self.sorts_arr.append(annotation)
+        self.sorts_arr.append({"text": annotation + self.describe_runtime(plan), "node": self.node_id})
+        self.sort_keys_arr.append(plan.sort_key)
 
     def annotate_aggregate(self, plan):
-        annotation = f"This aggregation is performed with the strategy \"{plan['Strategy']}\"."
-        if "Filter" in plan:
-            annotation += f" The filter \"{plan['Filter']}\" is applied."
-        self.aggregates_arr.append(annotation)
+        annotation = f"This aggregation is performed with the strategy \"{plan.strategy}\"."
+        if plan.filter is not None:
+            annotation += f" The filter \"{plan.filter}\" is applied."
+        self.aggregates_arr.append({"text": annotation + self.describe_runtime(plan), "node": self.node_id})
 
     def annotate_groupaggregate(self, plan):
-        annotation = f"This aggregation is performed using GroupAggregate and with the strategy \"{plan['Strategy']}\"."
-        if "Filter" in plan:
-            annotation += f" The filter \"{plan['Filter']}\" is applied."
-        self.aggregates_arr.append(annotation)
+        annotation = f"This aggregation is performed using GroupAggregate and with the strategy \"{plan.strategy}\"."
+        if plan.filter is not None:
+            annotation += f" The filter \"{plan.filter}\" is applied."
+        self.aggregates_arr.append({"text": annotation + self.describe_runtime(plan), "node": self.node_id})
 
     def annotate_hashaggregate(self, plan):
-        annotation = f"This aggregation is performed using HashAggregate and with the strategy \"{plan['Strategy']}\"."
-        if "Filter" in plan:
-            annotation += f" The filter \"{plan['Filter']}\" is applied."
-        self.aggregates_arr.append(annotation)
+        annotation = f"This aggregation is performed using HashAggregate and with the strategy \"{plan.strategy}\"."
+        if plan.filter is not None:
+            annotation += f" The filter \"{plan.filter}\" is applied."
+        self.aggregates_arr.append({"text": annotation + self.describe_runtime(plan), "node": self.node_id})
+
+# class to give each worker thread its own Annotator, since an Annotator keeps the state of the query it is annotating:
+class ThreadAnnotators:
+
+    def __init__(self, metrics=None, catalog=None):
+        '''
+        :param metrics: optional metrics.Metrics, passed to every Annotator
+        :param catalog: optional catalog.CatalogCache, shared by every Annotator
+        '''
+        self.metrics = metrics
+        self.catalog = catalog
+        self._local = threading.local()
+
+    def get(self):
+        '''
+        :returns: the Annotator of the calling thread, created on its first call
+        '''
+        annotator = getattr(self._local, "annotator", None)
+        if annotator is None:
+            annotator = self._local.annotator = Annotator(self.metrics, self.catalog)
+        return annotator
@@ -0,0 +1,181 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+import psycopg2
+import psycopg2.extensions
+
+import plantree
+from cache import PlanCache
+from preprocessing import EXPLAIN_OPTIONS, JSON_TEXT, STATISTICS_VERSION_QUERY, cached_plan, check_single_query, fingerprint_query, plan_from_result, tokenize_query
+
+async def wait_ready(conn):
+    '''
+    Waits without blocking the event loop until an asynchronous psycopg2 connection has finished its current operation
+    '''
+    loop = asyncio.get_running_loop()
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            return
+        future = loop.create_future()
+        ready = lambda: future.done() or future.set_result(None)
+        fd = conn.fileno()
+        if state == psycopg2.extensions.POLL_READ:
+            loop.add_reader(fd, ready)
+            remove = loop.remove_reader
+        elif state == psycopg2.extensions.POLL_WRITE:
+            loop.add_writer(fd, ready)
+            remove = loop.remove_writer
+        else:
+            raise psycopg2.OperationalError(f"Unexpected poll state {state}")
+        try:
+            await future
+        finally:
+            remove(fd)
+
+# asyncio variant of QueryProcessor, for overlapping many EXPLAIN round trips:
+class AsyncQueryProcessor:
+
+    def __init__(self, username, password, host, database, pool_size=4, cache_size=256, version_ttl=1.0):
+        '''
+        Connections are opened by `await open()` or `async with AsyncQueryProcessor(...) as processor`
+        :param pool_size: number of connections the EXPLAINs are spread over
+        :param cache_size: maximum number of plans kept in the plan cache; 0 disables the cache
+        :param version_ttl: seconds for which the statistics version is trusted before it is queried again
+        '''
+        self.connect_args = {"dbname": database, "user": username, "host": host, "password": password}
+        self.pool_size = max(1, pool_size)
+        self.plan_cache = PlanCache(cache_size)
+        self.version_ttl = version_ttl
+        self._version = None
+        self._version_checked = 0.0
+        self._version_lock = None
+        self._idle = None
+
+    async def _connect(self):
+        conn = psycopg2.connect(async_=True, **self.connect_args)
+        await wait_ready(conn)
+        psycopg2.extensions.register_type(JSON_TEXT, conn)  # plans are decoded by plantree.loads
+        return conn
+
+    async def open(self):
+        self._version_lock = asyncio.Lock()
+        self._idle = asyncio.Queue()
+        connections = await asyncio.gather(*(self._connect() for _ in range(self.pool_size)))
+        for conn in connections:
+            self._idle.put_nowait(conn)
+        return self
+
+    async def close(self):
+        '''
+        Closes the idle connections now, and the checked-out ones when they are returned
+        '''
+        if self._idle is None:
+            return
+        while not self._idle.empty():
+            conn = self._idle.get_nowait()
+            if conn is not None:
+                conn.close()
+        self._idle = None
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    @asynccontextmanager
+    async def connection(self):
+        '''
+        Checks out an idle connection, waiting for one if all of them are busy
+        '''
+        if self._idle is None:
+            raise Exception("The database session is not open")
+        idle = self._idle
+        conn = await idle.get()
+        try:
+            if conn is None or conn.closed:  # replaces a connection that broke earlier
+                conn = None
+                conn = await self._connect()
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            if conn is not None:
+                conn.close()
+            raise
+        except asyncio.CancelledError:
+            # stop the statement on the server too, and don't reuse the busy connection
+            if conn is not None:
+                conn.cancel()
+                conn.close()
+            raise
+        finally:
+            if idle is not self._idle:  # the pool it was checked out of was closed meanwhile: close it instead of returning it
+                if conn is not None:
+                    conn.close()
+            else:
+                idle.put_nowait(conn if conn is not None and not conn.closed else None)
+
+    async def execute(self, sql):
+        '''
+        Runs sql on a pooled connection
+        :returns: all rows of the result
+        '''
+        async with self.connection() as conn:
+            cur = conn.cursor()
+            try:
+                cur.execute(sql)
+                await wait_ready(conn)
+                return cur.fetchall()
+            finally:
+                cur.close()
+
+    async def statistics_version(self):
+        '''
+        Returns the current schema/statistics version, querying it at most once every version_ttl seconds.
+        The plan cache is cleared whenever the version changes.
+        '''
+        async with self._version_lock:
+            now = time.monotonic()
+            if self._version is None or now - self._version_checked >= self.version_ttl:
+                version = (await self.execute(STATISTICS_VERSION_QUERY))[0]
+                if self._version is not None and version != self._version:
+                    self.plan_cache.clear()
+                self._version = version
+                self._version_checked = now
+            return self._version
+
+    async def process_query(self, query):
+        '''
+        Retrieves query plan from Postgresql, or from the plan cache
+        :param query: query to be analyzed
+        :returns: query_plan if query is valid, in the same form as QueryProcessor.process_query
+        '''
+        check_single_query(query)
+
+        cache_key = None
+        if self.plan_cache.max_size > 0:
+            cache_key = (fingerprint_query(query), await self.statistics_version())
+            query_plan = self.plan_cache.get(cache_key)
+            if query_plan is not None:
+                return cached_plan(query_plan)
+
+        rows = await self.execute(f"EXPLAIN ({EXPLAIN_OPTIONS}) " + query)
+        query_plan = plan_from_result(plantree.loads(rows[0][0])[0])
+        if cache_key is not None:
+            self.plan_cache.put(cache_key, query_plan)
+        return query_plan
+
+    async def process_queries(self, queries, return_exceptions=False):
+        '''
+        Explains many queries concurrently over the pooled connections
+        :param return_exceptions: if True, a failing query gives its exception in place of a plan instead of raising
+        :returns: list of query plans, in the order of queries
+        '''
+        return await asyncio.gather(*(self.process_query(query) for query in queries), return_exceptions=return_exceptions)
+
+    def tokenize_query(self, query):
+        '''
+        Breaks query into lexer tokens, see preprocessing.tokenize_query
+        '''
+        return tokenize_query(query)
@@ -0,0 +1,256 @@
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from advisor import IndexAdvisor
+from annotation import ThreadAnnotators
+from catalog import CatalogCache
+from history import PlanHistory
+from lexer import LexerError, split_statements
+from metrics import Metrics
+from plansource import RecordingSource, ReplaySource
+from preprocessing import QueryProcessor
+
+# operators joining two inputs, and those appending the partitions of a partitioned table
+JOIN_TYPES = ("Nested Loop", "Hash Join", "Merge Join")
+APPEND_TYPES = ("Append", "Merge Append")
+
+def planning_drivers(query_plan):
+    '''
+    :returns: {"planning_time", "joins", "partitions"}: the planning time in ms, the number of joins in the plan, and the
+    number of partitions the planner considered (relations scanned under Append nodes, plus the ones pruned at planning)
+    '''
+    joins = 0
+    partitions = 0
+    for node in query_plan.walk():
+        if node.node_type in JOIN_TYPES:
+            joins += 1
+        elif node.node_type in APPEND_TYPES:
+            partitions += node.get("Subplans Removed", 0) + sum(1 for child in node.children if child.relation_name is not None)
+    return {"planning_time": query_plan.get("Planning Time"), "joins": joins, "partitions": partitions}
+
+# class to run annotations without the GUI, over many statements at once:
+class BatchAnnotator:
+
+    def __init__(self, processor, workers=4, analyze=False, advise=False, run_statements=False, catalog=None, planning_threshold=None):
+        '''
+        :param processor: QueryProcessor shared by all workers; its pool should hold at least `workers` connections
+        :param workers: maximum number of statements annotated at the same time
+        :param analyze: run each statement with EXPLAIN ANALYZE (inside a rolled-back transaction) instead of only planning it
+        :param advise: also propose indexes for each statement, see advisor.IndexAdvisor
+        :param run_statements: in scripts, run the statements that cannot be explained (rolled back afterwards), see QueryProcessor.process_script
+        :param catalog: optional catalog.CatalogCache shared by all workers, adding catalog statistics to the annotations
+        :param planning_threshold: planning time in ms from which a statement is flagged as expensive to plan, with the
+        joins and partitions that drove it (see planning_drivers); None to flag none
+        '''
+        self.processor = processor
+        self.workers = max(1, workers)
+        self.analyze = analyze
+        self.advisor = IndexAdvisor(processor) if advise else None
+        self.run_statements = run_statements
+        self.catalog = catalog
+        self.planning_threshold = planning_threshold
+        self.annotators = ThreadAnnotators(processor.metrics, catalog)
+
+    def annotate_statement(self, source, index, statement, cancellation=None, timeout=None):
+        '''
+        Runs process_query -> tokenize_query -> annotate for one statement
+        :param cancellation: optional Cancellation that can stop the EXPLAIN from another thread
+        :param timeout: seconds after which the server stops the EXPLAIN, see QueryProcessor.process_query
+        :returns: JSON-serializable record of the result (or of the error)
+        '''
+        record = {"source": source, "index": index, "query": statement}
+        try:
+            query_plan = self.processor.process_query(statement, cancellation=cancellation, timeout=timeout, analyze=self.analyze)
+            self.annotate_plan(record, statement, query_plan)
+        except Exception as e:
+            record["error"] = str(e)
+        return record
+
+    def annotate_script(self, source, script, cancellation=None, timeout=None):
+        '''
+        Retrieves the plans of all statements of a script at once (see QueryProcessor.process_script) and annotates them
+        :param cancellation, timeout: as for annotate_statement, for the whole script
+        :returns: list of records, as from annotate_statement with the offset of each statement in the script
+        '''
+        try:
+            if self.analyze:
+                raise Exception("Scripts cannot be run with EXPLAIN ANALYZE, only planned")
+            results = self.processor.process_script(script, cancellation=cancellation, timeout=timeout, run_statements=self.run_statements)
+        except Exception as e:
+            return [{"source": source, "index": None, "query": script, "error": str(e)}]
+
+        records = []
+        for index, result in enumerate(results):
+            record = {"source": source, "index": index, "offset": result["offset"], "query": result["query"]}
+            if "error" in result:
+                record["error"] = result["error"]
+            elif result["plan"] is None:
+                record["executed"] = True  # run instead of explained, nothing to annotate
+            else:
+                try:
+                    self.annotate_plan(record, result["query"], result["plan"])
+                except Exception as e:
+                    record["error"] = str(e)
+            records.append(record)
+        return records
+
+    def annotate_plan(self, record, statement, query_plan):
+        '''
+        Runs tokenize_query -> annotate for one statement and its plan, adding the results to record
+        '''
+        annotator = self.annotators.get()
+        tokenized_query = self.processor.tokenize_query(statement)
+        annotations = annotator.annotate(query_plan, tokenized_query)
+        record["tokens"] = [[token.text, token.start, token.end] for token in tokenized_query]
+        record.update(annotations.to_dict())  # fields, annotations (as rows of fields), cost, planning and aliases
+        record["plan_changes"] = query_plan.get("Plan Changes", [])
+        if (self.planning_threshold is not None and not query_plan.get("From Cache", False)  # a cached plan was not planned again
+                and query_plan.get("Planning Time", 0) >= self.planning_threshold):
+            record["expensive_planning"] = planning_drivers(query_plan)
+            if self.processor.metrics is not None:
+                self.processor.metrics.increment("expensive_planning")
+        if self.advisor is not None:
+            try:
+                record["index_advice"] = self.advisor.advise(statement, query_plan)
+            except Exception as e:  # the annotations are kept, only the advice is missing
+                record["index_advice_error"] = str(e)
+
+    def run(self, statements, out):
+        '''
+        Annotates (source, index, statement) tuples and writes one JSON line per statement as soon as it finishes.
+        At most `workers` statements are in flight, so arbitrarily long inputs are consumed lazily.
+        :returns: number of statements that failed
+        '''
+        return self._run(lambda *statement: [self.annotate_statement(*statement)], statements, out)
+
+    def run_scripts(self, scripts, out):
+        '''
+        Annotates (source, script) tuples, one round trip per script, and writes one JSON line per statement
+        :returns: number of statements that failed
+        '''
+        return self._run(self.annotate_script, scripts, out)
+
+    def _run(self, annotate, items, out):
+        failures = 0
+        items = iter(items)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = set()
+            exhausted = False
+            while True:
+                while not exhausted and len(pending) < self.workers:
+                    try:
+                        pending.add(executor.submit(annotate, *next(items)))
+                    except StopIteration:
+                        exhausted = True
+                if not pending:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    for record in future.result():
+                        if "error" in record:
+                            failures += 1
+                        out.write(json.dumps(record) + "\n")
+                    if self.processor.metrics is not None:
+                        self.processor.metrics.increment("statements", len(future.result()))
+                out.flush()
+        return failures
+
+
+def read_statements(paths):
+    '''
+    Yields (source, index, statement) for every statement in the given .sql files, directories of .sql files, or stdin ("-").
+    A file that cannot be split into statements (e.g. with an unterminated string) is yielded whole with an index of None:
+    annotating it fails with the same LexerError, so the file gets one error record and the files after it are still read
+    '''
+    for source, text in read_scripts(paths):
+        try:
+            statements = split_statements(text)
+        except LexerError:
+            yield source, None, text
+            continue
+        for index, (_, statement) in enumerate(statements):
+            yield source, index, statement
+
+
+def read_scripts(paths):
+    '''
+    Yields (source, text) for each of the given .sql files, .sql files in the given directories, or stdin ("-")
+    '''
+    for path in paths:
+        if path == "-":
+            sources = [("<stdin>", sys.stdin.read())]
+        elif os.path.isdir(path):
+            sources = []
+            for root, _, files in os.walk(path):
+                for name in sorted(files):
+                    if name.lower().endswith(".sql"):
+                        sources.append(os.path.join(root, name))
+            sources = ((source, None) for source in sorted(sources))
+        else:
+            sources = [(path, None)]
+
+        for source, text in sources:
+            if text is None:
+                with open(source, encoding="utf-8") as f:
+                    text = f.read()
+            yield source, text
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="project.py batch", description="Annotate SQL statements without the GUI, writing one JSON line per statement.")
+    parser.add_argument("paths", nargs="*", default=["-"], help=".sql files or directories to annotate (default: read stdin)")
+    parser.add_argument("--username", default=os.environ.get("PGUSER", "postgres"))
+    parser.add_argument("--password", default=os.environ.get("PGPASSWORD", ""))
+    parser.add_argument("--host", default=os.environ.get("PGHOST", "localhost"))
+    parser.add_argument("--database", default=os.environ.get("PGDATABASE", "postgres"))
+    parser.add_argument("--workers", type=int, default=4, help="number of statements annotated concurrently (default: 4)")
+    parser.add_argument("--output", default="-", help="file to write JSON lines to (default: stdout)")
+    parser.add_argument("--cache-size", type=int, default=256, help="number of plans kept for repeated statements, 0 to disable (default: 256)")
+    parser.add_argument("--history", help="SQLite file recording every plan; changes from the last recorded plan are reported")
+    parser.add_argument("--analyze", action="store_true", help="execute each statement with EXPLAIN ANALYZE; changes are rolled back")
+    parser.add_argument("--script", action="store_true", help="explain each file as one script, in a single round trip")
+    parser.add_argument("--run-statements", action="store_true", help="with --script, run statements that cannot be explained (e.g. DDL) so later ones see them; all is rolled back")
+    parser.add_argument("--advise", action="store_true", help="propose indexes for each statement, ranked by estimated cost reduction")
+    parser.add_argument("--catalog", action="store_true", help="add table sizes, scan selectivity, unused indexes and join column statistics from the catalog")
+    parser.add_argument("--planning-threshold", type=float, metavar="MS", help="flag statements taking at least MS milliseconds to plan, with their join and partition counts")
+    parser.add_argument("--record", metavar="DIR", help="save every plan retrieved to a fixture directory")
+    parser.add_argument("--replay", metavar="DIR", help="serve plans from a fixture directory made with --record, without a database")
+    parser.add_argument("--metrics", metavar="FILE", help="write the time spent in each stage to FILE: Prometheus text format if it ends with .prom, JSON lines otherwise")
+    args = parser.parse_args(argv)
+    if args.script and args.analyze:
+        parser.error("--analyze cannot be combined with --script: scripts are only planned, in one round trip")
+    if args.advise and args.replay:
+        parser.error("--advise cannot be combined with --replay: the advisor plans hypothetical indexes on a database")
+
+    metrics = Metrics() if args.metrics else None
+    if args.replay:
+        processor = ReplaySource(args.replay, args.cache_size, metrics=metrics)
+    else:
+        processor = QueryProcessor(args.username, args.password, args.host, args.database, pool_size=args.workers, cache_size=args.cache_size,
+                                   history=PlanHistory(args.history) if args.history else None, metrics=metrics)
+        if args.record:
+            processor = RecordingSource(processor, args.record)
+    with processor:
+        catalog = CatalogCache(processor) if args.catalog and not args.replay else None  # replayed plans have no database to read it from
+        batch = BatchAnnotator(processor, args.workers, args.analyze, args.advise, args.run_statements, catalog, args.planning_threshold)
+        out = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+        try:
+            if args.script:
+                failures = batch.run_scripts(read_scripts(args.paths), out)
+            else:
+                failures = batch.run(read_statements(args.paths), out)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        print("Plan cache: " + json.dumps(processor.plan_cache.stats()), file=sys.stderr)
+    if metrics is not None:
+        metrics.increment("failures", failures)
+        metrics.write(args.metrics)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,492 @@
+import argparse
+import gc
+import glob
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from annotation import SCAN, SUBPLAN, Annotation, AnnotationIndex, Annotator
+from plansource import ReplaySource
+from preprocessing import tokenize_query
+
+'''
+Benchmarks for the annotation pipeline, run with: python benchmark.py <benchmark> [options]
+The plans used here are synthetic or recorded (see benchmarks/tpch), so no database is needed.
+'''
+
+TPCH_FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks", "tpch")
+SUITE_STAGES = ("tokenize", "generate", "attach", "render")
+
+def synthetic_partitioned_plan(partitions):
+    '''
+    Plan of a query over a partitioned table: an Append with one Seq Scan per partition under an Aggregate
+    '''
+    scans = [{
+        "Node Type": "Seq Scan",
+        "Relation Name": f"lineitem_p{i}",
+        "Alias": f"lineitem_{i}",
+        "Total Cost": 10.0,
+        "Plan Rows": 100,
+        "Filter": "(l_quantity > 10)",
+    } for i in range(partitions)]
+    return {
+        "Node Type": "Aggregate",
+        "Strategy": "Plain",
+        "Total Cost": 10.0 * partitions,
+        "Plans": [{"Node Type": "Append", "Total Cost": 10.0 * partitions, "Plans": scans}],
+    }
+
+
+def synthetic_deep_plan(depth):
+    '''
+    Plan `depth` Nested Loops deep (each with an Index Scan as inner side), built without recursion
+    '''
+    plan = {"Node Type": "Seq Scan", "Relation Name": "orders", "Alias": "orders", "Total Cost": 1.0}
+    for i in range(depth - 1):
+        plan = {
+            "Node Type": "Nested Loop",
+            "Total Cost": float(i),
+            "Join Filter": "(o_orderkey = l_orderkey)",
+            "Plans": [plan, {"Node Type": "Index Scan", "Relation Name": "lineitem", "Alias": "lineitem", "Total Cost": 1.0}],
+        }
+    return plan
+
+
+def synthetic_wide_query(tables, aggregates):
+    '''
+    Analytic query joining `tables` aliased tables with `aggregates` aggregates in the select list, and its plan
+    (a left-deep chain of Hash Joins under a HashAggregate)
+    :returns: (query, plan)
+    '''
+    select_list = ", ".join(f"SUM(t{i % tables}.amount_{i})" for i in range(aggregates))
+    from_list = ", ".join(f"table_{i} t{i}" for i in range(tables))
+    conditions = " AND ".join(f"t{i-1}.k = t{i}.k" for i in range(1, tables))
+    query = f"SELECT t0.region, {select_list} FROM {from_list} WHERE {conditions or 'TRUE'} GROUP BY t0.region"
+
+    plan = {"Node Type": "Seq Scan", "Relation Name": "table_0", "Alias": "t0", "Total Cost": 1.0}
+    for i in range(1, tables):
+        inner = {"Node Type": "Seq Scan", "Relation Name": f"table_{i}", "Alias": f"t{i}", "Total Cost": 1.0}
+        plan = {
+            "Node Type": "Hash Join",
+            "Total Cost": float(i),
+            "Hash Cond": f"(t{i-1}.k = t{i}.k)",
+            "Plans": [plan, {"Node Type": "Hash", "Total Cost": 1.0, "Plans": [inner]}],
+        }
+    plan = {"Node Type": "HashAggregate", "Strategy": "Hashed", "Total Cost": float(tables), "Plans": [plan]}
+    return query, plan
+
+
+def count_nodes(plan):
+    count = 0
+    stack = [plan]
+    while stack:
+        node = stack.pop()
+        count += 1
+        stack.extend(node.get("Plans", []))
+    return count
+
+
+def bench_generate_annotations(sizes, repeat):
+    '''
+    Times Annotator.generate_annotations on wide (partitioned) and deep plans of growing size.
+    With a linear traversal the time per node stays roughly constant as the plan grows.
+    '''
+    annotator = Annotator()
+    print(f"{'shape':<8}{'nodes':>10}{'best (s)':>12}{'us/node':>10}")
+    for shape, build in (("wide", synthetic_partitioned_plan), ("deep", synthetic_deep_plan)):
+        for size in sizes:
+            plan = build(size)
+            nodes = count_nodes(plan)
+            best = float("inf")
+            for _ in range(repeat):
+                annotator.reset()
+                start = time.perf_counter()
+                annotator.generate_annotations(plan)
+                best = min(best, time.perf_counter() - start)
+            print(f"{shape:<8}{nodes:>10}{best:>12.4f}{best / nodes * 1e6:>10.2f}")
+
+
+def bench_attach_annotations(sizes, repeat):
+    '''
+    Times Annotator.attach_annotations on wide analytic queries with `size` joined tables and 10 * `size` aggregates.
+    Time per token stays roughly constant when attachment is linear in tokens + plan nodes.
+    '''
+    annotator = Annotator()
+    print(f"{'tables':>8}{'tokens':>10}{'best (s)':>12}{'us/token':>10}")
+    for size in sizes:
+        query, plan = synthetic_wide_query(size, 10 * size)
+        tokens = tokenize_query(query)
+        best = float("inf")
+        for _ in range(repeat):
+            annotator.reset()
+            annotator.generate_annotations(plan)
+            start = time.perf_counter()
+            annotator.attach_annotations(tokens)
+            best = min(best, time.perf_counter() - start)
+        print(f"{size:>8}{len(tokens):>10}{best:>12.4f}{best / len(tokens) * 1e6:>10.2f}")
+
+
+def bench_hover(sizes, repeat):
+    '''
+    Times hovering over annotations in QEPScreen (enter + exit) for queries of 10 joined tables
+    with `size` aggregates, so the number of tokens grows while the number of annotations does not.
+    Needs PyQt5; runs on the offscreen platform unless QT_QPA_PLATFORM is set.
+    '''
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    import interface
+    interface.application()
+
+    annotator = Annotator()
+    print(f"{'tokens':>10}{'annotations':>13}{'build (s)':>12}{'hover (ms)':>12}")
+    for size in sizes:
+        query, plan = synthetic_wide_query(10, size)
+        tokens = tokenize_query(query)
+        annotations = annotator.annotate(plan, tokens)
+        start = time.perf_counter()
+        screen = interface.QEPScreen(annotations, tokens)
+        build = time.perf_counter() - start
+        rows = [screen.table.item(row, 0) for row in range(min(20, len(screen.selections_by_row)))]
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for item in rows:
+                screen.handle_item_entered(item)
+                interface.app.processEvents()
+                screen.handle_item_exited(item)
+                interface.app.processEvents()
+            best = min(best, (time.perf_counter() - start) / len(rows))
+        print(f"{len(tokens):>10}{len(screen.selections_by_row):>13}{build:>12.3f}{best * 1000:>12.3f}")
+        screen.deleteLater()
+
+
+def bench_lookup(sizes, repeat):
+    '''
+    Times AnnotationIndex.at_token and at_offset over every position of a query with `size` two-token annotations
+    and one subquery annotation spanning the whole query. The time per lookup grows with log(size), not with size.
+    '''
+    print(f"{'annotations':>12}{'best (s)':>12}{'us/lookup':>11}")
+    for size in sizes:
+        annotations = [Annotation(SCAN, 3 * i, 3 * i + 2, 10 * i, 10 * i + 7, (i,), "") for i in range(size)]
+        annotations.append(Annotation(SUBPLAN, 0, 3 * size, 0, 10 * size, (size,), ""))
+        index = AnnotationIndex(annotations, "", {})
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for position in range(3 * size):
+                index.at_token(position)
+                index.at_offset(position)
+            best = min(best, time.perf_counter() - start)
+        print(f"{size + 1:>12}{best:>12.4f}{best / (6 * size) * 1e6:>11.2f}")
+
+
+def resident_memory():
+    '''
+    :returns: resident set size of this process in KiB (on Linux; elsewhere, the peak resident set size)
+    '''
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def bench_session(fixtures, cycles, report):
+    '''
+    Stress test of a long GUI session: each cycle submits a recorded TPC-H query, goes to the QEPScreen and back;
+    every 100 cycles, the session goes back to the welcome screen, fails a login into the ErrorScreen and logs in again.
+    Prints the resident memory and the number of live widgets every `report` cycles, which should stay flat.
+    Needs PyQt5; runs on the offscreen platform unless QT_QPA_PLATFORM is set.
+    '''
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    import interface
+    app = interface.application()
+    welcome = interface.WelcomeScreen()
+    interface.widgetStack.addWidget(welcome)
+    queries = [open(path, encoding="utf-8").read() for path in sorted(glob.glob(os.path.join(fixtures, "queries", "*.sql")))]
+
+    print(f"{'cycles':>8}{'RSS (KiB)':>12}{'widgets':>10}{'seconds':>10}")
+    start = time.perf_counter()
+    query_screen = None
+    for cycle in range(cycles + 1):
+        if cycle % report == 0:
+            gc.collect()
+            print(f"{cycle:>8}{resident_memory():>12}{len(app.allWidgets()):>10}{time.perf_counter() - start:>10.1f}")
+        if cycle == cycles:
+            break
+        if query_screen is None:
+            interface.replay_directory = os.path.join(fixtures, "missing")  # a new session, whose login fails
+            welcome.validate_login()
+            welcome.error_screen.goto_welcome_screen()
+            interface.replay_directory = fixtures
+            welcome.validate_login()
+            query_screen = interface.widgetStack.currentWidget()
+
+        query = queries[cycle % len(queries)]
+        query_screen.show_result(query_screen.get_annotated_query(query, query_screen.processor, query_screen.annotator))
+        query_screen.qep_screen.goto_query_screen()
+        if cycle % 100 == 99:
+            query_screen.goto_welcome_screen()
+            welcome.close_session()
+            query_screen = None
+        app.sendPostedEvents(None, interface.QEvent.DeferredDelete)  # what the event loop does with deleteLater
+    welcome.close_session()
+
+
+STARTUP_SCRIPT = '''
+import time
+start = time.perf_counter()
+import interface
+imported = time.perf_counter()
+interface.application()
+created = time.perf_counter()
+interface.WelcomeScreen()
+print(imported - start, created - imported, time.perf_counter() - created)
+'''
+
+def bench_startup(repeat):
+    '''
+    Times starting the GUI in a new interpreter, up to the WelcomeScreen being built: in total (including starting Python),
+    importing interface, creating the QApplication and building the screen.
+    The first run starts without the compiled layouts (see interface.ui_form), the others use the ones it saved.
+    Needs PyQt5; runs on the offscreen platform unless QT_QPA_PLATFORM is set.
+    '''
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for cached in glob.glob(os.path.join(directory, "__pycache__", "*.ui.*.pyc")):
+        os.remove(cached)
+
+    print(f"{'run':>6}{'total (s)':>12}{'import (s)':>12}{'app (s)':>10}{'screen (s)':>12}")
+    for run in range(repeat + 1):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT], cwd=directory, capture_output=True, text=True, check=True).stdout
+        total = time.perf_counter() - start
+        imported, created, built = (float(value) for value in output.split())
+        print(f"{'cold' if run == 0 else run:>6}{total:>12.3f}{imported:>12.3f}{created:>10.3f}{built:>12.3f}")
+
+
+def bench_replay(directory, repeat):
+    '''
+    Times tokenizing + annotating every plan in a fixture directory recorded with `project.py batch --record`,
+    so annotation throughput can be profiled on real plans without a database
+    '''
+    source = ReplaySource(directory)
+    recorded = list(source.recorded())
+    annotator = Annotator()
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for query, plan in recorded:
+            annotator.annotate(plan, tokenize_query(query))
+        best = min(best, time.perf_counter() - start)
+    source.close()
+    print(f"{'plans':>8}{'best (s)':>12}{'plans/s':>12}")
+    print(f"{len(recorded):>8}{best:>12.4f}{len(recorded) / best if best > 0 else 0:>12.0f}")
+
+
+def percentile(samples, fraction):
+    '''
+    :returns: nearest-rank percentile of a sorted list of samples
+    '''
+    return samples[min(len(samples) - 1, max(0, int(round(fraction * len(samples) + 0.5)) - 1))]
+
+
+def suite_cases(fixtures):
+    '''
+    :returns: {group: [(name, query, plan)]} with the TPC-H queries of the fixture directory (one per queries/*.sql file)
+    and synthetic cases of 10k+ plan nodes and 100k+ tokens
+    '''
+    source = ReplaySource(fixtures)
+    tpch = []
+    for path in sorted(glob.glob(os.path.join(fixtures, "queries", "*.sql"))):
+        with open(path, encoding="utf-8") as f:
+            query = f.read()
+        tpch.append((os.path.splitext(os.path.basename(path))[0], query, source.process_query(query)))
+    source.close()
+
+    wide_query, wide_plan = synthetic_wide_query(2000, 20000)
+    return {
+        "tpch": tpch,
+        "partitioned-10k": [("partitioned-10k", "SELECT SUM(l_quantity) FROM lineitem WHERE l_quantity > 10", synthetic_partitioned_plan(10000))],
+        "deep-10k": [("deep-10k", "SELECT * FROM orders, lineitem WHERE o_orderkey = l_orderkey", synthetic_deep_plan(10000))],
+        "tokens-100k": [("tokens-100k", wide_query, wide_plan)],
+    }
+
+
+def suite_stage(stage, query, plan, annotator, render):
+    '''
+    Prepares one stage of the pipeline for a case
+    :returns: (function run untimed before each run, function running the timed part, function cleaning up after the runs)
+    '''
+    tokens = tokenize_query(query)
+    if stage == "tokenize":
+        return lambda: None, lambda: tokenize_query(query), lambda: None
+    if stage == "generate":
+        return annotator.reset, lambda: annotator.generate_annotations(plan), lambda: None
+    if stage == "attach":  # attach_annotations consumes what generate_annotations collected, so that is redone before each run
+        def prepare():
+            annotator.reset()
+            annotator.tokenized_query = tokens
+            annotator.generate_annotations(plan)
+        return prepare, lambda: annotator.attach_annotations(tokens), lambda: None
+    annotations = annotator.annotate(plan, tokens)
+    screens = []
+    def cleanup():
+        while screens:
+            screens.pop().deleteLater()
+        render.app.sendPostedEvents(None, render.QEvent.DeferredDelete)
+    return lambda: None, lambda: screens.append(render.QEPScreen(annotations, tokens)), cleanup
+
+
+def bench_suite(fixtures, repeat, render=True, baseline=None, save_baseline=None, threshold=1.2):
+    '''
+    Runs each stage of the pipeline (tokenize_query, generate_annotations, attach_annotations, building a QEPScreen)
+    over the recorded TPC-H plans and synthetic plans, reporting throughput (runs/s, and units/s: plan nodes/s for
+    generate, tokens/s otherwise), latency percentiles and peak memory.
+    Peak memory is measured with tracemalloc in a separate, untimed run, so only Python allocations are counted.
+    :param render: include the QEPScreen stage (needs PyQt5; runs on the offscreen platform unless QT_QPA_PLATFORM is set)
+    :param baseline: JSON file saved with save_baseline to compare against; stages whose p50 latency or peak memory
+    grew by more than `threshold` times are reported as regressions
+    :returns: number of regressions
+    '''
+    stages = SUITE_STAGES
+    if render:
+        os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+        try:
+            import interface as render
+            render.application()
+        except ImportError as e:
+            print(f"Skipping render: {e}", file=sys.stderr)
+            render = None
+    if not render:
+        stages = stages[:-1]
+
+    annotator = Annotator()
+    results = {}
+    for group, cases in suite_cases(fixtures).items():
+        for stage in stages:
+            samples = []
+            units = 0  # plan nodes for generate, tokens for the other stages
+            peak = 0
+            for _, query, plan in cases:
+                prepare, run, cleanup = suite_stage(stage, query, plan, annotator, render)
+                units += (count_nodes(plan) if stage == "generate" else len(tokenize_query(query))) * repeat
+                gc.collect()
+                for _ in range(repeat):
+                    prepare()
+                    start = time.perf_counter()
+                    run()
+                    samples.append(time.perf_counter() - start)
+                cleanup()
+
+                prepare()
+                gc.collect()
+                tracemalloc.start()
+                run()
+                peak = max(peak, tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+                cleanup()
+
+            samples.sort()
+            total = sum(samples)
+            results[f"{group}/{stage}"] = {
+                "runs": len(samples),
+                "runs_per_s": len(samples) / total if total > 0 else 0.0,
+                "units_per_s": units / total if total > 0 else 0.0,
+                "p50_ms": percentile(samples, 0.50) * 1000,
+                "p95_ms": percentile(samples, 0.95) * 1000,
+                "p99_ms": percentile(samples, 0.99) * 1000,
+                "peak_kib": peak / 1024,
+            }
+
+    previous = {}
+    if baseline is not None:
+        with open(baseline, encoding="utf-8") as f:
+            previous = json.load(f)["results"]
+
+    regressions = 0
+    print(f"{'benchmark':<26}{'runs':>6}{'runs/s':>10}{'units/s':>12}{'p50 (ms)':>10}{'p95 (ms)':>10}{'p99 (ms)':>10}{'peak (KiB)':>12}"
+          + (f"{'p50 vs base':>13}{'mem vs base':>13}" if previous else ""))
+    for name, result in results.items():
+        line = (f"{name:<26}{result['runs']:>6}{result['runs_per_s']:>10.1f}{result['units_per_s']:>12.0f}"
+                f"{result['p50_ms']:>10.3f}{result['p95_ms']:>10.3f}{result['p99_ms']:>10.3f}{result['peak_kib']:>12.1f}")
+        if name in previous:
+            ratios = [result[key] / previous[name][key] if previous[name][key] > 0 else 1.0 for key in ("p50_ms", "peak_kib")]
+            line += "".join(f"{ratio:>12.2f}x" for ratio in ratios)
+            if max(ratios) > threshold:
+                line += "  REGRESSION"
+                regressions += 1
+        print(line)
+
+    if save_baseline is not None:
+        with open(save_baseline, "w", encoding="utf-8") as f:
+            json.dump({"python": sys.version.split()[0], "repeat": repeat, "results": results}, f, indent=2)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks for the annotation pipeline.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    generate = subparsers.add_parser("generate", help="plan traversal in Annotator.generate_annotations")
+    generate.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    generate.add_argument("--repeat", type=int, default=3)
+
+    attach = subparsers.add_parser("attach", help="token-to-plan matching in Annotator.attach_annotations")
+    attach.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    attach.add_argument("--repeat", type=int, default=3)
+
+    hover = subparsers.add_parser("hover", help="hover highlighting in QEPScreen (needs PyQt5)")
+    hover.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    hover.add_argument("--repeat", type=int, default=3)
+
+    lookup = subparsers.add_parser("lookup", help="AnnotationIndex lookups by token and offset, with one annotation spanning the query")
+    lookup.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    lookup.add_argument("--repeat", type=int, default=3)
+
+    session = subparsers.add_parser("session", help="memory and widget count over a long GUI session (needs PyQt5)")
+    session.add_argument("--fixtures", default=TPCH_FIXTURES, help="fixture directory with the plans of queries/*.sql (default: benchmarks/tpch)")
+    session.add_argument("--cycles", type=int, default=10000)
+    session.add_argument("--report", type=int, default=1000, help="print memory every this many cycles")
+
+    startup = subparsers.add_parser("startup", help="time to start the GUI, in new interpreters (needs PyQt5)")
+    startup.add_argument("--repeat", type=int, default=5)
+
+    replay = subparsers.add_parser("replay", help="annotation of plans recorded with `project.py batch --record`")
+    replay.add_argument("directory")
+    replay.add_argument("--repeat", type=int, default=3)
+
+    suite = subparsers.add_parser("suite", help="every stage over the TPC-H fixtures and 10k+ node / 100k+ token plans, with an optional baseline")
+    suite.add_argument("--fixtures", default=TPCH_FIXTURES, help="fixture directory with the plans of queries/*.sql (default: benchmarks/tpch)")
+    suite.add_argument("--repeat", type=int, default=5)
+    suite.add_argument("--no-render", action="store_true", help="skip the QEPScreen stage")
+    suite.add_argument("--baseline", help="JSON file from --save-baseline to compare against; exits with 1 on a regression")
+    suite.add_argument("--save-baseline", metavar="FILE", help="save the results as a baseline")
+    suite.add_argument("--threshold", type=float, default=1.2, help="ratio to the baseline above which a stage is a regression (default: 1.2)")
+
+    args = parser.parse_args(argv)
+    if args.benchmark == "generate":
+        bench_generate_annotations(args.sizes, args.repeat)
+    elif args.benchmark == "attach":
+        bench_attach_annotations(args.sizes, args.repeat)
+    elif args.benchmark == "hover":
+        bench_hover(args.sizes, args.repeat)
+    elif args.benchmark == "lookup":
+        bench_lookup(args.sizes, args.repeat)
+    elif args.benchmark == "session":
+        bench_session(args.fixtures, args.cycles, args.report)
+    elif args.benchmark == "startup":
+        bench_startup(args.repeat)
+    elif args.benchmark == "replay":
+        bench_replay(args.directory, args.repeat)
+    elif args.benchmark == "suite":
+        if bench_suite(args.fixtures, args.repeat, not args.no_render, args.baseline, args.save_baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,63 @@
+import threading
+from collections import OrderedDict
+
+# class to hold query plans that were already retrieved from Postgresql:
+class PlanCache:
+
+    def __init__(self, max_size=256):
+        '''
+        Least-recently-used cache of query plans
+        :param max_size: maximum number of plans kept; 0 disables caching
+        '''
+        self.max_size = max_size
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        '''
+        :returns: the cached plan for key, or None if it is not cached
+        '''
+        with self._lock:
+            plan = self._plans.get(key)
+            if plan is None:
+                self.misses += 1
+                return None
+            self._plans.move_to_end(key)
+            self.hits += 1
+            return plan
+
+    def put(self, key, plan):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._plans[key] = plan
+            self._plans.move_to_end(key)
+            while len(self._plans) > self.max_size:
+                self._plans.popitem(last=False)  # evict least recently used
+
+    def clear(self):
+        '''
+        Drops every cached plan, e.g. after the statistics or schema of the database changed
+        '''
+        with self._lock:
+            if self._plans:
+                self.invalidations += 1
+            self._plans.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._plans),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "invalidations": self.invalidations,
+            }
+
+    def __len__(self):
+        return len(self._plans)
@@ -0,0 +1,86 @@
+import threading
+
+# size, row estimate, indexes and per-column statistics of the given relations, resolved through the search path
+# like the relation names in plans; every relation is fetched in this one query, whatever their number
+CATALOG_QUERY = """
+SELECT name, c.reltuples::float8, c.relpages::bigint * current_setting('block_size')::bigint,
+       COALESCE((SELECT json_agg(json_build_object(
+                    'name', i.relname,
+                    'columns', (SELECT json_agg(a.attname ORDER BY k.n)
+                                FROM unnest(x.indkey::int2[]) WITH ORDINALITY AS k(attnum, n)
+                                JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum = k.attnum),
+                    'unique', x.indisunique,
+                    'definition', pg_get_indexdef(x.indexrelid)) ORDER BY i.relname)
+                 FROM pg_index x JOIN pg_class i ON i.oid = x.indexrelid
+                 WHERE x.indrelid = c.oid AND x.indisvalid), '[]'::json),
+       COALESCE((SELECT json_object_agg(s.attname, json_build_object('null_frac', s.null_frac, 'n_distinct', s.n_distinct, 'correlation', s.correlation))
+                 FROM pg_stats s
+                 WHERE s.schemaname = n.nspname AND s.tablename = c.relname), '{}'::json)
+FROM unnest(%s::text[]) AS name
+JOIN pg_class c ON c.oid = to_regclass(quote_ident(name))
+JOIN pg_namespace n ON n.oid = c.relnamespace
+"""
+
+def format_size(size):
+    '''
+    :returns: size in bytes as text, e.g. "8.0 kB", "1.2 GB"
+    '''
+    for unit in ("bytes", "kB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "bytes" else f"{size:.1f} {unit}"
+        size /= 1024
+
+def distinct_values(stats, column):
+    '''
+    :returns: estimated number of distinct values of a column, from pg_stats.n_distinct (negative when it is a fraction of the rows),
+    or None without statistics
+    '''
+    column_stats = stats["columns"].get(column)
+    if column_stats is None or column_stats["n_distinct"] is None:
+        return None
+    n_distinct = column_stats["n_distinct"]
+    if n_distinct >= 0:
+        return n_distinct
+    return -n_distinct * stats["rows"] if stats["rows"] is not None else None
+
+# class to cache catalog statistics of the relations in plans, for the whole session:
+class CatalogCache:
+
+    def __init__(self, processor):
+        '''
+        :param processor: QueryProcessor the catalog is read with. The cache is cleared when its statistics version changes
+        (after DDL or ANALYZE), see QueryProcessor.statistics_version
+        '''
+        self.processor = processor
+        self._relations = {}  # {relation name: statistics, None if it is not in the catalog}
+        self._version = None
+        self._lock = threading.Lock()
+
+    def lookup(self, names):
+        '''
+        Reads the relations not cached yet from the catalog, all in one query
+        :param names: relation names as they appear in plans ("Relation Name")
+        :returns: {name: {"rows" (None if never analyzed), "bytes", "indexes": [{"name", "columns", "unique", "definition"}], "columns": {column: {"null_frac", "n_distinct", "correlation"}}}}
+        of the names found in the catalog
+        '''
+        version = self.processor.statistics_version()
+        with self._lock:
+            if version != self._version:
+                self._relations = {}
+                self._version = version
+            relations = self._relations
+            missing = sorted(set(name for name in names if name not in relations))
+
+        if len(missing) != 0:
+            fetched = dict.fromkeys(missing)
+            for name, rows, size, indexes, columns in self.processor.execute(CATALOG_QUERY, (missing,)):
+                fetched[name] = {"rows": rows if rows >= 0 else None, "bytes": size, "indexes": indexes, "columns": columns}  # reltuples is -1 before the first ANALYZE
+            with self._lock:
+                relations.update(fetched)  # dropped if the version changed meanwhile
+
+        return {name: relations[name] for name in names if relations.get(name) is not None}
+
+    def clear(self):
+        with self._lock:
+            self._relations = {}
+            self._version = None
@@ -0,0 +1,161 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+import plantree
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS plans (
+    id INTEGER PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    recorded_at REAL NOT NULL,
+    total_cost REAL,
+    plan TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS plans_fingerprint ON plans (fingerprint);
+"""
+
+# fields that differ between two EXPLAINs of the same plan: the top-level EXPLAIN fields added to the plan by
+# preprocessing.plan_from_result, the marks added by QueryProcessor (changes from the history, plans from the cache)
+# and the run-time figures of EXPLAIN ANALYZE
+VOLATILE_FIELDS = {"Planning Time", "Planning", "Execution Time", "Triggers", "JIT", "Plan Changes", "From Cache", "Workers", "Workers Launched"}
+VOLATILE_PREFIXES = ("Actual ", "Rows Removed by ", "Shared ", "Local ", "Temp ", "I/O ", "WAL ", "Sort Space ", "Sort Method",
+                     "Peak Memory", "Heap Fetches", "Exact Heap", "Lossy Heap", "Hash Batches", "Hash Buckets", "Original Hash",
+                     "Disk Usage", "HashAgg Batches", "Cache ")
+
+def plan_digest(plan):
+    '''
+    :returns: hex digest of the plan as planned (node types, estimates, conditions, ...), the same for every EXPLAIN
+    giving this plan whatever its planning time, buffers or run-time figures
+    '''
+    digest = hashlib.sha1()
+    stack = [(plan, -1)]
+    position = 0
+    while len(stack) != 0:  # pre-order, each node with the position of its parent
+        node, parent = stack.pop()
+        fields = [[key, value] for key, value in node.items()
+                  if key != "Plans" and key not in VOLATILE_FIELDS and not key.startswith(VOLATILE_PREFIXES)]
+        digest.update(json.dumps([parent, fields], default=plantree.encode).encode("utf-8"))
+        stack.extend((child, position) for child in reversed(node.get("Plans", [])))
+        position += 1
+    return digest.hexdigest()
+
+def describe_node(plan):
+    '''
+    :returns: short name of a plan node, e.g. "Index Scan on customer"
+    '''
+    if "Relation Name" in plan:
+        return f"{plan['Node Type']} on {plan['Relation Name']}"
+    return plan["Node Type"]
+
+def join_order(plan):
+    '''
+    :returns: the relations of the plan in the order they are scanned (the leaves of the plan, left to right)
+    '''
+    relations = []
+    stack = [plan]
+    while len(stack) != 0:
+        curr_plan = stack.pop()
+        if "Relation Name" in curr_plan:
+            relations.append(curr_plan.get("Alias", curr_plan["Relation Name"]))
+        stack.extend(reversed(curr_plan.get("Plans", [])))
+    return relations
+
+def diff_plans(previous, current, cost_ratio=2.0):
+    '''
+    Compares a plan with an earlier plan of the same query
+    :param cost_ratio: total cost change (either way) from which a cost jump is reported
+    :returns: list of sentences describing changed node types, join order and cost jumps; empty if nothing changed
+    '''
+    changes = []
+
+    # walk both trees side by side; nodes at the same position are compared
+    stack = [(previous, current)]
+    while len(stack) != 0:
+        before, after = stack.pop()
+        if before["Node Type"] != after["Node Type"]:
+            name = describe_node(after)
+            changes.append(f"The {describe_node(before)} is now {'an' if name[0] in 'AEIOU' else 'a'} {name}.")
+        before_children = before.get("Plans", [])
+        after_children = after.get("Plans", [])
+        if len(before_children) != len(after_children):
+            changes.append(f"The {describe_node(after)} now has {len(after_children)} input(s) instead of {len(before_children)}.")
+        stack.extend(reversed(list(zip(before_children, after_children))))
+
+    before_order = join_order(previous)
+    after_order = join_order(current)
+    if before_order != after_order and sorted(before_order) == sorted(after_order):
+        changes.append(f"The join order changed from {', '.join(before_order)} to {', '.join(after_order)}.")
+
+    before_cost = previous.get("Total Cost", 0)
+    after_cost = current.get("Total Cost", 0)
+    if before_cost > 0 and after_cost > 0 and max(before_cost, after_cost) >= cost_ratio * min(before_cost, after_cost):
+        direction = "rose" if after_cost > before_cost else "fell"
+        changes.append(f"The total cost {direction} from {before_cost} to {after_cost}.")
+    return changes
+
+# class to keep the plans retrieved for a query, each one until the query gets another, to catch plan regressions:
+class PlanHistory:
+
+    def __init__(self, path="plan_history.sqlite3", cost_ratio=2.0):
+        '''
+        Opens (or creates) a SQLite plan history
+        :param path: database file, or ":memory:"
+        :param cost_ratio: total cost change (either way) from which a cost jump is reported
+        '''
+        self.path = path
+        self.cost_ratio = cost_ratio
+        self._lock = threading.Lock()  # one connection shared by the worker threads
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._db.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def record(self, fingerprint, plan):
+        '''
+        Stores a plan of the query with this fingerprint, unless it is the plan recorded last for it (see plan_digest)
+        :returns: the plan recorded for the fingerprint before this one, or None
+        '''
+        with self._lock, self._db:
+            row = self._db.execute(
+                "SELECT plan FROM plans WHERE fingerprint = ? ORDER BY id DESC LIMIT 1", (fingerprint,)
+            ).fetchone()
+            previous = None if row is None else plantree.loads(row[0])
+            if previous is not None and plan_digest(previous) == plan_digest(plan):
+                return previous
+            self._db.execute(
+                "INSERT INTO plans (fingerprint, recorded_at, total_cost, plan) VALUES (?, ?, ?, ?)",
+                (fingerprint, time.time(), plan.get("Total Cost"), plantree.dumps(plan))
+            )
+        return previous
+
+    def compare(self, fingerprint, plan):
+        '''
+        Records a plan and compares it with the last plan recorded for the same query
+        :returns: list of changes, see diff_plans
+        '''
+        previous = self.record(fingerprint, plan)
+        if previous is None:
+            return []
+        return diff_plans(previous, plan, self.cost_ratio)
+
+    def plans(self, fingerprint, limit=10):
+        '''
+        :returns: the latest `limit` records for the fingerprint as dicts of recorded_at, total_cost and plan, newest first
+        '''
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT recorded_at, total_cost, plan FROM plans WHERE fingerprint = ? ORDER BY id DESC LIMIT ?", (fingerprint, limit)
+            ).fetchall()
+        return [{"recorded_at": recorded_at, "total_cost": total_cost, "plan": plantree.loads(plan)} for recorded_at, total_cost, plan in rows]
@@ -1,19 +1,40 @@
 import sys
 import os
+import io
+import marshal
 import re
-import copy
-from PyQt5.uic import loadUi
 from PyQt5 import QtWidgets
-from PyQt5.QtCore import Qt, QEvent, pyqtSignal, QPersistentModelIndex, QModelIndex
+from PyQt5.QtCore import Qt, QEvent, pyqtSignal, QPersistentModelIndex, QModelIndex, QObject, QRunnable, QThreadPool
 from PyQt5.QtWidgets import QDialog, QApplication, QHeaderView, QTableWidget, QTableWidgetItem, QAbstractItemView
-from PyQt5.QtGui import QFont, QSyntaxHighlighter, QTextCharFormat, QBrush, QColor
+from PyQt5.QtGui import QFont, QSyntaxHighlighter, QTextCharFormat, QTextCursor, QBrush, QColor
 
-from annotation import Annotator
-from preprocessing import QueryProcessor
+from annotation import SUBPLAN, AnnotationIndex, Annotator
+from metrics import Metrics, timed
 
-QApplication.setAttribute(Qt.AA_EnableHighDpiScaling) # DPI Support for high DPI screens
-app = QApplication(sys.argv)
-widgetStack = QtWidgets.QStackedWidget()
+# QApplication and the stack of screens, created by application() when the GUI starts, so importing this module does no Qt work
+app = None
+widgetStack = None
+
+# Directory of the .ui files, and of their compiled layouts (see ui_form)
+UI_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+UI_CACHE = os.path.join(UI_DIRECTORY, "__pycache__")
+
+_UI_FORMS = {}  # {.ui file name: form class compiled from it}
+
+# Seconds after which the server stops an EXPLAIN started from the GUI
+query_timeout = 60
+
+# SQLite file in which every plan is recorded, so that changes from the last recorded plan are reported; None to disable
+history_path = None
+
+# Fixture directory recorded with `project.py batch --record`; if set, plans are served from it and no database is used
+replay_directory = None
+
+# Add table sizes, the share of rows each scan returns, unused indexes and join column statistics from the catalog to the annotations
+catalog_statistics = True
+
+# Show how long each stage (connection, EXPLAIN, decoding, tokenizing, annotating, display) took below the annotations
+show_timings = False
 
 # Sample queries used for display in QueryScreen
 sample_queries = ["SELECT * \nFROM customer, nation, supplier \nWHERE nation.n_nationkey = 0",
@@ -24,10 +45,77 @@ sample_queries = ["SELECT * \nFROM customer, nation, supplier \nWHERE nation.n_n
 "SELECT * \nFROM customer c, lineitem l1 \nWHERE c.c_custkey = ( \n    SELECT o_orderkey \n    FROM orders, lineitem l2 \n    WHERE o_custkey = 4 and l2.l_partkey = 5\n) and l1.l_suppkey = 7",
 "SELECT * \nFROM customer c, lineitem l1 \nWHERE c.c_custkey = ( \n    SELECT o_orderkey \n    FROM orders \n    WHERE o_custkey = 4 and l1.l_partkey = 5 \n) and l1.l_suppkey = ( \n    SELECT ps_suppkey \n    FROM partsupp \n    WHERE ps_availqty = 4 \n)"]
 
+def application():
+    '''
+    Creates the QApplication and the stack of screens the first time it is called
+    :returns: app
+    '''
+    global app, widgetStack
+    if app is None:
+        QApplication.setAttribute(Qt.AA_EnableHighDpiScaling) # DPI Support for high DPI screens
+        app = QApplication.instance() or QApplication(sys.argv)
+        widgetStack = QtWidgets.QStackedWidget()
+    return app
+
+def ui_form(name):
+    '''
+    Compiles a .ui file into a form class once per run, instead of parsing its XML every time a screen is built.
+    The compiled code is also kept in UI_CACHE until the .ui file changes, so later runs start without PyQt5.uic
+    :param name: .ui file in UI_DIRECTORY
+    :returns: the form class (Ui_<object name>), whose setupUi(widget) builds the layout on widget
+    '''
+    form = _UI_FORMS.get(name)
+    if form is not None:
+        return form
+
+    path = os.path.join(UI_DIRECTORY, name)
+    cached = os.path.join(UI_CACHE, f"{name}.{sys.implementation.cache_tag}.pyc")
+    stamp = os.stat(path).st_mtime_ns.to_bytes(8, "little")
+    code = None
+    try:
+        with open(cached, "rb") as f:
+            if f.read(8) == stamp:
+                code = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        code = None
+    if code is None:
+        from PyQt5.uic import compileUi  # only needed when the layout changed
+        source = io.StringIO()
+        compileUi(path, source)
+        code = compile(source.getvalue(), path, "exec")
+        try:
+            os.makedirs(UI_CACHE, exist_ok=True)
+            temporary = f"{cached}.{os.getpid()}.tmp"
+            with open(temporary, "wb") as f:
+                f.write(stamp)
+                marshal.dump(code, f)
+            os.replace(temporary, cached)
+        except OSError:
+            pass  # e.g. installed read-only; compiled again on the next run
+
+    namespace = {}
+    exec(code, namespace)
+    form = _UI_FORMS[name] = next(value for key, value in namespace.items() if key.startswith("Ui_"))
+    return form
+
+def load_ui(name, widget):
+    '''
+    Builds the layout of a .ui file on widget, like PyQt5.uic.loadUi: each child widget is set as an attribute of widget
+    '''
+    form = ui_form(name)()
+    form.setupUi(widget)
+    for attribute, child in vars(form).items():
+        setattr(widget, attribute, child)
+
 class WelcomeScreen(QDialog):
     def __init__(self):
         super(WelcomeScreen, self).__init__()
-        loadUi(os.path.join(os.path.dirname(__file__), 'WelcomeScreen.ui'), self)
+        load_ui('WelcomeScreen.ui', self)
+        self.processor = None
+        self.catalog = None
+        self.login = None
+        self.error_screen = None  # built on the first failed login, and reused for the next ones
+        self.metrics = Metrics() if show_timings else None
         self.loadDatabaseButton.clicked.connect(self.validate_login)
         self.quitButton.clicked.connect(self.quit)
 
@@ -38,19 +126,47 @@ class WelcomeScreen(QDialog):
         self.database = self.database_input.toPlainText()
 
         try:   
+            # imported on the first login, so psycopg2 is not loaded before the first screen is shown
+            from catalog import CatalogCache
+            from history import PlanHistory
+            from plansource import ReplaySource
+            from preprocessing import QueryProcessor
+
             # Load QueryScreen if successful
-            self.processor = QueryProcessor(self.username, self.password, self.host, self.database)
-            self.annotator = Annotator()
+            login = (self.username, self.password, self.host, self.database)
+            if self.processor is None or self.login != login:  # reuse the open session if the login did not change
+                self.close_session()
+                if replay_directory is not None:
+                    self.processor = ReplaySource(replay_directory, metrics=self.metrics)
+                else:
+                    history = PlanHistory(history_path) if history_path is not None else None
+                    self.processor = QueryProcessor(self.username, self.password, self.host, self.database, history=history, metrics=self.metrics)
+                    if catalog_statistics:
+                        self.catalog = CatalogCache(self.processor)
+                self.login = login
+            self.annotator = Annotator(self.metrics, self.catalog)
             queryScreen = QueryScreen(self.processor, self.annotator)
             widgetStack.addWidget(queryScreen)
-            widgetStack.setCurrentIndex(widgetStack.currentIndex()+1)
+            widgetStack.setCurrentWidget(queryScreen)
         except Exception as e:
             # Load ErrorScreen if unsuccessful
-            error_screen = ErrorScreen(e)
-            widgetStack.addWidget(error_screen)
-            widgetStack.setCurrentIndex(widgetStack.currentIndex()+1)
+            if self.error_screen is None:
+                self.error_screen = ErrorScreen(e)
+            else:
+                self.error_screen.set_error(e)
+            widgetStack.addWidget(self.error_screen)
+            widgetStack.setCurrentWidget(self.error_screen)
+
+    def close_session(self):
+        # Close the pooled connections of the previous login, if any
+        if self.processor is not None:
+            self.processor.close()
+            self.processor = None
+            self.catalog = None
+            self.login = None
 
     def quit(self):
+        self.close_session()
         app.quit()
 
 class Highlighter(QSyntaxHighlighter):
@@ -91,26 +207,64 @@ class ErrorScreen(QDialog):
 
     def __init__(self, error_message: str):
         super(ErrorScreen, self).__init__()
-        loadUi(os.path.join(os.path.dirname(__file__), 'ErrorScreen.ui'), self)
+        load_ui('ErrorScreen.ui', self)
         self.backButton.clicked.connect(self.goto_welcome_screen)
+        self.set_error(error_message)
+
+    def set_error(self, error_message):
         self.errorMessage.setText(str(error_message))
 
     def goto_welcome_screen(self):
-        widgetStack.removeWidget(widgetStack.currentWidget())
+        # the screen is kept for the next error, so it is only taken off the stack
+        widgetStack.removeWidget(self)
+
+
+class WorkerSignals(QObject):
+    finished = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+class Worker(QRunnable):
+    '''
+    Runs fn(*args) on a QThreadPool thread, and reports its result or error through signals on the GUI thread
+    '''
+    def __init__(self, fn, *args):
+        super(Worker, self).__init__()
+        self.fn = fn
+        self.args = args
+        self.signals = WorkerSignals()
+
+    def run(self):
+        try:
+            result = self.fn(*self.args)
+        except Exception as e:
+            self.signals.failed.emit(str(e))
+        else:
+            self.signals.finished.emit(result)
 
 
 class QueryScreen(QDialog):
-    def __init__(self, processor: QueryProcessor, annotator: Annotator):
+    def __init__(self, processor, annotator: Annotator):
+        '''
+        :param processor: preprocessing.QueryProcessor, or plansource.ReplaySource when replaying recorded plans
+        '''
         super(QueryScreen, self).__init__()
-        loadUi(os.path.join(os.path.dirname(__file__), 'QueryScreen.ui'), self)
+        load_ui('QueryScreen.ui', self)
 
         self.processor = processor
         self.annotator = annotator
+        self.qep_screen = None  # built for the first result, and repopulated for the next ones
 
         self.submitButton.clicked.connect(self.click_submit)
         self.backButton.clicked.connect(self.goto_welcome_screen)
+        self.cancelButton.clicked.connect(self.click_cancel)
         self.comboBox.activated.connect(self.on_activated)
 
+        # Annotation runs on a worker thread; these are shown while it runs
+        self.worker = None
+        self.cancellation = None
+        self.progressBar.hide()
+        self.cancelButton.hide()
+
         self.highlighter = Highlighter()
         self.highlighter.setDocument(self.queryInput.document())
         
@@ -121,47 +275,83 @@ class QueryScreen(QDialog):
             self.queryInput.clear()
             self.queryInput.appendPlainText(sample_queries[combobox_index-1])
 
-    def get_annotated_query(self, query, processor, annotator):
+    def get_annotated_query(self, query, processor, annotator, cancellation=None, analyze=False):
         '''
-        Gets annotations for the input query
+        Gets annotations for the input query. Runs on a worker thread, and raises if the query fails
         :param query: 
         SQL query to be analyzed
+        :param analyze:
+        if True, the query is executed with EXPLAIN ANALYZE and annotated with its actual rows and timings
         :returns tup: 
-        tuple[0] = dictionary where the keys represent a token's index, and the value represents the annotation for that token
+        tuple[0] = AnnotationIndex of the annotations, each with the range of tokens it belongs to
         tuple[1]= list of tokens that the query has been split into
         '''
-        try:
-            query_plan = processor.process_query(query)
-            tokenized_query = processor.tokenize_query(query)
-            annotation_dict = annotator.annotate(query_plan, tokenized_query)
-            return annotation_dict, tokenized_query
-        except Exception as e:
-            return e
+        query_plan = processor.process_query(query, cancellation=cancellation, timeout=query_timeout, analyze=analyze)
+        tokenized_query = processor.tokenize_query(query)
+        annotations = annotator.annotate(query_plan, tokenized_query)
+        return annotations, tokenized_query
 
     def click_submit(self):
+        from preprocessing import Cancellation  # already loaded by the login
         self.text = self.queryInput.toPlainText()
-        try:
-            annotated_dict, tokenized_query = self.get_annotated_query(self.text, self.processor, self.annotator)
-            if len(annotated_dict) != 2:
-                self.errorMessage.setText("")
-                self.goto_QEP_screen(annotated_dict, list(enumerate(tokenized_query)))
-            else:
-                # Query has no annotations 
-                self.errorMessage.setStyleSheet("color: #4BB543")
-                self.errorMessage.setText("Query executed successfully, but has no annotations for viewing!")
-        except Exception as e:
-            # Query execution has error, display error message
-            error_message = self.get_annotated_query(self.text, self.processor, self.annotator)
-            self.errorMessage.setStyleSheet("color: #FF0000")
-            self.errorMessage.setText(str(error_message))
+        self.cancellation = Cancellation()
+        self.worker = Worker(self.get_annotated_query, self.text, self.processor, self.annotator, self.cancellation, self.analyzeCheckBox.isChecked())
+        self.worker.signals.finished.connect(self.show_result)
+        self.worker.signals.failed.connect(self.show_error)
+        self.set_running(True)
+        QThreadPool.globalInstance().start(self.worker)
+
+    def click_cancel(self):
+        if self.cancellation is not None:
+            self.cancellation.cancel()
+
+    # Swaps the submit/back buttons for the progress indicator and cancel button while a query runs
+    def set_running(self, running):
+        self.submitButton.setEnabled(not running)
+        self.backButton.setEnabled(not running)
+        self.analyzeCheckBox.setEnabled(not running)
+        self.progressBar.setVisible(running)
+        self.cancelButton.setVisible(running)
+        if running:
+            self.errorMessage.setStyleSheet("color: #FFFFFF")
+            self.errorMessage.setText("Retrieving the query plan...")
+
+    def show_result(self, result):
+        self.set_running(False)
+        self.worker = None
+        annotations, tokenized_query = result
+        if len(annotations) != 0:
+            self.errorMessage.setText("")
+            self.goto_QEP_screen(annotations, tokenized_query)
+        else:
+            # Query has no annotations 
+            self.errorMessage.setStyleSheet("color: #4BB543")
+            self.errorMessage.setText("Query executed successfully, but has no annotations for viewing!")
+
+    def show_error(self, error_message):
+        # Query execution has error, display the error message of that run
+        self.set_running(False)
+        self.worker = None
+        if self.cancellation is not None and self.cancellation.cancelled:
+            error_message = "The query was cancelled."
+        self.errorMessage.setStyleSheet("color: #FF0000")
+        self.errorMessage.setText(error_message)
 
     def goto_welcome_screen(self):
-        widgetStack.removeWidget(widgetStack.currentWidget())
-
-    def goto_QEP_screen(self, annotatedDict, tokenizedQuery):
-        qepScreen = QEPScreen(annotatedDict, tokenizedQuery)
-        widgetStack.addWidget(qepScreen)
-        widgetStack.setCurrentIndex(widgetStack.currentIndex()+1)
+        # a new QueryScreen is built on the next login, so this one and its QEPScreen are freed
+        widgetStack.removeWidget(self)
+        if self.qep_screen is not None:
+            self.qep_screen.deleteLater()
+            self.qep_screen = None
+        self.deleteLater()
+
+    def goto_QEP_screen(self, annotations, tokenizedQuery):
+        if self.qep_screen is None:
+            self.qep_screen = QEPScreen(annotations, tokenizedQuery, self.annotator.metrics)
+        else:
+            self.qep_screen.show_annotations(annotations, tokenizedQuery)
+        widgetStack.addWidget(self.qep_screen)
+        widgetStack.setCurrentWidget(self.qep_screen)
 
 class TableWidget(QTableWidget):
     
@@ -212,191 +402,220 @@ class TableWidget(QTableWidget):
 
 class QEPScreen(QDialog):
 
-    def __init__(self, annotated_dict: dict, tokenized_query: list):
+    def __init__(self, annotations: AnnotationIndex, tokenized_query: list, metrics: Metrics = None):
         super(QEPScreen, self).__init__()
 
-        self.annotated_dict = annotated_dict
-        self.tokenized_query = tokenized_query
+        self.annotations = None
+        self.tokenized_query = None
+        self.metrics = metrics  # if set, the time each stage took is shown below the annotations
         self.highlighter = Highlighter()
 
         '''
-        Dictionaries that hold the mapping of an annotation to its highlight color
-        color_allocation holds the mapping of all annotations for the query
-        current_color only holds the mapping of the annotation that the mouse is hovering on
-        current_color is copied from color_allocation if mouse is not hovering over any annotation
+        List of (token ranges, highlight color) of each annotation, in the order of the table rows.
+        The query is laid out once; token_spans holds where each token ended up in the document,
+        and the highlights are extra selections over those spans, prepared once per annotation.
+        all_selections is shown when the mouse is not hovering over any annotation
         '''
-        self.color_allocation = {}
-        self.current_color = {}
+        self.color_allocation = []
+        self.token_spans = []
+        self.selections_by_row = []
+        self.all_selections = []
 
-        loadUi(os.path.join(os.path.dirname(__file__), 'QEPScreen.ui'),self)
+        load_ui('QEPScreen.ui', self)
 
-        # Initialise table, annotation and highlighter
-        self.table = TableWidget(len(self.annotated_dict), 1, self)
+        # Initialise table and highlighter, which are kept for every result shown on this screen
+        self.table = TableWidget(0, 1, self)
         self.table.move(440,120)
-        self.display_annotation()
-        self.backButton.clicked.connect(self.goto_query_screen)
         self.highlighter.setDocument(self.queryText.document())
+        self.queryText.setUndoRedoEnabled(False)  # otherwise every query laid out here is kept in its undo history
+        self.backButton.clicked.connect(self.goto_query_screen)
+
+        # Set up mouse tracking and onHover functions
+        self.table.setMouseTracking(True)
+        self.table.itemEntered.connect(self.handle_item_entered)
+        self.table.itemExited.connect(self.handle_item_exited)
+
+        self.show_annotations(annotations, tokenized_query)
+
+    def show_annotations(self, annotations: AnnotationIndex, tokenized_query: list):
+        '''
+        Shows the annotations of a query, replacing those shown before and reusing the same table and query text
+        '''
+        self.annotations = annotations
+        self.tokenized_query = tokenized_query
+        self.color_allocation = []
+        self.table.clearContents()
+        self.table.setRowCount(len(self.annotations) + 1 + (annotations.planning is not None))  # the last rows hold the cost and planning time
+        self.table.scrollToTop()
+        self.display_annotation()
+        if self.metrics is not None:
+            self.timingText.setText(self.metrics.summary())
         
-    # When user hovers over an item in the table
+    # When user hovers over an item in the table, only its spans are highlighted
     def handle_item_entered(self, item):
         index = item.row()
-        tuple_list = list(self.color_allocation.items())
-        if index < len(self.color_allocation):
-            key_value = tuple_list[index]
-            new_color = {}
-            new_color[key_value[0]] = key_value[1]
-            self.current_color = new_color.copy()
-            self.display_query()
+        if index < len(self.selections_by_row):
+            self.queryText.setExtraSelections(self.selections_by_row[index])
 
     # When user stops hovering over an item in the table
     def handle_item_exited(self, item):
         item.setBackground(QTableWidgetItem().background())
-        self.current_color = copy.deepcopy(self.color_allocation)
-        self.display_query()
+        self.queryText.setExtraSelections(self.all_selections)
 
     def goto_query_screen(self):
-        widgetStack.removeWidget(widgetStack.currentWidget())
+        # the screen is kept for the next result, so it is only taken off the stack
+        widgetStack.removeWidget(self)
 
     def display_query(self):
-
-        self.queryText.clear() #Clear previous query if any
-        ending_bracket_pos=[]
+        '''
+        Lays out the formatted query in queryText once, and records each token's (start, end) position in token_spans
+        Newline is performed when a keyword such as "SELECT", "WHERE", etc is read
+        Indenting for subplans is done by keeping track of indent_amount based on "(" and ")" tokens
+        After reaching a ")" token, there are three scenarios:
+                1) End of a subplan -> Newline after this token
+                2) End of a aggregation function -> Do not newline after this token
+                3) End of a VALUES function -> Do not newline after this token
+        For cases 2 and 3, right parenthesis' position is placed in ending_bracket_pos to indicate newline not needed
+        '''
+        ending_bracket_pos = set()
         indent_amount = 0
-        temp_string = ""
-        tokens_to_newline = ["select", "where", "from", "group", "order", "set", "values", "insert", "SELECT", "WHERE", "FROM", "GROUP", "ORDER", "SET", "VALUES", "INSERT"]
-        aggregation_keywords = ["count", "avg", "max", "min", "sum", "COUNT", "AVG", "MAX", "MIN", "SUM"]
-
-        for idx, value in enumerate(self.tokenized_query):
-
-            '''
-            === Step 1: Check if token needs to be highlighted by referencing current_color dictionary ===
-            Generates the corresponding HTML code based on whether token is highlighted
-            '''
-            # "&lt;" needs to be used for printing "<" in HTML
-            if value[1] == "<":
-                token_to_add = "<font>&lt;</font>"
-            else:
-                # Check if token needs to be highlighted
-                highlight = ""
-                
-                for key in self.current_color.keys():
-                    if isinstance(key, tuple):
-                        if value[0] in key:
-                            highlight = self.current_color[key]
+        tokens_to_newline = ["SELECT", "WHERE", "FROM", "GROUP", "ORDER", "SET", "VALUES", "INSERT"]
+        aggregation_keywords = ["COUNT", "AVG", "MAX", "MIN", "SUM"]
+
+        # === Step 1: split the tokens into lines of [indent, [token indexes]] ===
+        lines = []
+        line = [0, []]
+        for idx, token in enumerate(self.tokenized_query):
+            if token.upper in aggregation_keywords or token.upper == "VALUES":
+                if token.upper == "VALUES": # "VALUES" token should start after newline
+                    lines.append(line)
+                    line = [indent_amount, [idx]]
+                else: # Aggregation function do not need newline
+                    line[1].append(idx)
+                # find the bracket closing this function call
+                depth = 0
+                for i in range(idx+1, len(self.tokenized_query)):
+                    if self.tokenized_query[i].text == "(":
+                        depth += 1
+                    elif self.tokenized_query[i].text == ")":
+                        depth -= 1
+                        if depth <= 0:
+                            ending_bracket_pos.add(i)
                             break
-                    elif value[0] == key:
-                        highlight = self.current_color[key]
-                        break
 
-                if highlight != "":
-                    token_to_add = "<font style='background-color: " + highlight + "'>" + value[1] + "</font>"
-                else:
-                    token_to_add = "<font>" + value[1] + "</font>"
-
-            '''
-            === Step 2: Formatting and print of tokens to GUI ===
-            Newline is performed when a keyword such as "SELECT", "WHERE", etc is read
-            Indenting for subplans is done by keeping track of indent_amount based on "(" and ")" tokens
-            After reaching a ")" token, there are three scenarios:
-                    1) End of a subplan -> Newline after this token
-                    2) End of a aggregation function -> Do not newline after this token
-                    3) End of a VALUES function -> Do not newline after this token
-            For cases 2 and 3, right parenthesis' position is placed in ending_bracket_pos to indicate newline not needed
-            '''
-            if value[1] in aggregation_keywords or value[1] == "values" or value[1] == "VALUES":
-                if value[1] == "values" or value[1] == "VALUES": # "VALUES" token should start after newline
-                    self.queryText.appendHtml(temp_string)
-                    temp_string = "<font>" + indent_amount * "&nbsp;" + "</font>" + token_to_add + " "
-                else: # Aggregation function do not need newline
-                    temp_string += token_to_add + " "
-                i = 1
-                while True:
-                    if self.tokenized_query[idx+i][1] == ")":
-                        ending_bracket_pos.append(idx+i)
-                        break
-                    i += 1 
-
-            # Once a new keyword appears, print out previous tokens and start newline
-            elif value[1] in tokens_to_newline:
-                self.queryText.appendHtml(temp_string)
-                temp_string = "<font>" + indent_amount * "&nbsp;" + "</font>" + token_to_add + " "
-
-            elif value[1] == "(":
-                temp_string += token_to_add + " "
+            # Once a new keyword appears, start newline
+            elif token.upper in tokens_to_newline:
+                lines.append(line)
+                line = [indent_amount, [idx]]
+
+            elif token.text == "(":
+                line[1].append(idx)
                 indent_amount += 4
 
-            elif value[1] == ")":
+            elif token.text == ")":
                 indent_amount -= 4
-                if idx in ending_bracket_pos : # Closing bracket is from aggregate function, don't newline
-                    temp_string += token_to_add + " "
+                if idx in ending_bracket_pos: # Closing bracket is from aggregate function, don't newline
+                    line[1].append(idx)
                 else: # Closing bracket is from subplan, append after newline
-                    self.queryText.appendHtml(temp_string)
-                    temp_string = "<font>" + indent_amount * "&nbsp;" + "</font>" + token_to_add + " "
+                    lines.append(line)
+                    line = [max(indent_amount, 0), [idx]]
 
             else:
-                temp_string += token_to_add + " "
- 
-        # Print out last line of query
-        self.queryText.appendHtml(temp_string)
+                line[1].append(idx)
+        lines.append(line)
+
+        # === Step 2: build the text once, recording the position of every token ===
+        self.token_spans = [None] * len(self.tokenized_query)
+        parts = []
+        position = 0
+        for indent, token_indexes in lines:
+            if len(token_indexes) == 0:
+                continue
+            if len(parts) != 0:
+                parts.append("\n")
+                position += 1
+            parts.append(" " * indent)
+            position += indent
+            for n, idx in enumerate(token_indexes):
+                if n != 0:
+                    parts.append(" ")
+                    position += 1
+                text = self.tokenized_query[idx].text
+                self.token_spans[idx] = (position, position + len(text))
+                parts.append(text)
+                position += len(text)
+        self.queryText.setPlainText("".join(parts))
+
+    def make_selections(self, ranges, color):
+        '''
+        Creates the extra selections highlighting an annotation's token ranges, each a (start, end) pair with end exclusive
+        Each range is highlighted as one span, so the spaces between its tokens are highlighted too
+        '''
+        char_format = QTextCharFormat()
+        char_format.setBackground(QBrush(QColor(color)))
+        selections = []
+        for start, end in ranges:
+            if not 0 <= start < end <= len(self.token_spans) or self.token_spans[start] is None or self.token_spans[end-1] is None:
+                continue
+            selection = QtWidgets.QTextEdit.ExtraSelection()
+            selection.format = char_format
+            cursor = QTextCursor(self.queryText.document())
+            cursor.setPosition(self.token_spans[start][0])
+            cursor.setPosition(self.token_spans[end-1][1], QTextCursor.KeepAnchor)
+            selection.cursor = cursor
+            selections.append(selection)
+        return selections
 
     # Displays annotation in the table widget, and setting up on colors for each annotation
     def display_annotation(self):
 
         color_array= ["#63FF00", "#BD9FDF", "#FFFF00", "#E3630E" ,"#59F0FF", "#12EC83", "#FAC541", "#FC4260", "#E08D94", "#4C49D6", "#EB33FF"]
-        counter = 0
-        array_index = 0
-
-        # Iterate through annotations, set the colors for each annotation, and add to table
-        for key, value in self.annotated_dict.items():
-
-            '''
-            If an alias is to be highlighted, a check is performed to see if there is the alias is given by the user or by the DBMS
-            If the alias is given by the user, then the name of the relation before it should be highlighted too
-            If an aggregation is to be highlighted, the entire aggregation function should be highlighted (until the right parenthesis)
-            '''
-            if (key != "alias"):
-                if (key != "cost"):
-                    if ("alias" in value): # Check if alias is generated by user or by Postgres
-                        if self.tokenized_query[key][1] in self.annotated_dict["alias"].keys(): # Alias from user, highlight token before this
-                            self.color_allocation[(key - 1, key)] = color_array[array_index]
-                        else: # Alias from Postgres, just highlight current token only
-                            self.color_allocation[key] = color_array[array_index]
-                    elif ("aggregation" in value): # Highlight entire aggregation
-                        self.color_allocation[(key, key+1, key+2, key+3)] = color_array[array_index]
-                    else: # Highlight token as per normal
-                        self.color_allocation[key] = color_array[array_index]
-
-                    item = QTableWidgetItem("-> " + value)
-                    item.setForeground(QBrush(QColor(color_array[array_index])))
-                    self.table.setItem(counter, 0, item)
-                    array_index += 1
-                else:
-                    item = QTableWidgetItem(value)
-                    item.setForeground(QBrush(QColor("#FFFFFF")))
-                    self.table.setItem(counter, 0, item)
-
-            counter += 1
-            if array_index == len(color_array):
-                array_index = 0
 
-        # Set up mouse tracking and onHover functions
-        self.current_color = copy.deepcopy(self.color_allocation)
-        self.table.setMouseTracking(True)
-        self.table.itemEntered.connect(self.handle_item_entered)
-        self.table.itemExited.connect(self.handle_item_exited)
-        self.display_query()
+        # Add the annotations to the table in query order, each with its color, followed by the cost and planning time of the plan
+        for row, annotation in enumerate(self.annotations):
+            color = color_array[row % len(color_array)]
+            if annotation.category == SUBPLAN:  # only the brackets around the subquery are highlighted
+                ranges = [(annotation.token_start, annotation.token_start + 1), (annotation.token_end - 1, annotation.token_end)]
+            else:
+                ranges = [(annotation.token_start, annotation.token_end)]
+            self.color_allocation.append((ranges, color))
+
+            item = QTableWidgetItem("-> " + annotation.text)
+            item.setForeground(QBrush(QColor(color)))
+            self.table.setItem(row, 0, item)
+
+        item = QTableWidgetItem(self.annotations.cost)
+        item.setForeground(QBrush(QColor("#FFFFFF")))
+        self.table.setItem(len(self.annotations), 0, item)
+        if self.annotations.planning is not None:
+            item = QTableWidgetItem(self.annotations.planning)
+            item.setForeground(QBrush(QColor("#FFFFFF")))
+            self.table.setItem(len(self.annotations) + 1, 0, item)
+
+        # Lay the query out once, and prepare the highlights of each annotation
+        with timed(self.metrics, "display"):
+            self.display_query()
+            self.selections_by_row = [self.make_selections(ranges, color) for ranges, color in self.color_allocation]
+            self.all_selections = [selection for selections in self.selections_by_row for selection in selections]
+            self.queryText.setExtraSelections(self.all_selections)
 
 class GUI():
-    
-    #Initialise with WelcomeScreen and set width/height
-    welcome = WelcomeScreen()
-    widgetStack.setWindowTitle("SQL Query Annotator")
-    widgetStack.addWidget(welcome)
-    widgetStack.setFixedHeight(550)
-    widgetStack.setFixedWidth(850)
-    widgetStack.show()
 
-    try:
-        sys.exit(app.exec_())
-    except:
-        print("Exiting")
\ No newline at end of file
+    def __init__(self):
+        #Initialise with WelcomeScreen and set width/height
+        application()
+        self.welcome = WelcomeScreen()
+        widgetStack.setWindowTitle("SQL Query Annotator")
+        widgetStack.addWidget(self.welcome)
+        widgetStack.setFixedHeight(550)
+        widgetStack.setFixedWidth(850)
+
+    def run(self):
+        # Shows the GUI and runs the event loop until the window is closed
+        widgetStack.show()
+        try:
+            exit_code = app.exec_()
+            self.welcome.close_session()
+            sys.exit(exit_code)
+        except:
+            print("Exiting")
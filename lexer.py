@@ -0,0 +1,178 @@
+import re
+
+# kinds of tokens produced by tokenize
+WORD = "word"                  # keyword or (possibly qualified/quoted) identifier, e.g. SELECT, c.c_custkey, "My Table".id
+STRING = "string"              # 'text', E'text', $$text$$, $tag$text$tag$
+NUMBER = "number"
+PARAMETER = "parameter"        # $1
+OPERATOR = "operator"          # =, <>, ||, ...
+PUNCTUATION = "punctuation"    # ( ) , ; [ ] . : ::
+COMMENT = "comment"            # only returned with keep_comments=True
+OTHER = "other"                # any character Postgres would reject
+
+_IDENTIFIER = r'(?:[A-Za-z_\u0080-\uffff][\w$]*|"[^"]*(?:""[^"]*)*")'
+TOKEN_PATTERN = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<line_comment>--[^\n]*)
+  | (?P<block_comment>/\*)
+  | (?P<dollar>\$(?:[A-Za-z_\u0080-\uffff][\w]*)?\$)
+  | (?P<escape_string>[Ee]'[^'\\]*(?:(?:\\.|'')[^'\\]*)*')
+  | (?P<string>(?:[BbXxNn]|[Uu]&)?'[^']*(?:''[^']*)*')
+  | (?P<word>""" + _IDENTIFIER + r"""(?:\.(?:""" + _IDENTIFIER + r"""|\*))*)
+  | (?P<number>(?:\d+(?:\.\d*)?|\.\d+)(?:[Ee][+-]?\d+)?)
+  | (?P<parameter>\$\d+)
+  | (?P<punctuation>::|[(),;\[\]:.])
+  | (?P<operator>[+\-*/<>=~!@\#%^&|`?]+)
+""", re.VERBOSE | re.DOTALL)
+
+_KINDS = {
+    "escape_string": STRING, "string": STRING, "word": WORD, "number": NUMBER,
+    "parameter": PARAMETER, "punctuation": PUNCTUATION, "line_comment": COMMENT,
+}
+
+# class for the errors raised on text that cannot be split into tokens, e.g. an unterminated string or comment:
+class LexerError(Exception):
+    pass
+
+# class to hold one lexical token of a query:
+class Token:
+    __slots__ = ("kind", "start", "end", "text", "upper")
+
+    def __init__(self, kind, start, end, text):
+        self.kind = kind
+        self.start = start  # offset of the first character in the query
+        self.end = end  # offset after the last character
+        self.text = text
+        self.upper = text.upper()  # computed once, keyword checks compare against this
+
+    def __repr__(self):
+        return f"Token({self.kind!r}, {self.start}, {self.end}, {self.text!r})"
+
+
+def _operator_length(text):
+    '''
+    Length of the operator at the start of text, following Postgres' rules:
+    "--" and "/*" start a comment, and a multi-character operator cannot end in + or -
+    unless it contains one of ~ ! @ # % ^ & | ` ?
+    '''
+    length = len(text)
+    for comment in ("--", "/*"):
+        found = text.find(comment)
+        if found != -1:
+            length = min(length, found)
+    if not any(char in "~!@#%^&|`?" for char in text[:length]):
+        while length > 1 and text[length-1] in "+-":
+            length -= 1
+    return length
+
+
+def _block_comment_end(query, pos):
+    '''
+    :returns: offset after the (possibly nested) block comment starting at pos
+    '''
+    depth = 0
+    i = pos
+    while True:
+        opening = query.find("/*", i)
+        closing = query.find("*/", i)
+        if closing == -1:
+            raise LexerError(f"Unterminated comment starting at offset {pos}")
+        if opening != -1 and opening < closing:
+            depth += 1
+            i = opening + 2
+        else:
+            depth -= 1
+            i = closing + 2
+            if depth == 0:
+                return i
+
+
+def tokenize(query, keep_comments=False):
+    '''
+    Splits a query into tokens in a single pass, keeping each token's offsets into the query
+    :param keep_comments: if True, comments are returned as COMMENT tokens instead of being skipped
+    :returns: list of Token
+    :raises LexerError: on an unterminated quoted string, dollar-quoted string or block comment
+    '''
+    tokens = []
+    pos = 0
+    length = len(query)
+    match_at = TOKEN_PATTERN.match
+    while pos < length:
+        match = match_at(query, pos)
+        if match is None:
+            if query[pos] in "'\"":
+                raise LexerError(f"Unterminated quoted string starting at offset {pos}")
+            tokens.append(Token(OTHER, pos, pos + 1, query[pos]))
+            pos += 1
+            continue
+
+        group = match.lastgroup
+        end = match.end()
+        if group == "space":
+            pos = end
+            continue
+        if group == "block_comment":
+            end = _block_comment_end(query, pos)
+            if keep_comments:
+                tokens.append(Token(COMMENT, pos, end, query[pos:end]))
+            pos = end
+            continue
+        if group == "dollar":  # $tag$ ... $tag$, the body is taken verbatim
+            closing = query.find(match.group(0), end)
+            if closing == -1:
+                raise LexerError(f"Unterminated dollar-quoted string starting at offset {pos}")
+            end = closing + len(match.group(0))
+            tokens.append(Token(STRING, pos, end, query[pos:end]))
+        elif group == "operator":
+            end = pos + _operator_length(match.group(0))
+            tokens.append(Token(OPERATOR, pos, end, query[pos:end]))
+        elif group != "line_comment" or keep_comments:
+            tokens.append(Token(_KINDS[group], pos, end, match.group(0)))
+        pos = end
+    return tokens
+
+
+def split_statements(query):
+    '''
+    Splits a script into statements on the semicolons outside quotes, comments and dollar-quoted bodies
+    :returns: list of (offset, statement) where offset is the position of the statement in query
+    :raises LexerError: as tokenize
+    '''
+    statements = []
+    first = None
+    last = None
+    for token in tokenize(query):
+        if token.kind == PUNCTUATION and token.text == ";":
+            if first is not None:
+                statements.append((first.start, query[first.start:last.end]))
+            first = None
+        else:
+            if first is None:
+                first = token
+            last = token
+    if first is not None:
+        statements.append((first.start, query[first.start:last.end]))
+    return statements
+
+
+# words in conditions that are never columns
+CONDITION_KEYWORDS = {"AND", "OR", "NOT", "IS", "NULL", "TRUE", "FALSE", "ANY", "ALL", "IN", "LIKE", "ILIKE", "BETWEEN", "DESC", "ASC", "NULLS", "FIRST", "LAST"}
+
+def column_references(expression):
+    '''
+    Finds the column references in a condition or sort key, e.g. "((c.c_custkey = 5) AND (c_name ~~ 'a%'::text))"
+    :returns: list of (qualifier or None, column), in the order they appear
+    '''
+    tokens = tokenize(expression)
+    references = []
+    for i, token in enumerate(tokens):
+        if token.kind != WORD or token.upper in CONDITION_KEYWORDS:
+            continue
+        if i + 1 < len(tokens) and tokens[i+1].text == "(":  # function call
+            continue
+        if i > 0 and tokens[i-1].text == "::":  # type cast
+            continue
+        parts = [part.strip('"') for part in token.text.rsplit(".", 1)]
+        references.append((parts[0], parts[1]) if len(parts) == 2 else (None, parts[0]))
+    return references
@@ -0,0 +1,143 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+
+# stages of the annotation pipeline, in the order they run for a query
+STAGES = ("connection", "explain", "decode", "tokenize", "generate", "attach", "display")
+
+# upper bounds, in seconds, of the latency buckets exported to Prometheus
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+PROMETHEUS_PREFIX = "sql_annotator"
+
+def timed(metrics, stage):
+    '''
+    :returns: context manager timing stage with metrics, or doing nothing if metrics is None
+    '''
+    if metrics is None:
+        return nullcontext()
+    return metrics.timer(stage)
+
+# class to collect how long each stage of the pipeline takes, and how often things happen:
+class Metrics:
+
+    def __init__(self, buckets=BUCKETS):
+        '''
+        Thread-safe timers (one per stage) and counters
+        :param buckets: upper bounds in seconds of the latency histogram of each stage
+        '''
+        self.buckets = tuple(buckets)
+        self._stages = {}  # {stage: [count, total seconds, max seconds, [count per bucket]]}
+        self._counters = {}
+        self._hooks = []
+        self._lock = threading.Lock()
+        self.last = {}  # {stage: seconds} of the latest run of each stage
+
+    def add_hook(self, hook):
+        '''
+        :param hook: called as hook(stage, seconds) after every timed stage, on the thread that ran it
+        '''
+        with self._lock:
+            self._hooks = self._hooks + [hook]
+
+    def remove_hook(self, hook):
+        with self._lock:
+            self._hooks = [h for h in self._hooks if h is not hook]
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def observe(self, stage, seconds):
+        '''
+        Records one run of stage that took seconds
+        '''
+        with self._lock:
+            timings = self._stages.get(stage)
+            if timings is None:
+                timings = self._stages[stage] = [0, 0.0, 0.0, [0] * len(self.buckets)]
+            timings[0] += 1
+            timings[1] += seconds
+            timings[2] = max(timings[2], seconds)
+            bucket = bisect_left(self.buckets, seconds)
+            if bucket < len(self.buckets):
+                timings[3][bucket] += 1
+            self.last[stage] = seconds
+            hooks = self._hooks
+        for hook in hooks:
+            hook(stage, seconds)
+
+    def increment(self, counter, value=1):
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + value
+
+    def snapshot(self):
+        '''
+        :returns: {"time", "stages": {stage: {"count", "total", "mean", "max", "buckets"}}, "counters"}, with times in seconds
+        and buckets as cumulative counts per upper bound (as in Prometheus histograms)
+        '''
+        with self._lock:
+            stages = {}
+            for stage, (count, total, longest, buckets) in self._stages.items():
+                cumulative = []
+                running = 0
+                for bound, bucket in zip(self.buckets, buckets):
+                    running += bucket
+                    cumulative.append([bound, running])
+                stages[stage] = {"count": count, "total": total, "mean": total / count, "max": longest, "buckets": cumulative}
+            return {"time": time.time(), "stages": stages, "counters": dict(self._counters)}
+
+    def summary(self):
+        '''
+        :returns: one line with the latest time of each stage, e.g. "explain 12.1 ms, decode 0.3 ms, ..."
+        '''
+        with self._lock:
+            last = dict(self.last)
+        ordered = [stage for stage in STAGES if stage in last] + sorted(stage for stage in last if stage not in STAGES)
+        return ", ".join(f"{stage} {last[stage] * 1000:.1f} ms" for stage in ordered)
+
+    def write_jsonl(self, path):
+        '''
+        Appends the current snapshot to path as one JSON line
+        '''
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(self.snapshot()) + "\n")
+
+    def write_prometheus(self, path):
+        '''
+        Writes the current snapshot to path in the Prometheus text format (e.g. for node_exporter's textfile collector).
+        The file is replaced at once, so a scrape never sees half of it
+        '''
+        snapshot = self.snapshot()
+        name = PROMETHEUS_PREFIX + "_stage_seconds"
+        lines = [f"# HELP {name} Time spent in each stage of the annotation pipeline.", f"# TYPE {name} histogram"]
+        for stage, timings in sorted(snapshot["stages"].items()):
+            for bound, count in timings["buckets"]:
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {count}')
+            lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {timings["count"]}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {timings["total"]}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {timings["count"]}')
+        for counter, value in sorted(snapshot["counters"].items()):
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{counter}_total counter")
+            lines.append(f"{PROMETHEUS_PREFIX}_{counter}_total {value}")
+
+        temporary = path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temporary, path)
+
+    def write(self, path):
+        '''
+        Exports to path in the Prometheus text format if it ends with ".prom", as JSON lines otherwise
+        '''
+        if path.endswith(".prom"):
+            self.write_prometheus(path)
+        else:
+            self.write_jsonl(path)
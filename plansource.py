@@ -0,0 +1,182 @@
+import json
+import mmap
+import os
+import threading
+
+import plantree
+from cache import PlanCache
+from history import plan_digest
+from lexer import split_statements
+from metrics import timed
+from preprocessing import check_single_query, fingerprint_query, tokenize_query
+
+'''
+Plan sources other than a live database, for annotating without Postgres (e.g. on CI machines):
+RecordingSource saves the plans a QueryProcessor retrieves to a fixture directory, and ReplaySource serves them from it.
+
+A fixture directory holds plans.jsonl, one {"key", "query", "plan"} object per line, and index.jsonl,
+one [key, offset, length, digest] line per plan locating it in plans.jsonl, with the plan's history.plan_digest
+(older fixtures have no digest). The key is the query's fingerprint (prefixed with "ANALYZE " for EXPLAIN ANALYZE plans);
+when a key is recorded again with another plan, the last plan wins.
+'''
+
+PLANS_FILE = "plans.jsonl"
+INDEX_FILE = "index.jsonl"
+
+def plan_key(query, analyze=False):
+    return ("ANALYZE " if analyze else "") + fingerprint_query(query)
+
+# class to save every plan retrieved by a QueryProcessor to a fixture directory:
+class RecordingSource:
+
+    def __init__(self, processor, directory):
+        '''
+        :param processor: QueryProcessor the plans are retrieved with
+        :param directory: fixture directory, created if needed; plans are added to the ones already in it
+        '''
+        self.processor = processor
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._digests = {}  # {key: digest of the plan recorded last}, so a plan retrieved again is not written twice
+        if os.path.exists(os.path.join(directory, INDEX_FILE)):
+            with open(os.path.join(directory, INDEX_FILE), encoding="utf-8") as f:
+                for line in f:
+                    entry = json.loads(line)
+                    self._digests[entry[0]] = entry[3] if len(entry) > 3 else None
+        self._plans = open(os.path.join(directory, PLANS_FILE), "ab")
+        self._index = open(os.path.join(directory, INDEX_FILE), "a", encoding="utf-8")
+
+    def __getattr__(self, name):  # everything else (plan_cache, execute, explain, ...) is the processor's
+        return getattr(self.processor, name)
+
+    def record(self, query, query_plan, analyze=False):
+        '''
+        Saves the plan of query, unless the same plan (see history.plan_digest: planning times and run-time figures aside)
+        is already recorded for it. Changes from a PlanHistory ("Plan Changes") and the plan-cache mark ("From Cache") are left out,
+        as they only held for the run that found them
+        '''
+        key = plan_key(query, analyze)
+        if "Plan Changes" in query_plan or "From Cache" in query_plan:
+            query_plan = plantree.PlanNode({field: value for field, value in query_plan.items() if field not in ("Plan Changes", "From Cache")})
+        digest = plan_digest(query_plan)
+        if self._digests.get(key) == digest:  # checked again below, once the line is encoded
+            return
+        line = (plantree.dumps({"key": key, "query": query})[:-1] + ', "plan": ' + plantree.dumps(query_plan) + "}\n").encode("utf-8")
+        with self._lock:
+            if self._digests.get(key) == digest:
+                return
+            self._digests[key] = digest
+            offset = self._plans.tell()
+            self._plans.write(line)
+            self._plans.flush()  # written before it is indexed
+            self._index.write(json.dumps([key, offset, len(line), digest]) + "\n")
+            self._index.flush()
+
+    def process_query(self, query, cancellation=None, timeout=None, analyze=False, settings=None):
+        query_plan = self.processor.process_query(query, cancellation=cancellation, timeout=timeout, analyze=analyze, settings=settings)
+        if not settings:  # only the plans the query normally gets are recorded
+            self.record(query, query_plan, analyze)
+        return query_plan
+
+    def process_script(self, script, cancellation=None, timeout=None, run_statements=False):
+        records = self.processor.process_script(script, cancellation=cancellation, timeout=timeout, run_statements=run_statements)
+        for record in records:
+            if record.get("plan") is not None:
+                self.record(record["query"], record["plan"])
+        return records
+
+    def close(self):
+        with self._lock:
+            self._plans.close()
+            self._index.close()
+        self.processor.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# class to serve recorded plans in place of a QueryProcessor, without a database:
+class ReplaySource:
+
+    def __init__(self, directory, cache_size=256, metrics=None):
+        '''
+        Only the index is read up front; plans.jsonl is memory-mapped and each plan is decoded when it is first asked for
+        :param cache_size: maximum number of decoded plans kept
+        :param metrics: optional metrics.Metrics timing the decode and tokenize stages
+        '''
+        self.directory = directory
+        self.metrics = metrics
+        self.plan_cache = PlanCache(cache_size)
+        self._offsets = {}  # {key: (offset, length)}
+        with open(os.path.join(directory, INDEX_FILE), encoding="utf-8") as f:
+            for line in f:
+                key, offset, length = json.loads(line)[:3]
+                self._offsets[key] = (offset, length)
+        self._file = open(os.path.join(directory, PLANS_FILE), "rb")
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(self._file.fileno()).st_size else b""
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def _entry(self, key):
+        offset, length = self._offsets[key]
+        with timed(self.metrics, "decode"):
+            return plantree.loads(self._data[offset:offset + length])
+
+    def recorded(self):
+        '''
+        Yields (query, plan) for every recorded plan, decoding them one at a time
+        '''
+        for key in self._offsets:
+            entry = self._entry(key)
+            yield entry["query"], entry["plan"]
+
+    def process_query(self, query, cancellation=None, timeout=None, analyze=False, settings=None):
+        '''
+        :returns: the plan recorded for the query, as QueryProcessor.process_query would return it
+        '''
+        if settings:
+            raise Exception("Recorded plans cannot be planned again under other settings")
+        check_single_query(query)
+        if self.metrics is not None:
+            self.metrics.increment("queries")
+        key = plan_key(query, analyze)
+        query_plan = self.plan_cache.get(key)
+        if query_plan is None:
+            if key not in self._offsets:
+                raise Exception("No plan was recorded for this query")
+            query_plan = self._entry(key)["plan"]
+            self.plan_cache.put(key, query_plan)
+        return query_plan
+
+    def process_script(self, script, cancellation=None, timeout=None, run_statements=False):
+        '''
+        :returns: the recorded plans of the script's statements, as QueryProcessor.process_script would return them
+        '''
+        records = []
+        for offset, statement in split_statements(script):
+            record = {"offset": offset, "query": statement}
+            try:
+                record["plan"] = self.process_query(statement)
+            except Exception as e:
+                record["error"] = str(e)
+            records.append(record)
+        return records
+
+    def tokenize_query(self, query):
+        with timed(self.metrics, "tokenize"):
+            return tokenize_query(query)
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
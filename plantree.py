@@ -0,0 +1,255 @@
+import json
+import sys
+import threading
+from collections.abc import Mapping
+
+'''
+Compact representation of EXPLAIN (FORMAT JSON) plans. Each plan node is a PlanNode holding only a tuple of its
+values; the names of its fields, where each one is, and which of them are conditions are kept in a Layout shared by
+every node listing the same fields in the same order (as all scans of a partitioned table do).
+Node types are interned. The fields the annotator reads are attributes (node.node_type, node.filter, ...),
+and PlanNode can also be read like the dict it was decoded from (plan["Node Type"], plan.get("Plans", []),
+"Filter" in plan, ...), so code walking plans works on both.
+
+Plans are converted lazily: loads only decodes the JSON (without a Python call per object) and wraps the top node,
+and the inputs of a node stay decoded JSON until they are first read, when they are converted and the dicts dropped.
+Code that only reads the top of a plan (e.g. its "Total Cost") never pays for converting the rest.
+'''
+
+# {EXPLAIN field: attribute} of the fields read while annotating
+FIELDS = {
+    "Node Type": "node_type",
+    "Relation Name": "relation_name",
+    "Alias": "alias",
+    "Subplan Name": "subplan_name",
+    "One-Time Filter": "one_time_filter",
+    "Filter": "filter",
+    "Sort Key": "sort_key",
+    "Strategy": "strategy",
+    "Total Cost": "total_cost",
+    "Plan Rows": "plan_rows",
+    "Plans": "plans",
+}
+
+_LAYOUTS = {}  # {field names: Layout}
+MAX_LAYOUTS = 4096  # beyond this many distinct field lists, new layouts are not kept for sharing
+
+_CONVERT_LOCK = threading.Lock()  # plans are shared between threads (e.g. through the plan cache); inputs are converted once
+
+def is_condition(key):
+    '''
+    :returns: whether the field is a condition, e.g. "Hash Cond", "Index Cond" or "Join Filter"
+    '''
+    return "cond" in key.lower() or key == "Join Filter"
+
+# class for the field names shared by plan nodes:
+class Layout:
+
+    __slots__ = ("keys", "positions", "conditions", "node_type", "plans")
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.positions = {key: i for i, key in enumerate(keys)}
+        self.conditions = tuple(i for i, key in enumerate(keys) if is_condition(key))  # in the order EXPLAIN lists them
+        self.node_type = self.positions.get("Node Type")
+        self.plans = self.positions.get("Plans")
+
+def layout_of(keys):
+    layout = _LAYOUTS.get(keys)
+    if layout is None:
+        layout = Layout(keys)
+        if len(_LAYOUTS) < MAX_LAYOUTS:
+            _LAYOUTS[keys] = layout
+    return layout
+
+def _field(key):
+    def get(self):
+        i = self._layout.positions.get(key)
+        return None if i is None else self._values[i]
+    get.__doc__ = f'the "{key}" field, None if the node has none'
+    return property(get)
+
+# class for one node of a query plan:
+class PlanNode(Mapping):
+
+    __slots__ = ("_layout", "_values")
+
+    def __init__(self, data):
+        '''
+        :param data: dict of the node's fields, in the order EXPLAIN lists them, with its inputs under "Plans"
+        as PlanNodes or as dicts (converted when they are first read)
+        '''
+        self._layout = layout = layout_of(tuple(data))
+        values = tuple(data.values())
+        i = layout.node_type
+        if i is not None and isinstance(values[i], str):
+            values = values[:i] + (sys.intern(values[i]),) + values[i+1:]
+        i = layout.plans
+        if i is not None and values[i].__class__ is tuple and not all(isinstance(child, PlanNode) for child in values[i]):
+            values = values[:i] + (list(values[i]),) + values[i+1:]  # converted by children
+        self._values = values
+
+    node_type = _field("Node Type")
+    relation_name = _field("Relation Name")
+    alias = _field("Alias")
+    subplan_name = _field("Subplan Name")
+    one_time_filter = _field("One-Time Filter")
+    filter = _field("Filter")
+    sort_key = _field("Sort Key")
+    strategy = _field("Strategy")
+    total_cost = _field("Total Cost")
+    plan_rows = _field("Plan Rows")
+
+    @property
+    def children(self):
+        '''
+        the inputs of the node as a tuple of PlanNodes, converted from the decoded JSON the first time they are read
+        '''
+        i = self._layout.plans
+        if i is None:
+            return ()
+        children = self._values[i]
+        if children.__class__ is tuple:
+            return children
+        with _CONVERT_LOCK:
+            children = self._values[i]
+            if children.__class__ is not tuple:
+                children = tuple(child if isinstance(child, PlanNode) else PlanNode(child) for child in children)
+                values = self._values
+                self._values = values[:i] + (children,) + values[i+1:]
+            return children
+
+    plans = children
+
+    @property
+    def conditions(self):
+        '''
+        :returns: (field, condition) pairs of the node's conditions (see is_condition), in the order EXPLAIN lists them
+        '''
+        keys = self._layout.keys
+        return tuple((keys[i], self._values[i]) for i in self._layout.conditions)
+
+    def walk(self):
+        '''
+        Yields this node and every node below it in pre-order, without recursion
+        '''
+        stack = [self]
+        while len(stack) != 0:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(node.children))
+
+    def index(self):
+        '''
+        Numbers the nodes of the plan in pre-order, as the ids of Annotation.nodes do.
+        Nodes do not point back to their parent (so a plan holds no reference cycles); this maps them instead
+        :returns: (nodes, parents): the nodes in pre-order, and the position of each node's parent in nodes (-1 for this node)
+        '''
+        nodes = []
+        parents = []
+        stack = [(self, -1)]
+        while len(stack) != 0:
+            node, parent = stack.pop()
+            position = len(nodes)
+            nodes.append(node)
+            parents.append(parent)
+            stack.extend((child, position) for child in reversed(node.children))
+        return nodes, parents
+
+    def get(self, key, default=None):
+        i = self._layout.positions.get(key)
+        if i is None:
+            return default
+        return self.children if i == self._layout.plans else self._values[i]
+
+    def __getitem__(self, key):
+        i = self._layout.positions.get(key)
+        if i is None:
+            raise KeyError(key)
+        return self.children if i == self._layout.plans else self._values[i]
+
+    def __contains__(self, key):
+        return key in self._layout.positions
+
+    def __iter__(self):
+        return iter(self._layout.keys)
+
+    def __len__(self):
+        return len(self._layout.keys)
+
+    def __setitem__(self, key, value):
+        '''
+        Sets a field, e.g. the top-level EXPLAIN fields ("Planning Time", ...) added to the plan by preprocessing.plan_from_result
+        '''
+        data = self.to_dict()
+        data[key] = value
+        PlanNode.__init__(self, data)
+
+    def __repr__(self):
+        return f"PlanNode({self.node_type!r}, {len(self.children)} input(s))"
+
+    def copy(self):
+        '''
+        :returns: a shallow copy, sharing the inputs of this node
+        '''
+        self.children  # converted first, so both nodes share the same PlanNodes below them
+        node = PlanNode.__new__(PlanNode)
+        node._layout = self._layout
+        node._values = self._values
+        return node
+
+    def to_dict(self):
+        '''
+        :returns: the node as a dict, with its inputs still as PlanNodes under "Plans"
+        '''
+        data = dict(zip(self._layout.keys, self._values))
+        if self._layout.plans is not None:
+            data["Plans"] = self.children
+        return data
+
+def wrap(value):
+    '''
+    Turns the plan nodes (objects with a "Node Type") among decoded JSON into PlanNodes, without descending into them:
+    their inputs are converted when they are first read (see PlanNode.children)
+    '''
+    if isinstance(value, dict):
+        if "Node Type" in value:
+            return PlanNode(value)
+        for key, item in value.items():
+            if isinstance(item, (dict, list)):
+                value[key] = wrap(item)
+    elif isinstance(value, list):
+        for i, item in enumerate(value):
+            if isinstance(item, (dict, list)):
+                value[i] = wrap(item)
+    return value
+
+def loads(text):
+    '''
+    Decodes JSON text (e.g. the output of EXPLAIN (FORMAT JSON)) with the plain json decoder, then wraps its plan nodes
+    as PlanNodes (see wrap); the nodes below them are converted as they are reached
+    '''
+    return wrap(json.loads(text))
+
+def encode(value):
+    '''
+    json default function encoding PlanNodes as objects
+    '''
+    if isinstance(value, PlanNode):
+        return value.to_dict()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def dumps(value, **kwargs):
+    '''
+    Encodes JSON text like json.dumps, with PlanNodes as objects
+    '''
+    return json.dumps(value, default=encode, **kwargs)
+
+def as_plan(plan):
+    '''
+    :returns: plan as a PlanNode; plans decoded by loads are returned as they are, while plans held as nested dicts
+    (e.g. built by hand) are wrapped, their inputs being converted as they are reached
+    '''
+    if isinstance(plan, PlanNode):
+        return plan
+    return PlanNode(plan)
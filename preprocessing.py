@@ -1,40 +1,467 @@
+import re
+import threading
+import time
+from contextlib import contextmanager
+
 import psycopg2
+import psycopg2.extensions
+from psycopg2.pool import ThreadedConnectionPool
+
+import lexer
+import plantree
+from cache import PlanCache
+from metrics import timed
+
+# cheap summary of the catalog and statistics; changes after DDL (pg_class rows are added/updated) or ANALYZE
+STATISTICS_VERSION_QUERY = """
+SELECT (SELECT count(*) FROM pg_class),
+       (SELECT max(xmin::text::bigint) FROM pg_class),
+       (SELECT sum(reltuples)::float8 FROM pg_class),
+       (SELECT sum(analyze_count + autoanalyze_count) FROM pg_stat_user_tables),
+       (SELECT max(greatest(last_analyze, last_autoanalyze))::text FROM pg_stat_user_tables)
+"""
+
+# hands json values (e.g. EXPLAIN's output) over as text, so they are decoded separately from the round trip, into plantree.PlanNodes
+JSON_TEXT = psycopg2.extensions.new_type((114,), "JSON_TEXT", lambda value, cur: value)
+
+# options of every EXPLAIN that only plans the query: SUMMARY adds the planning time, and BUFFERS the buffer usage during planning
+EXPLAIN_OPTIONS = "SUMMARY, BUFFERS, FORMAT JSON"
+
+# lists of constants, e.g. "IN ( ? , ? , ? )" once literals are stripped
+CONSTANT_LIST = re.compile(r"(\bIN \( |\bARRAY \[ )\?(?: , \?)*( \)| \])")
+
+def fingerprint_query(query, strip_literals=False):
+    '''
+    Normalizes a query so that texts differing only in whitespace, comments, keyword/identifier case
+    or a trailing semicolon share one fingerprint. Literals are kept, since they appear in the plan's filters,
+    and so are planner hints (/*+ ... */ comments, as read by pg_hint_plan), since they change the plan.
+    :param strip_literals: replace literals and $n parameters (with their sign) with "?" and collapse IN lists to one item,
+    so that queries differing only in their values (e.g. in logs) share one fingerprint
+    '''
+    words = []
+    previous = [None, None]  # the two tokens before this one, comments aside
+    for token in lexer.tokenize(query, keep_comments=True):
+        if token.kind == lexer.COMMENT:
+            if token.text.startswith("/*+"):
+                words.append(token.text)
+            continue
+        if token.kind == lexer.PUNCTUATION and token.text == ";":
+            continue
+        if strip_literals and token.kind in (lexer.STRING, lexer.NUMBER, lexer.PARAMETER):
+            sign, before = previous[-1], previous[-2]
+            if (sign is not None and sign.kind == lexer.OPERATOR and sign.text in ("-", "+") and words[-1] == sign.upper
+                    and (before is None or before.kind == lexer.OPERATOR or (before.kind == lexer.PUNCTUATION and before.text not in ")]"))):
+                words.pop()  # a unary sign, e.g. in IN (-1, 2): part of the literal
+            words.append("?")
+        elif token.kind == lexer.STRING or '"' in token.text:
+            words.append(token.text)
+        else:
+            words.append(token.upper)
+        previous = [previous[-1], token]
+    fingerprint = " ".join(words)
+    if strip_literals:
+        fingerprint = CONSTANT_LIST.sub(r"\1?\2", fingerprint)
+    return fingerprint
+
+def count_parameters(query):
+    '''
+    :returns: the highest $n parameter number in the query, 0 if it has none
+    '''
+    return max((int(token.text[1:]) for token in lexer.tokenize(query) if token.kind == lexer.PARAMETER), default=0)
+
+# plpgsql function explaining one statement of a script (with EXPLAIN_OPTIONS); errors are returned instead of aborting the whole script
+EXPLAIN_FUNCTION = f"""
+CREATE FUNCTION pg_temp.explain_json(statement text, run_statement boolean) RETURNS json AS $explain$
+DECLARE
+    plan json;
+BEGIN
+    BEGIN
+        EXECUTE 'EXPLAIN ({EXPLAIN_OPTIONS}) ' || statement INTO plan;
+        RETURN plan;
+    EXCEPTION
+        WHEN syntax_error THEN  -- not explainable, e.g. DDL
+            IF NOT run_statement THEN
+                RETURN json_build_object('error', SQLERRM);
+            END IF;
+        WHEN OTHERS THEN
+            RETURN json_build_object('error', SQLERRM);
+    END;
+    BEGIN
+        EXECUTE statement;  -- so the statements after it see its effects
+        RETURN NULL;
+    EXCEPTION
+        WHEN OTHERS THEN
+            RETURN json_build_object('error', SQLERRM);
+    END;
+END
+$explain$ LANGUAGE plpgsql
+"""
+
+def check_single_query(query):
+    '''
+    Raises an exception if more than one query is written. Semicolons in strings and comments are not counted.
+    '''
+    if len(lexer.split_statements(query)) > 1:
+        raise Exception("More than one query is written (max one allowed)")
+
+def plan_from_result(result):
+    '''
+    :param result: one element of the JSON output of EXPLAIN, as decoded by plantree.loads
+    :returns: the plan, with the top-level EXPLAIN fields (e.g. "Execution Time") added to it
+    '''
+    query_plan = result["Plan"].copy()
+    for key, value in result.items():
+        if key != "Plan":
+            query_plan[key] = value
+    return query_plan
+
+def cached_plan(query_plan):
+    '''
+    :returns: a copy of a plan served from the plan cache, marked with "From Cache": its "Planning Time" was measured
+    when it was retrieved, and nothing was planned this time
+    '''
+    query_plan = query_plan.copy()
+    query_plan["From Cache"] = True
+    return query_plan
+
+def settings_setup(settings):
+    '''
+    :param settings: {name: value} of session settings, e.g. {"enable_hashjoin": "off", "work_mem": "64MB"}
+    :returns: setup statements for QueryProcessor.explain applying the settings to the EXPLAIN's transaction only (as SET LOCAL does),
+    so the pooled connection keeps its own settings
+    '''
+    return [("SELECT set_config(%s, %s, true)", (name, str(value))) for name, value in sorted(settings.items())]
+
+def tokenize_query(query):
+    '''
+    Breaks query into lexer tokens, which keep their offsets into the query.
+    Comments and statement-terminating semicolons are left out.
+    '''
+    return [token for token in lexer.tokenize(query) if token.text != ";" or token.kind != lexer.PUNCTUATION]
+
+# class to stop running process_query calls from another thread; one Cancellation can be shared by concurrent calls:
+class Cancellation:
+
+    def __init__(self):
+        self.cancelled = False
+        self._conns = set()  # connections a statement is running on
+        self._lock = threading.Lock()
+
+    def attach(self, conn):
+        '''
+        Called by process_query with the connection its statement is about to run on
+        '''
+        with self._lock:
+            if self.cancelled:
+                raise Exception("The query was cancelled")
+            self._conns.add(conn)
+
+    def detach(self, conn):
+        with self._lock:
+            self._conns.discard(conn)
+
+    def cancel(self):
+        '''
+        Stops the statements on the server (the same as pg_cancel_backend for their backends)
+        '''
+        with self._lock:
+            self.cancelled = True
+            for conn in self._conns:
+                conn.cancel()
 
 # class to handle query pre-processing:
 class QueryProcessor:
 
-    def __init__(self, username, password, host, database):
-        conn = psycopg2.connect(
+    def __init__(self, username, password, host, database, pool_size=4, cache_size=256, version_ttl=1.0, statement_timeout=None, history=None, metrics=None):
+        '''
+        Opens a bounded pool of connections to the database
+        :param pool_size: maximum number of connections; callers wait for a free connection once all are checked out
+        :param cache_size: maximum number of plans kept in the plan cache; 0 disables the cache
+        :param version_ttl: seconds for which the statistics version is trusted before it is queried again
+        :param statement_timeout: default timeout in seconds for each EXPLAIN, None for the server's setting
+        :param history: optional history.PlanHistory; every plan is recorded in it and compared with the previous plan of the query
+        :param metrics: optional metrics.Metrics timing the connection, explain, decode and tokenize stages
+        '''
+        self.statement_timeout = statement_timeout
+        self.history = history
+        self.metrics = metrics
+        self.pool_size = max(1, pool_size)
+        # one connection is opened immediately, so invalid credentials are reported here
+        self.pool = ThreadedConnectionPool(
+            1, self.pool_size,
             dbname=database,
             user=username,
             host=host,
             password=password
         )
-        conn.autocommit = True
-        self.cur = conn.cursor()
+        self._available = threading.BoundedSemaphore(self.pool_size)  # ThreadedConnectionPool raises instead of waiting when exhausted
 
-    def process_query(self, query):
+        # plans are cached by (fingerprint, statistics version), so ANALYZE or DDL invalidates them
+        self.plan_cache = PlanCache(cache_size)
+        self.version_ttl = version_ttl
+        self._version = None
+        self._version_checked = 0.0
+        self._version_lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        '''
+        Checks out a connection for the calling thread, and returns it to the pool afterwards
+        '''
+        if self.pool.closed:
+            raise Exception("The database session has been closed")
+        start = time.perf_counter()
+        with self._available:
+            conn = self.pool.getconn()
+            conn.autocommit = True
+            if self.metrics is not None:  # includes waiting for a free connection
+                self.metrics.observe("connection", time.perf_counter() - start)
+            try:
+                yield conn
+            finally:
+                if not self.pool.closed:
+                    self.pool.putconn(conn, close=conn.closed != 0)  # psycopg2 marks lost connections as closed
+
+    def close(self):
         '''
-        Retrieves query plan from Postgresql
+        Closes every connection in the pool
+        '''
+        if not self.pool.closed:
+            self.pool.closeall()
+        if self.history is not None:
+            self.history.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def execute(self, sql, params=None):
+        '''
+        Runs sql on a pooled connection
+        :returns: all rows of the result
+        '''
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(sql, params)
+                return cur.fetchall()
+
+    def statistics_version(self):
+        '''
+        Returns the current schema/statistics version, querying it at most once every version_ttl seconds.
+        The plan cache is cleared whenever the version changes.
+        '''
+        with self._version_lock:
+            now = time.monotonic()
+            if self._version is None or now - self._version_checked >= self.version_ttl:
+                version = self.execute(STATISTICS_VERSION_QUERY)[0]
+                if self._version is not None and version != self._version:
+                    self.plan_cache.clear()
+                self._version = version
+                self._version_checked = now
+            return self._version
+
+    def timeout_statement(self, timeout):
+        '''
+        :returns: statement setting the timeout (in seconds) of the statements that follow it, until the end of the transaction
+        it is run in, so the pooled connection keeps the server/role default; empty if there is no timeout to set
+        '''
+        if timeout is None:
+            timeout = self.statement_timeout
+        if timeout is None:
+            return ""
+        return f"SET LOCAL statement_timeout = {max(1, int(timeout * 1000))}; "
+
+    def explain(self, query, options=EXPLAIN_OPTIONS, cancellation=None, timeout=None, rollback=False, setup=(), teardown=None):
+        '''
+        Runs EXPLAIN (options) on a pooled connection
+        :param rollback: run the EXPLAIN inside a transaction that is always rolled back, e.g. for EXPLAIN ANALYZE of DML.
+        It is also done when a timeout applies, as the timeout is set for that transaction only
+        :param setup: statements run just before the EXPLAIN (inside its transaction), each a string or a (sql, params) pair
+        :param teardown: statement run on the connection afterwards, even if the EXPLAIN failed
+        :returns: the plan, with the top-level EXPLAIN fields (e.g. "Planning Time", "Planning" buffers) added to it
+        '''
+        with self.connection() as conn:
+            if cancellation is not None:
+                cancellation.attach(conn)
+            try:
+                with conn.cursor() as cur:
+                    psycopg2.extensions.register_type(JSON_TEXT, cur)
+                    # parameters are bound into the setup only, so a "%" in the query is left alone
+                    prefix = "".join(
+                        (item if isinstance(item, str) else cur.mogrify(*item).decode(psycopg2.extensions.encodings[conn.encoding])) + "; "
+                        for item in setup
+                    )
+                    timeout_statement = self.timeout_statement(timeout)
+                    rollback = rollback or timeout_statement != ""  # the timeout only lasts until the end of the transaction
+                    statement = timeout_statement + prefix + f"EXPLAIN ({options}) " + query
+                    if rollback:
+                        statement = "BEGIN; " + statement
+                    try:
+                        with timed(self.metrics, "explain"):
+                            cur.execute(statement)  # one round trip
+                            result = cur.fetchall()[0][0]
+                    finally:
+                        if rollback and not conn.closed:
+                            cur.execute("ROLLBACK")  # changes made by the statement are never kept
+                        if teardown is not None and not conn.closed:
+                            cur.execute(teardown)
+            finally:
+                if cancellation is not None:
+                    cancellation.detach(conn)
+        with timed(self.metrics, "decode"):
+            return plan_from_result(plantree.loads(result)[0])
+
+    def process_query(self, query, cancellation=None, timeout=None, analyze=False, settings=None):
+        '''
+        Retrieves query plan from Postgresql, or from the plan cache if the same query was explained
+        under the same statistics version
         :param query: query to be analyzed
-        :returns: query_plan if query is valid
-        '''
-        num_semicolons = query.count(";")
-        if num_semicolons > 1 or (num_semicolons == 1 and query.find(";") != len(query)-1):  # more than 1 query specified (+ last query may not have ended with ;)
-            raise Exception("More than one query is written (max one allowed)")
-        self.cur.execute("EXPLAIN (FORMAT JSON) " + query)
-        query_plan = self.cur.fetchall()[0][0][0]["Plan"]  # extract only the plan
-        return query_plan 
-    
-    def tokenize_query(self, query):
+        :param cancellation: optional Cancellation that can stop the EXPLAIN from another thread
+        :param timeout: seconds after which the server stops the EXPLAIN, defaults to statement_timeout
+        :param analyze: if True, the query is executed with EXPLAIN ANALYZE inside a transaction that is rolled back,
+        and the plan holds actual rows, timings and buffer usage
+        :param settings: optional {name: value} of settings the query is planned under (see settings_setup), e.g. for sweep.SettingsSweep.
+        Plans are cached per settings, and are not recorded in the history
+        :returns: query_plan if query is valid, with the planning time and buffers under "Planning Time" and "Planning"
+        (as measured when the plan was retrieved, for cached plans, which are marked with "From Cache", see cached_plan). With a history, changes from the previously recorded plan
+        are listed under "Plan Changes"
+        '''
+        check_single_query(query)
+        if self.metrics is not None:
+            self.metrics.increment("queries")
+        fingerprint = None
+        if self.plan_cache.max_size > 0 or self.history is not None:
+            fingerprint = fingerprint_query(query)
+
+        query_plan = None
+        cache_key = None
+        cached = False
+        parameters = count_parameters(query)
+        setup = settings_setup(settings) if settings else []
+        if analyze:  # actual run-time figures are never cached
+            query_plan = self.explain(query, "ANALYZE, BUFFERS, TIMING, FORMAT JSON", cancellation, timeout, rollback=True, setup=setup)
+        elif self.plan_cache.max_size > 0:
+            cache_key = (fingerprint, self.statistics_version())
+            if settings:
+                cache_key += (tuple((name, str(value)) for name, value in sorted(settings.items())),)
+            query_plan = self.plan_cache.get(cache_key)
+            cached = query_plan is not None
+            if cached:
+                query_plan = cached_plan(query_plan)
+                if self.metrics is not None:
+                    self.metrics.increment("cached_plans")
+
+        if query_plan is None:
+            if parameters > 0:  # e.g. from pg_stat_statements
+                query_plan = self.explain_generic(query, parameters, cancellation, timeout, setup)
+            else:
+                query_plan = self.explain(query, cancellation=cancellation, timeout=timeout, rollback=len(setup) != 0, setup=setup)
+            if cache_key is not None:
+                self.plan_cache.put(cache_key, query_plan)
+
+        if settings or cached:  # not the plan the query normally gets, or already recorded when it was retrieved
+            return query_plan
+        return self.track(fingerprint, query_plan)
+
+    def explain_generic(self, query, parameters, cancellation=None, timeout=None, setup=()):
+        '''
+        Plans a query with $1 to $parameters without knowing their values: the query is prepared, and executed with NULLs
+        under plan_cache_mode = force_generic_plan, so the plan is the generic one and does not depend on the NULLs
+        :param setup: further setup statements, see explain
+        '''
+        # the line break ends a trailing -- comment of the query (e.g. an ORM tag), which would otherwise swallow the EXPLAIN after it
+        setup = list(setup) + ["SET LOCAL plan_cache_mode = force_generic_plan", "PREPARE annotator_generic AS " + query + "\n"]
+        execute = "EXECUTE annotator_generic(" + ", ".join(["NULL"] * parameters) + ")"
+        # prepared statements outlive the rolled-back transaction
+        return self.explain(execute, cancellation=cancellation, timeout=timeout, rollback=True, setup=setup, teardown="DEALLOCATE ALL")
+
+    def track(self, fingerprint, query_plan):
+        '''
+        Records a plan just retrieved in the history, if any (plans served from the plan cache were recorded when they were retrieved)
+        :returns: the plan, or a copy of it with the changes from the previously recorded plan under "Plan Changes"
+        '''
+        if self.history is not None:
+            changes = self.history.compare(fingerprint, query_plan)
+            if len(changes) != 0:
+                query_plan = query_plan.copy()  # the cached plan itself is left as it was
+                query_plan["Plan Changes"] = changes
+        return query_plan
+
+    def process_script(self, script, cancellation=None, timeout=None, run_statements=False):
         '''
-        Breaks query into tokens separated by whitespace
+        Retrieves the plans of every statement in a script in one round trip: the EXPLAINs run in a single
+        transaction (always rolled back) through a temporary function, and only the plans not in the plan cache are requested
+        :param script: statements separated by semicolons
+        :param timeout: seconds after which the server stops the EXPLAINs, for the whole script
+        :param run_statements: run the statements that cannot be explained (e.g. CREATE TABLE) inside the transaction,
+        so that the statements after them are planned with their effects. The plan cache is not used then.
+        :returns: list of {"offset", "query", "plan"} in script order, where offset is the position of the statement in script.
+        A failed statement has "error" instead of a plan; a statement that was run instead of explained has a plan of None
         '''
-        clean_query = query.replace(",", " , ") # isolate commas
-        clean_query = clean_query.replace("(", " ( ") # isolate lparen
-        clean_query = clean_query.replace(")", " ) ") # isolate rparen
-        clean_query = clean_query.replace(";", "") # remove semicolons
-        return clean_query.split()
+        records = [{"offset": offset, "query": statement} for offset, statement in lexer.split_statements(script)]
+        use_cache = self.plan_cache.max_size > 0 and not run_statements
+        fingerprints = [None] * len(records)
+        if use_cache or self.history is not None:
+            fingerprints = [fingerprint_query(record["query"]) for record in records]
+
+        pending = {}  # {fingerprint (or index without the cache): indexes of the records waiting for its plan}
+        version = self.statistics_version() if use_cache else None
+        for i, record in enumerate(records):
+            query_plan = self.plan_cache.get((fingerprints[i], version)) if use_cache else None
+            if query_plan is not None:
+                record["plan"] = cached_plan(query_plan)
+                record["cached"] = True
+            elif use_cache:
+                pending.setdefault(fingerprints[i], []).append(i)  # statements with the same fingerprint are explained once
+            else:
+                pending[i] = [i]
+
+        if len(pending) != 0:
+            statements = [records[indexes[0]]["query"] for indexes in pending.values()]
+            with self.connection() as conn:
+                if cancellation is not None:
+                    cancellation.attach(conn)
+                try:
+                    with conn.cursor() as cur:
+                        psycopg2.extensions.register_type(JSON_TEXT, cur)
+                        try:
+                            with timed(self.metrics, "explain"):
+                                cur.execute(
+                                    "BEGIN; " + self.timeout_statement(timeout) + EXPLAIN_FUNCTION + "; "
+                                    "SELECT pg_temp.explain_json(statement, %s) FROM unnest(%s::text[]) WITH ORDINALITY AS s(statement, n) ORDER BY n",
+                                    (run_statements, statements)
+                                )
+                                results = [row[0] for row in cur.fetchall()]
+                        finally:
+                            if not conn.closed:
+                                cur.execute("ROLLBACK")  # also drops the temporary function
+                finally:
+                    if cancellation is not None:
+                        cancellation.detach(conn)
+            with timed(self.metrics, "decode"):
+                results = [plantree.loads(result) if result is not None else None for result in results]
+
+            for indexes, result in zip(pending.values(), results):
+                for i in indexes:
+                    if isinstance(result, dict):
+                        records[i]["error"] = result["error"]
+                    elif result is None:
+                        records[i]["plan"] = None
+                    else:
+                        records[i]["plan"] = plan_from_result(result[0])
+                        if use_cache:
+                            self.plan_cache.put((fingerprints[i], version), records[i]["plan"])
 
-        
-        
\ No newline at end of file
+        for i, record in enumerate(records):
+            if record.get("plan") is not None and not record.pop("cached", False):
+                record["plan"] = self.track(fingerprints[i], record["plan"])
+        return records
+
+    def tokenize_query(self, query):
+        '''
+        Breaks query into lexer tokens, see tokenize_query
+        '''
+        with timed(self.metrics, "tokenize"):
+            return tokenize_query(query)
@@ -1,4 +1,19 @@
-import interface
+import sys
 
 if __name__ == "__main__":
-    gui = interface.GUI()
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":  # headless mode, no Qt display needed
+        import batch
+        sys.exit(batch.main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "workload":  # report on a query log, no Qt display needed
+        import workload
+        sys.exit(workload.main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "sweep":  # one query under a grid of planner settings, no Qt display needed
+        import sweep
+        sys.exit(sweep.main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":  # annotation service for editors and dashboards, no Qt display needed
+        import service
+        sys.exit(service.main(sys.argv[2:]))
+
+    import interface  # Qt is only loaded for the GUI
+    gui = interface.GUI()
+    gui.run()
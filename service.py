@@ -0,0 +1,227 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from batch import BatchAnnotator
+from catalog import CatalogCache
+from history import PlanHistory
+from metrics import Metrics
+from plansource import ReplaySource
+from preprocessing import Cancellation, QueryProcessor
+
+'''
+Long-running annotation service, run with: python project.py serve [options]
+Clients send JSON over HTTP/1.1, on a TCP port or a Unix socket, e.g.
+    curl -s localhost:8765/annotate -d '{"query": "SELECT * FROM customer"}'
+    curl -s --unix-socket /tmp/annotator.sock http://localhost/batch -d '{"script": "SELECT 1; SELECT 2"}'
+Endpoints:
+    POST /annotate  {"query", "timeout"?}               -> record, as a line of `project.py batch`
+    POST /batch     {"queries": [...] | "script", "timeout"?} -> {"records": [...]}
+    GET  /health                                        -> {"status", "pending", "metrics"?}
+Every client shares one connection pool, plan cache and catalog cache.
+'''
+
+# reasons of the HTTP status codes the service answers with
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large",
+           503: "Service Unavailable", 504: "Gateway Timeout"}
+
+MAX_BODY = 16 * 1024 * 1024  # bytes of a request body
+MAX_HEADERS = 100
+
+# class to answer annotation requests from many clients with one processor:
+class AnnotationService:
+
+    def __init__(self, processor, workers=4, max_pending=64, timeout=60.0, catalog=None):
+        '''
+        :param processor: QueryProcessor (or plansource.ReplaySource) shared by every request; its pool should hold at least `workers` connections
+        :param workers: number of requests processed at the same time; the others wait for a free worker
+        :param max_pending: number of statements accepted (processed or waiting) at once, each query of a /batch request counting as one
+        and a script as one (it is explained in one round trip), timed-out ones counting until their workers are done;
+        beyond it requests are answered with 503 at once, and /batch requests of more queries than that with 413
+        :param timeout: longest time in seconds a request may take; longer ones are cancelled (on the server too) and answered with 504.
+        Requests can ask for less with "timeout"
+        :param catalog: optional catalog.CatalogCache adding catalog statistics to the annotations
+        '''
+        self.processor = processor
+        self.batch = BatchAnnotator(processor, workers, catalog=catalog)
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers))
+        self.max_pending = max(1, max_pending)
+        self.timeout = timeout
+        self.pending = 0  # statements accepted and not done yet; only changed on the event loop
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def release_when_done(self, futures):
+        '''
+        Counts each statement of a request as pending until its worker future is done, even after the request was answered (e.g. with 504)
+        '''
+        loop = asyncio.get_running_loop()
+
+        def finished():
+            self.pending -= 1
+
+        for future in futures:
+            future.add_done_callback(lambda future: loop.call_soon_threadsafe(finished))
+
+    async def handle(self, method, path, body):
+        '''
+        :returns: (HTTP status, JSON-serializable response)
+        '''
+        if path == "/health":
+            if method != "GET":
+                return 405, {"error": "Use GET"}
+            health = {"status": "ok", "pending": self.pending, "max_pending": self.max_pending}
+            if self.processor.metrics is not None:
+                health["metrics"] = self.processor.metrics.snapshot()
+            return 200, health
+
+        if path not in ("/annotate", "/batch"):
+            return 404, {"error": f"Unknown endpoint {path}"}
+        if method != "POST":
+            return 405, {"error": "Use POST"}
+        try:
+            request = json.loads(body)
+        except ValueError as e:
+            return 400, {"error": f"Invalid JSON: {e}"}
+        if not isinstance(request, dict):
+            return 400, {"error": "Expected a JSON object"}
+        timeout = request.get("timeout", self.timeout)
+        if isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or timeout <= 0:
+            return 400, {"error": "timeout must be a positive number of seconds"}
+        timeout = min(timeout, self.timeout)
+
+        if path == "/annotate":
+            if not isinstance(request.get("query"), str):
+                return 400, {"error": "Expected {\"query\": text}"}
+            calls = [(self.batch.annotate_statement, "request", 0, request["query"])]
+        elif isinstance(request.get("script"), str):  # one round trip for every statement
+            calls = [(self.batch.annotate_script, "request", request["script"])]
+        elif isinstance(request.get("queries"), list) and all(isinstance(query, str) for query in request["queries"]):
+            calls = [(self.batch.annotate_statement, "request", index, query) for index, query in enumerate(request["queries"])]
+        else:
+            return 400, {"error": "Expected {\"queries\": [texts]} or {\"script\": text}"}
+
+        if len(calls) > self.max_pending:
+            return 413, {"error": f"Too many queries in one request (at most {self.max_pending})"}
+        if self.pending + len(calls) > self.max_pending:  # backpressure: refuse instead of queueing without bound
+            return 503, {"error": f"Too many statements in progress ({self.max_pending}), retry later"}
+        cancellation = Cancellation()  # shared by the statements of the request, it cancels every one of them
+        futures = [self.executor.submit(fn, *args, cancellation, timeout) for fn, *args in calls]
+        self.pending += len(futures)
+        self.release_when_done(futures)
+        try:
+            results = await asyncio.wait_for(asyncio.gather(*(asyncio.wrap_future(future) for future in futures)), timeout)
+        except asyncio.TimeoutError:
+            cancellation.cancel()  # stops the running EXPLAINs on the server (waiting ones are dropped); the workers then finish with error records
+            return 504, {"error": f"The request took longer than {timeout} seconds"}
+        if path == "/annotate":
+            return 200, results[0]
+        if len(calls) == 1 and calls[0][0] == self.batch.annotate_script:
+            return 200, {"records": results[0]}
+        return 200, {"records": results}
+
+    async def serve_connection(self, reader, writer):
+        '''
+        Answers the HTTP/1.1 requests of one connection, keeping it open between requests unless asked not to
+        '''
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                parts = request_line.decode("latin-1").split()
+                headers = {}
+                for _ in range(MAX_HEADERS):
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                keep_alive = len(parts) == 3 and parts[2] == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                length = headers.get("content-length", "0")
+                length = int(length) if length.isdigit() else -1
+                if len(parts) != 3 or length < 0:
+                    status, response = 400, {"error": "Malformed request"}
+                    keep_alive = False
+                elif length > MAX_BODY:
+                    status, response = 413, {"error": f"Request body over {MAX_BODY} bytes"}
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length)
+                    status, response = await self.handle(parts[0].upper(), parts[1].split("?")[0], body)
+
+                payload = json.dumps(response).encode("utf-8")
+                head = (f"HTTP/1.1 {status} {REASONS[status]}\r\nContent-Type: application/json\r\nContent-Length: {len(payload)}\r\n"
+                        + ("Retry-After: 1\r\n" if status == 503 else "")
+                        + ("" if keep_alive else "Connection: close\r\n") + "\r\n")
+                writer.write(head.encode("latin-1") + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass  # the client went away
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8765, socket_path=None):
+        '''
+        Serves until cancelled, on a Unix socket if socket_path is given, on host:port otherwise
+        '''
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)  # left over from a previous run
+            server = await asyncio.start_unix_server(self.serve_connection, socket_path)
+            address = socket_path
+        else:
+            server = await asyncio.start_server(self.serve_connection, host, port)
+            address = ", ".join(f"{sock.getsockname()[0]}:{sock.getsockname()[1]}" for sock in server.sockets)
+        print(f"Serving annotations on {address}", file=sys.stderr)
+        async with server:
+            await server.serve_forever()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="project.py serve", description="Serve annotations over HTTP/JSON to many clients, sharing one connection pool and plan cache.")
+    parser.add_argument("--host", dest="listen_host", default="127.0.0.1", help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8765, help="port to listen on (default: 8765)")
+    parser.add_argument("--socket", metavar="PATH", help="listen on a Unix socket instead of a port")
+    parser.add_argument("--username", default=os.environ.get("PGUSER", "postgres"))
+    parser.add_argument("--password", default=os.environ.get("PGPASSWORD", ""))
+    parser.add_argument("--db-host", default=os.environ.get("PGHOST", "localhost"))
+    parser.add_argument("--database", default=os.environ.get("PGDATABASE", "postgres"))
+    parser.add_argument("--workers", type=int, default=4, help="number of requests processed concurrently, and of pooled connections (default: 4)")
+    parser.add_argument("--max-pending", type=int, default=64, help="number of statements accepted at once before answering 503 (default: 64)")
+    parser.add_argument("--timeout", type=float, default=60.0, help="longest time in seconds a request may take before answering 504 (default: 60)")
+    parser.add_argument("--cache-size", type=int, default=1024, help="number of plans kept for repeated queries, 0 to disable (default: 1024)")
+    parser.add_argument("--history", help="SQLite file recording every plan; changes from the last recorded plan are reported")
+    parser.add_argument("--catalog", action="store_true", help="add table sizes, scan selectivity, unused indexes and join column statistics from the catalog")
+    parser.add_argument("--replay", metavar="DIR", help="serve plans from a fixture directory made with `project.py batch --record`, without a database")
+    parser.add_argument("--metrics", metavar="FILE", help="write the time spent in each stage to FILE on exit: Prometheus text format if it ends with .prom, JSON lines otherwise")
+    args = parser.parse_args(argv)
+
+    metrics = Metrics()  # also reported by /health
+    if args.replay:
+        processor = ReplaySource(args.replay, args.cache_size, metrics=metrics)
+    else:
+        processor = QueryProcessor(args.username, args.password, args.db_host, args.database, pool_size=args.workers, cache_size=args.cache_size,
+                                   history=PlanHistory(args.history) if args.history else None, metrics=metrics)
+    with processor:
+        catalog = CatalogCache(processor) if args.catalog and not args.replay else None
+        service = AnnotationService(processor, args.workers, args.max_pending, args.timeout, catalog)
+        try:
+            asyncio.run(service.serve(args.listen_host, args.port, args.socket))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            service.close()
+    if args.metrics:
+        metrics.write(args.metrics)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,186 @@
+import argparse
+import itertools
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from annotation import JOIN, SCAN, ThreadAnnotators
+from catalog import CatalogCache
+from metrics import Metrics
+from preprocessing import QueryProcessor, check_single_query
+
+# planner settings swept by default, with the values tried for each
+DEFAULT_GRID = {
+    "work_mem": ["4MB", "64MB"],
+    "enable_hashjoin": ["on", "off"],
+    "enable_nestloop": ["on", "off"],
+    "enable_seqscan": ["on", "off"],
+    "max_parallel_workers_per_gather": ["0", "2"],
+    "join_collapse_limit": ["1", "8"],
+}
+
+# categories of annotations compared between configurations
+COMPARED = (JOIN, SCAN)
+
+def parse_setting(text):
+    '''
+    :param text: e.g. "work_mem=4MB,64MB"
+    :returns: (name, list of values)
+    :raises argparse.ArgumentTypeError: if text is not a setting with at least one value, so --set reports it as a usage error
+    '''
+    name, sep, values = text.partition("=")
+    values = [value.strip() for value in values.split(",") if value.strip() != ""]
+    if sep == "" or name.strip() == "" or len(values) == 0:
+        raise argparse.ArgumentTypeError(f"expected a setting as name=value1,value2,...: {text}")
+    return name.strip(), values
+
+def configurations(grid):
+    '''
+    :param grid: {setting name: list of values}
+    :returns: list of {setting name: value}, one per combination of the values
+    '''
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+def annotation_changes(baseline, annotations):
+    '''
+    Compares the join and scan annotations of a configuration with those of the plan under the current settings
+    :returns: list of {"category", "tokens", "before", "after"} in query order; before/after is None if the
+    annotation is only in the other plan
+    '''
+    def by_span(index):
+        return {(a.category, a.token_start, a.token_end): a.text for a in index if a.category in COMPARED}
+
+    before = by_span(baseline)
+    after = by_span(annotations)
+    changes = []
+    for category, start, end in sorted(before.keys() | after.keys(), key=lambda span: (span[1], span[2], span[0])):
+        text_before = before.get((category, start, end))
+        text_after = after.get((category, start, end))
+        if text_before != text_after:
+            changes.append({"category": category, "tokens": [start, end], "before": text_before, "after": text_after})
+    return changes
+
+# class to explain one query under every combination of a grid of planner settings:
+class SettingsSweep:
+
+    def __init__(self, processor, workers=None, catalog=None):
+        '''
+        :param processor: QueryProcessor shared by all workers; each configuration is applied to the EXPLAIN's
+        transaction only, so its pooled connections keep their settings
+        :param workers: number of configurations explained concurrently, defaults to the processor's pool size
+        :param catalog: optional catalog.CatalogCache shared by all workers, adding catalog statistics to the annotations
+        '''
+        self.processor = processor
+        self.workers = max(1, workers if workers is not None else processor.pool_size)
+        self.annotators = ThreadAnnotators(processor.metrics, catalog)
+
+    def explain(self, query, tokenized_query, settings, timeout=None):
+        '''
+        :returns: {"settings", "total_cost", "annotations"} of the query planned under settings, or {"settings", "error"}
+        '''
+        record = {"settings": settings}
+        try:
+            query_plan = self.processor.process_query(query, timeout=timeout, settings=settings)
+            record["total_cost"] = query_plan["Total Cost"]
+            record["annotations"] = self.annotators.get().annotate(query_plan, tokenized_query)
+        except Exception as e:
+            record["error"] = str(e)
+        return record
+
+    def sweep(self, query, grid=None, timeout=None):
+        '''
+        Explains and annotates query under the current settings and under every configuration of grid, concurrently
+        :param grid: {setting name: list of values}, DEFAULT_GRID if not given
+        :returns: (baseline, results): the record of the current settings, and those of the configurations,
+        cheapest first and failed ones last, each with the join/scan annotations that differ from the baseline under "changes".
+        If the query fails under the current settings, the baseline holds the error and no configuration is tried
+        '''
+        check_single_query(query)
+        tokenized_query = self.processor.tokenize_query(query)
+        baseline = self.explain(query, tokenized_query, {}, timeout)
+        if "error" in baseline:
+            return baseline, []
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = list(executor.map(lambda settings: self.explain(query, tokenized_query, settings, timeout), configurations(grid or DEFAULT_GRID)))
+
+        for record in results:
+            if "annotations" in record:
+                record["changes"] = annotation_changes(baseline["annotations"], record["annotations"])
+        results.sort(key=lambda record: (0, record["total_cost"]) if "total_cost" in record else (1, 0))
+        return baseline, results
+
+def format_settings(settings):
+    return ", ".join(f"{name}={value}" for name, value in settings.items()) or "current settings"
+
+def format_report(baseline, results, top=None):
+    '''
+    :returns: the report as text, one section per configuration
+    '''
+    lines = [f"current settings  total cost: {baseline['total_cost']}", ""]
+    for rank, record in enumerate(results[:top], 1):
+        if "error" in record:
+            lines.append(f"#{rank}  {format_settings(record['settings'])}")
+            lines.append(f"    error: {record['error']}")
+        else:
+            ratio = record["total_cost"] / baseline["total_cost"] if baseline["total_cost"] else 1.0
+            lines.append(f"#{rank}  total cost: {record['total_cost']} ({ratio:.2f}x)  {format_settings(record['settings'])}")
+            for change in record["changes"]:
+                if change["before"] is None:
+                    lines.append(f"    + {change['after']}")
+                elif change["after"] is None:
+                    lines.append(f"    - {change['before']}")
+                else:
+                    lines.append(f"    ~ {change['before']}")
+                    lines.append(f"      -> {change['after']}")
+        lines.append("")
+    return "\n".join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="project.py sweep", description="Explain one query under every combination of a grid of planner settings, ranked by total cost.")
+    parser.add_argument("path", help="file with the query, or - for stdin")
+    parser.add_argument("--set", dest="settings", action="append", type=parse_setting, metavar="NAME=V1,V2,...",
+                        help="setting and the values tried for it, repeatable; replaces the default grid "
+                             "(work_mem, enable_hashjoin/nestloop/seqscan, max_parallel_workers_per_gather, join_collapse_limit)")
+    parser.add_argument("--username", default=os.environ.get("PGUSER", "postgres"))
+    parser.add_argument("--password", default=os.environ.get("PGPASSWORD", ""))
+    parser.add_argument("--host", default=os.environ.get("PGHOST", "localhost"))
+    parser.add_argument("--database", default=os.environ.get("PGDATABASE", "postgres"))
+    parser.add_argument("--workers", type=int, default=4, help="number of configurations explained concurrently (default: 4)")
+    parser.add_argument("--timeout", type=float, help="seconds after which each EXPLAIN is stopped")
+    parser.add_argument("--catalog", action="store_true", help="add table sizes, scan selectivity, unused indexes and join column statistics from the catalog")
+    parser.add_argument("--top", type=int, help="number of configurations in the report (default: all)")
+    parser.add_argument("--json", action="store_true", help="write the results as JSON lines instead of a report")
+    parser.add_argument("--metrics", metavar="FILE", help="write the time spent in each stage to FILE: Prometheus text format if it ends with .prom, JSON lines otherwise")
+    args = parser.parse_args(argv)
+
+    if args.path == "-":
+        query = sys.stdin.read()
+    else:
+        with open(args.path, encoding="utf-8") as f:
+            query = f.read()
+    grid = dict(args.settings) if args.settings else None
+
+    metrics = Metrics() if args.metrics else None
+    with QueryProcessor(args.username, args.password, args.host, args.database, pool_size=args.workers, metrics=metrics) as processor:
+        catalog = CatalogCache(processor) if args.catalog else None
+        baseline, results = SettingsSweep(processor, args.workers, catalog).sweep(query, grid, args.timeout)
+    if "error" in baseline and not args.json:
+        print(f"error: {baseline['error']}", file=sys.stderr)
+    elif args.json:
+        for record in [baseline] + results[:args.top]:
+            record = dict(record)
+            if "annotations" in record:
+                record["annotations"] = [annotation.text for annotation in record["annotations"]]
+            print(json.dumps(record))
+    else:
+        print(format_report(baseline, results, args.top))
+    if metrics is not None:
+        metrics.write(args.metrics)
+    return 1 if "error" in baseline else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
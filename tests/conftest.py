@@ -0,0 +1,26 @@
+import os
+import sys
+
+import pytest
+
+# the modules are flat files at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture(scope="session")
+def postgres():
+    '''
+    Connection details of a PostgreSQL server, from the PGUSER, PGPASSWORD, PGHOST and PGDATABASE environment variables
+    (as for project.py batch); tests using it are skipped when no server answers
+    '''
+    psycopg2 = pytest.importorskip("psycopg2")
+    args = {
+        "username": os.environ.get("PGUSER", "postgres"),
+        "password": os.environ.get("PGPASSWORD", ""),
+        "host": os.environ.get("PGHOST", "localhost"),
+        "database": os.environ.get("PGDATABASE", "postgres"),
+    }
+    try:
+        psycopg2.connect(dbname=args["database"], user=args["username"], host=args["host"], password=args["password"], connect_timeout=3).close()
+    except psycopg2.OperationalError as e:
+        pytest.skip(f"no PostgreSQL server to test against: {e}".strip())
+    return args
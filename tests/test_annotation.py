@@ -0,0 +1,119 @@
+from annotation import JOIN, SCAN, SUBPLAN, Annotation, AnnotationIndex, Annotator
+from preprocessing import tokenize_query
+
+QUERY = "SELECT * FROM customer c JOIN orders o ON c.c_custkey = o.o_custkey WHERE o.o_totalprice > 10"
+PLAN = {
+    "Node Type": "Hash Join", "Total Cost": 20.0, "Plan Rows": 10, "Hash Cond": "(o.o_custkey = c.c_custkey)",
+    "Plans": [
+        {"Node Type": "Seq Scan", "Relation Name": "orders", "Alias": "o", "Total Cost": 10.0, "Plan Rows": 10, "Filter": "(o_totalprice > 10)"},
+        {"Node Type": "Hash", "Total Cost": 5.0, "Plans": [
+            {"Node Type": "Seq Scan", "Relation Name": "customer", "Alias": "c", "Total Cost": 5.0, "Plan Rows": 100},
+        ]},
+    ],
+}
+
+
+def make_index():
+    annotations = [
+        Annotation(SCAN, 3, 5, 14, 24, (3,), "customer"),
+        Annotation(SCAN, 6, 8, 30, 38, (1,), "orders"),
+        Annotation(SUBPLAN, 0, 20, 0, 90, (0, 1), "whole query"),
+        Annotation(JOIN, 5, 6, 25, 29, (0,), "join"),
+    ]
+    return AnnotationIndex(annotations, "Total cost of the query plan is: 20.0.", {"c": "customer"})
+
+
+def texts(annotations):
+    return [annotation.text for annotation in annotations]
+
+
+def test_annotations_are_sorted_by_position():
+    assert texts(make_index()) == ["whole query", "customer", "join", "orders"]
+
+
+def test_at_token_and_at_offset():
+    index = make_index()
+    assert texts(index.at_token(4)) == ["whole query", "customer"]
+    assert texts(index.at_token(5)) == ["whole query", "join"]
+    assert texts(index.at_token(19)) == ["whole query"]
+    assert texts(index.at_token(20)) == []
+    assert texts(index.at_offset(14)) == ["whole query", "customer"]
+    assert texts(index.at_offset(24)) == ["whole query"]
+    assert texts(index.at_offset(37)) == ["whole query", "orders"]
+
+
+def test_lookups_match_a_linear_scan():
+    annotations = [Annotation(SCAN, i, i + 1 + i % 7, 2 * i, 2 * i + 3 + i % 11, (i,), str(i)) for i in range(0, 200, 3)]
+    annotations.append(Annotation(SUBPLAN, 1, 150, 2, 300, (999,), "wide"))
+    index = AnnotationIndex(annotations, "", {})
+    for position in range(-1, 420):
+        assert index.at_token(position) == [a for a in index if a.token_start <= position < a.token_end]
+        assert index.at_offset(position) == [a for a in index if a.char_start <= position < a.char_end]
+
+
+def test_empty_index():
+    index = AnnotationIndex([], "", {})
+    assert len(index) == 0
+    assert index.at_token(0) == [] and index.at_offset(0) == []
+
+
+def test_for_node():
+    index = make_index()
+    assert texts(index.for_node(0)) == ["whole query", "join"]
+    assert texts(index.for_node(1)) == ["whole query", "orders"]
+    assert index.for_node(42) == []
+
+
+def test_serialization_round_trip():
+    index = make_index()
+    loaded = AnnotationIndex.from_json(index.to_json())
+    assert [annotation.to_row() for annotation in loaded] == [annotation.to_row() for annotation in index]
+    assert (loaded.cost, loaded.aliases, loaded.planning) == (index.cost, index.aliases, None)
+    assert texts(loaded.at_token(7)) == ["whole query", "orders"]
+
+
+def test_annotate_scans_and_aliases():
+    tokens = tokenize_query(QUERY)
+    index = Annotator().annotate(PLAN, tokens)
+    scans = {tokens[annotation.token_start].text: annotation for annotation in index if annotation.category == SCAN}
+    assert set(scans) == {"customer", "orders"}
+    assert scans["orders"].nodes == (1,) and scans["customer"].nodes == (3,)
+    assert 'filter "o_totalprice > 10"' in scans["orders"].text
+    assert index.aliases == {"c": "customer", "o": "orders"}
+    assert index.cost == "Total cost of the query plan is: 20.0."
+    assert index.planning is None
+
+
+def test_from_dict_without_planning():
+    data = make_index().to_dict()
+    del data["planning"]  # saved before planning times were reported
+    assert AnnotationIndex.from_dict(data).planning is None
+
+
+def test_planning_annotation():
+    plan = dict(PLAN, **{"Planning Time": 1.25, "Planning": {"Shared Hit Blocks": 7, "Shared Read Blocks": 2}})
+    index = Annotator().annotate(plan, tokenize_query(QUERY))
+    assert index.planning == "Planning the query took 1.250 ms, hitting 7 and reading 2 buffer block(s)."
+    cached = dict(plan, **{"From Cache": True})
+    assert Annotator().annotate(cached, tokenize_query(QUERY)).planning == (
+        "Planning the query took 1.250 ms, hitting 7 and reading 2 buffer block(s). "
+        "The plan was served from the plan cache this time, without planning the query again."
+    )
+
+
+def test_costliest_operators_are_listed_in_the_cost():
+    plan = {
+        "Node Type": "Hash Join", "Hash Cond": "(o.o_custkey = c.c_custkey)", "Total Cost": 20.0, "Plan Rows": 10,
+        "Actual Rows": 10, "Actual Loops": 1, "Actual Total Time": 10.5, "Execution Time": 10.0,
+        "Plans": [
+            {"Node Type": "Seq Scan", "Relation Name": "orders", "Alias": "o", "Total Cost": 10.0, "Plan Rows": 10,
+             "Actual Rows": 10, "Actual Loops": 1, "Actual Total Time": 1.0},
+            {"Node Type": "Hash", "Total Cost": 5.0, "Actual Rows": 100, "Actual Loops": 1, "Actual Total Time": 8.0, "Plans": [
+                {"Node Type": "Seq Scan", "Relation Name": "customer", "Alias": "c", "Total Cost": 5.0, "Plan Rows": 100,
+                 "Actual Rows": 100, "Actual Loops": 1, "Actual Total Time": 2.0},
+            ]},
+        ],
+    }
+    index = Annotator().annotate(plan, tokenize_query(QUERY))
+    # the Hash has no annotation of its own, so its share only shows in the cost
+    assert "The costliest operators are: Hash (60%), Seq Scan on customer (20%), Hash Join (15%)." in index.cost
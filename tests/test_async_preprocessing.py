@@ -0,0 +1,66 @@
+import asyncio
+
+from async_preprocessing import AsyncQueryProcessor
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_process_queries(postgres):
+    async def explain():
+        async with AsyncQueryProcessor(**postgres, pool_size=2) as processor:
+            return await processor.process_queries(["SELECT 1", "SELECT 2 WHERE false", "SELECT 1 UNION ALL SELECT 2"])
+
+    plans = run(explain())
+    assert [plan["Node Type"] for plan in plans] == ["Result", "Result", "Append"]
+    assert all("Planning Time" in plan for plan in plans)
+
+
+def test_plan_cache(postgres):
+    async def explain_twice():
+        async with AsyncQueryProcessor(**postgres, pool_size=1) as processor:
+            first = await processor.process_query("SELECT 1")
+            second = await processor.process_query("select   1")
+            return first, second, processor.plan_cache.stats()
+
+    first, second, stats = run(explain_twice())
+    assert second is first
+    assert stats["hits"] == 1
+
+
+def test_failing_query(postgres):
+    async def explain():
+        async with AsyncQueryProcessor(**postgres, pool_size=1) as processor:
+            plans = await processor.process_queries(["SELECT * FROM no_such_table", "SELECT 1"], return_exceptions=True)
+            return plans, await processor.process_query("SELECT 3")
+
+    (failed, plan), after = run(explain())
+    assert isinstance(failed, Exception)
+    assert plan["Node Type"] == "Result" and after["Node Type"] == "Result"
+
+
+def test_cancelled_query_replaces_its_connection(postgres):
+    async def cancel():
+        async with AsyncQueryProcessor(**postgres, pool_size=1) as processor:
+            task = asyncio.ensure_future(processor.execute("SELECT pg_sleep(30)"))
+            await asyncio.sleep(0.2)
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            return await processor.execute("SELECT 42")
+
+    assert run(asyncio.wait_for(cancel(), 10)) == [(42,)]
+
+
+def test_close_closes_checked_out_connections(postgres):
+    async def close_while_checked_out():
+        processor = await AsyncQueryProcessor(**postgres, pool_size=2).open()
+        async with processor.connection() as conn:
+            await processor.close()
+            assert not conn.closed  # still in use
+        return conn
+
+    assert run(close_while_checked_out()).closed
@@ -0,0 +1,36 @@
+import os
+
+import pytest
+
+import batch
+from batch import BatchAnnotator
+import plantree
+from plansource import ReplaySource
+
+TPCH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks", "tpch")
+
+
+def test_advisor_failure_keeps_the_annotations():
+    annotator = BatchAnnotator(ReplaySource(TPCH), advise=True)
+    with open(os.path.join(TPCH, "queries", "q03.sql")) as f:
+        record = annotator.annotate_statement("q03.sql", 0, f.read())
+    assert "error" not in record and len(record["annotations"]) != 0
+    assert "index_advice" not in record and "index_advice_error" in record
+
+
+def test_advise_is_rejected_with_replay():
+    with pytest.raises(SystemExit):
+        batch.main(["--advise", "--replay", TPCH])
+
+
+def test_cached_plans_are_not_flagged_as_expensive_to_plan():
+    annotator = BatchAnnotator(ReplaySource(TPCH), planning_threshold=50.0)
+    plan = plantree.PlanNode({"Node Type": "Seq Scan", "Relation Name": "t", "Alias": "t", "Total Cost": 1.0, "Planning Time": 80.0})
+    record = {}
+    annotator.annotate_plan(record, "SELECT * FROM t", plan)
+    assert record["expensive_planning"] == {"planning_time": 80.0, "joins": 0, "partitions": 0}
+    cached = plan.copy()
+    cached["From Cache"] = True
+    record = {}
+    annotator.annotate_plan(record, "SELECT * FROM t", cached)
+    assert "expensive_planning" not in record
@@ -0,0 +1,28 @@
+from cache import PlanCache
+
+
+def test_least_recently_used_plan_is_evicted():
+    cache = PlanCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1  # "b" is now the least recently used
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+    assert len(cache) == 2
+
+
+def test_clear_counts_invalidations():
+    cache = PlanCache(2)
+    cache.clear()  # nothing was cached, so nothing was invalidated
+    cache.put("a", 1)
+    cache.clear()
+    assert cache.get("a") is None
+    stats = cache.stats()
+    assert (stats["size"], stats["invalidations"], stats["hits"], stats["misses"]) == (0, 1, 0, 1)
+
+
+def test_size_zero_disables_the_cache():
+    cache = PlanCache(0)
+    cache.put("a", 1)
+    assert cache.get("a") is None and len(cache) == 0
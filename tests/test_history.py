@@ -0,0 +1,63 @@
+from history import PlanHistory, diff_plans, join_order, plan_digest
+
+
+def scan(node_type, relation, alias=None):
+    return {"Node Type": node_type, "Relation Name": relation, "Alias": alias or relation, "Total Cost": 1.0}
+
+
+def join(node_type, left, right, cost):
+    return {"Node Type": node_type, "Total Cost": cost, "Plans": [left, right]}
+
+
+def test_identical_plans_have_no_changes():
+    plan = join("Hash Join", scan("Seq Scan", "orders"), scan("Seq Scan", "customer"), 10.0)
+    assert diff_plans(plan, plan) == []
+
+
+def test_node_type_change():
+    before = join("Hash Join", scan("Seq Scan", "orders"), scan("Seq Scan", "customer"), 10.0)
+    after = join("Hash Join", scan("Index Scan", "orders"), scan("Seq Scan", "customer"), 10.0)
+    assert diff_plans(before, after) == ["The Seq Scan on orders is now an Index Scan on orders."]
+
+
+def test_join_order_and_cost_jump():
+    before = join("Hash Join", scan("Seq Scan", "orders", "o"), scan("Seq Scan", "customer", "c"), 10.0)
+    after = join("Hash Join", scan("Seq Scan", "customer", "c"), scan("Seq Scan", "orders", "o"), 25.0)
+    assert join_order(after) == ["c", "o"]
+    assert diff_plans(before, after) == ["The join order changed from o, c to c, o.", "The total cost rose from 10.0 to 25.0."]
+    assert diff_plans(after, before, cost_ratio=3.0) == ["The join order changed from c, o to o, c."]
+
+
+def test_input_count_change():
+    before = {"Node Type": "Append", "Total Cost": 3.0, "Plans": [scan("Seq Scan", "p1"), scan("Seq Scan", "p2")]}
+    after = {"Node Type": "Append", "Total Cost": 3.0, "Plans": [scan("Seq Scan", "p1")]}
+    assert diff_plans(before, after) == ["The Append now has 1 input(s) instead of 2."]
+
+
+def test_history_compares_with_the_last_recorded_plan(tmp_path):
+    history = PlanHistory(str(tmp_path / "plans.sqlite3"))
+    try:
+        first = join("Hash Join", scan("Seq Scan", "orders"), scan("Seq Scan", "customer"), 10.0)
+        second = join("Merge Join", scan("Seq Scan", "orders"), scan("Seq Scan", "customer"), 10.0)
+        assert history.compare("Q", first) == []
+        assert history.compare("Q", second) == ["The Hash Join is now a Merge Join."]
+        assert history.compare("Q", second) == []
+        assert [record["plan"]["Node Type"] for record in history.plans("Q", 5)] == ["Merge Join", "Hash Join"]
+    finally:
+        history.close()
+
+
+def test_digest_ignores_planning_and_run_time_figures():
+    plan = join("Hash Join", scan("Seq Scan", "orders"), scan("Seq Scan", "customer"), 10.0)
+    explained = dict(plan, **{"Planning Time": 0.25, "Planning": {"Shared Hit Blocks": 3}})
+    analyzed = dict(plan, **{"Actual Rows": 5, "Actual Total Time": 1.5, "Execution Time": 2.0, "Shared Hit Blocks": 9})
+    assert plan_digest(plan) == plan_digest(explained) == plan_digest(analyzed)
+    assert plan_digest(plan) != plan_digest(join("Hash Join", scan("Seq Scan", "customer"), scan("Seq Scan", "orders"), 10.0))
+
+
+def test_identical_plans_are_recorded_once(tmp_path):
+    with PlanHistory(str(tmp_path / "plans.sqlite3")) as history:
+        plan = join("Hash Join", scan("Seq Scan", "orders"), scan("Seq Scan", "customer"), 10.0)
+        for planning_time in (0.5, 0.7, 0.6):
+            assert history.compare("Q", dict(plan, **{"Planning Time": planning_time})) == []
+        assert len(history.plans("Q")) == 1
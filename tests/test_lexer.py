@@ -0,0 +1,80 @@
+import pytest
+
+from lexer import COMMENT, NUMBER, OPERATOR, OTHER, PARAMETER, PUNCTUATION, STRING, WORD, LexerError, column_references, split_statements, tokenize
+
+
+def kinds(query, **kwargs):
+    return [(token.kind, token.text) for token in tokenize(query, **kwargs)]
+
+
+def test_offsets_point_into_the_query():
+    query = "SELECT  c.name,\n\t'it''s' FROM \"My Table\" c"
+    tokens = tokenize(query)
+    assert [token.text for token in tokens] == ["SELECT", "c.name", ",", "'it''s'", "FROM", '"My Table"', "c"]
+    for token in tokens:
+        assert query[token.start:token.end] == token.text
+
+
+def test_strings():
+    assert kinds("'a''b' E'x\\'y' B'101' X'ff' N'n' U&'d\\0061t'") == [
+        (STRING, "'a''b'"), (STRING, "E'x\\'y'"), (STRING, "B'101'"), (STRING, "X'ff'"), (STRING, "N'n'"), (STRING, "U&'d\\0061t'"),
+    ]
+
+
+def test_escape_string_keeps_escaped_quote_and_backslash():
+    assert kinds("E'a\\\\' , 1") == [(STRING, "E'a\\\\'"), (PUNCTUATION, ","), (NUMBER, "1")]
+
+
+def test_dollar_quotes():
+    query = "SELECT $$a ' ; $b$ $$, $fn$ body; $$ inner $$ $fn$, $1"
+    assert kinds(query) == [
+        (WORD, "SELECT"), (STRING, "$$a ' ; $b$ $$"), (PUNCTUATION, ","), (STRING, "$fn$ body; $$ inner $$ $fn$"),
+        (PUNCTUATION, ","), (PARAMETER, "$1"),
+    ]
+
+
+def test_comments_are_skipped_or_kept():
+    query = "SELECT 1 -- one\n/* outer /* nested */ still comment */ + 2"
+    assert kinds(query) == [(WORD, "SELECT"), (NUMBER, "1"), (OPERATOR, "+"), (NUMBER, "2")]
+    assert kinds(query, keep_comments=True) == [
+        (WORD, "SELECT"), (NUMBER, "1"), (COMMENT, "-- one"), (COMMENT, "/* outer /* nested */ still comment */"),
+        (OPERATOR, "+"), (NUMBER, "2"),
+    ]
+
+
+def test_operators_follow_postgres_rules():
+    # a multi-character operator cannot end in + or - unless it contains one of ~ ! @ # % ^ & | ` ?
+    assert kinds("a=-1") == [(WORD, "a"), (OPERATOR, "="), (OPERATOR, "-"), (NUMBER, "1")]
+    assert kinds("a @- b") == [(WORD, "a"), (OPERATOR, "@-"), (WORD, "b")]
+    # -- and /* end an operator and start a comment
+    assert kinds("a <--b\n> 1") == [(WORD, "a"), (OPERATOR, "<"), (OPERATOR, ">"), (NUMBER, "1")]
+    assert kinds("a </* c */> b") == [(WORD, "a"), (OPERATOR, "<"), (OPERATOR, ">"), (WORD, "b")]
+    assert kinds("x::int <> y || z") == [(WORD, "x"), (PUNCTUATION, "::"), (WORD, "int"), (OPERATOR, "<>"), (WORD, "y"), (OPERATOR, "||"), (WORD, "z")]
+
+
+def test_numbers_words_and_other():
+    assert kinds("1.5e3 .5 10 t.* \"a\"\"b\".c {") == [
+        (NUMBER, "1.5e3"), (NUMBER, ".5"), (NUMBER, "10"), (WORD, "t.*"), (WORD, '"a""b".c'), (OTHER, "{"),
+    ]
+
+
+@pytest.mark.parametrize("query", ["SELECT 'abc", "SELECT $x$ abc", "SELECT 1 /* a /* b */", 'SELECT "abc'])
+def test_unterminated_input_raises(query):
+    with pytest.raises(LexerError):
+        tokenize(query)
+
+
+def test_split_statements_ignores_quoted_semicolons():
+    script = "SELECT ';' ; SELECT $$;$$;\n-- ; comment\nSELECT \"a;b\" /* ; */;;  "
+    assert split_statements(script) == [(0, "SELECT ';'"), (13, "SELECT $$;$$"), (40, "SELECT \"a;b\"")]
+
+
+def test_split_statements_without_trailing_semicolon():
+    assert split_statements("  SELECT 1") == [(2, "SELECT 1")]
+    assert split_statements(" ; -- nothing") == []
+
+
+def test_column_references():
+    assert column_references("((c.c_custkey = 5) AND (lower(c_name) ~~ 'a%'::text) AND (\"Odd\".\"Col\" IS NOT NULL))") == [
+        ("c", "c_custkey"), (None, "c_name"), ("Odd", "Col"),
+    ]
@@ -0,0 +1,71 @@
+import json
+import os
+
+import plantree
+from plansource import INDEX_FILE, PLANS_FILE, RecordingSource, ReplaySource
+
+QUERY = "SELECT * FROM t WHERE a = 1"
+
+
+def plan(node_type="Seq Scan", planning_time=0.5):
+    return plantree.PlanNode({"Node Type": node_type, "Relation Name": "t", "Total Cost": 1.0, "Planning Time": planning_time})
+
+
+# class to stand in for a QueryProcessor, serving the plans it is given in turn:
+class FakeProcessor:
+
+    def __init__(self, *plans):
+        self.plans = list(plans)
+
+    def process_query(self, query, cancellation=None, timeout=None, analyze=False, settings=None):
+        return self.plans.pop(0)
+
+    def close(self):
+        pass
+
+
+def index_lines(directory):
+    with open(os.path.join(directory, INDEX_FILE), encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_recorded_plans_are_replayed(tmp_path):
+    directory = str(tmp_path)
+    with RecordingSource(FakeProcessor(plan()), directory) as source:
+        source.process_query(QUERY)
+    with ReplaySource(directory) as replay:
+        assert len(replay) == 1
+        replayed = replay.process_query("select *  from t where a = 1;")
+        assert replayed.node_type == "Seq Scan" and replayed["Planning Time"] == 0.5
+        assert [query for query, _ in replay.recorded()] == [QUERY]
+
+
+def test_identical_plans_are_recorded_once(tmp_path):
+    directory = str(tmp_path)
+    for planning_time in (0.5, 0.7):
+        with RecordingSource(FakeProcessor(plan(planning_time=planning_time), plan(planning_time=0.9)), directory) as source:
+            source.process_query(QUERY)
+            source.process_query(QUERY)
+    assert len(index_lines(directory)) == 1
+    with RecordingSource(FakeProcessor(plan("Index Scan")), directory) as source:
+        source.process_query(QUERY)
+    assert len(index_lines(directory)) == 2
+    with ReplaySource(directory) as replay:
+        assert replay.process_query(QUERY).node_type == "Index Scan"  # the last plan recorded wins
+
+
+def test_plan_changes_are_not_recorded(tmp_path):
+    changed = plan()
+    changed["Plan Changes"] = ["The Index Scan on t is now a Seq Scan on t."]
+    with RecordingSource(FakeProcessor(changed), str(tmp_path)) as source:
+        source.process_query(QUERY)
+    with ReplaySource(str(tmp_path)) as replay:
+        assert "Plan Changes" not in replay.process_query(QUERY)
+
+
+def test_fixtures_without_digests_are_read(tmp_path):
+    line = (json.dumps({"key": "SELECT 1", "query": "SELECT 1", "plan": {"Node Type": "Result", "Total Cost": 0.01}}) + "\n").encode("utf-8")
+    (tmp_path / PLANS_FILE).write_bytes(line)
+    (tmp_path / INDEX_FILE).write_text(json.dumps(["SELECT 1", 0, len(line)]) + "\n", encoding="utf-8")
+    with ReplaySource(str(tmp_path)) as replay:
+        assert replay.process_query("SELECT 1").node_type == "Result"
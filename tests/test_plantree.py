@@ -0,0 +1,96 @@
+import json
+
+import plantree
+from plantree import PlanNode, as_plan
+
+EXPLAIN_OUTPUT = json.dumps([{
+    "Plan": {
+        "Node Type": "Append", "Total Cost": 30.0, "Plan Rows": 3, "Subplans Removed": 1,
+        "Plans": [
+            {"Node Type": "Seq Scan", "Relation Name": "measurement_1", "Alias": "m_1", "Total Cost": 10.0, "Plan Rows": 1, "Filter": "(x > 1)"},
+            {"Node Type": "Seq Scan", "Relation Name": "measurement_2", "Alias": "m_2", "Total Cost": 10.0, "Plan Rows": 1, "Filter": "(x > 1)"},
+            {"Node Type": "Index Scan", "Relation Name": "measurement_3", "Alias": "m_3", "Index Name": "m_3_x", "Index Cond": "(x > 1)", "Total Cost": 10.0, "Plan Rows": 1},
+        ],
+    },
+    "Planning Time": 0.5,
+}])
+
+
+def test_loads_turns_plan_nodes_into_plan_nodes():
+    result = plantree.loads(EXPLAIN_OUTPUT)[0]
+    assert isinstance(result, dict) and result["Planning Time"] == 0.5
+    plan = result["Plan"]
+    assert isinstance(plan, PlanNode)
+    assert plan.node_type == "Append" and plan["Node Type"] == "Append"
+    assert [child.relation_name for child in plan.children] == ["measurement_1", "measurement_2", "measurement_3"]
+    assert plan.filter is None and plan.children[0].filter == "(x > 1)"
+    assert plan.get("Subplans Removed") == 1 and plan.get("Missing", 5) == 5
+    assert "Subplans Removed" in plan and "Filter" not in plan
+
+
+def test_plan_nodes_read_like_dicts():
+    plan = plantree.loads(EXPLAIN_OUTPUT)[0]["Plan"]
+    scan = plan.children[2]
+    assert dict(scan) == scan.to_dict() == json.loads(EXPLAIN_OUTPUT)[0]["Plan"]["Plans"][2]
+    assert list(scan) == ["Node Type", "Relation Name", "Alias", "Index Name", "Index Cond", "Total Cost", "Plan Rows"]
+    assert scan.conditions == (("Index Cond", "(x > 1)"),)
+
+
+def test_dumps_round_trip():
+    decoded = plantree.loads(EXPLAIN_OUTPUT)
+    assert json.loads(plantree.dumps(decoded)) == json.loads(EXPLAIN_OUTPUT)
+
+
+def test_walk_and_index_are_pre_order():
+    plan = plantree.loads(EXPLAIN_OUTPUT)[0]["Plan"]
+    assert [node.alias for node in plan.walk()] == [None, "m_1", "m_2", "m_3"]
+    nodes, parents = plan.index()
+    assert [node.alias for node in nodes] == [None, "m_1", "m_2", "m_3"]
+    assert parents == [-1, 0, 0, 0]
+
+
+def test_setitem_and_copy():
+    plan = plantree.loads(EXPLAIN_OUTPUT)[0]["Plan"]
+    copy = plan.copy()
+    copy["Planning Time"] = 0.5
+    assert copy["Planning Time"] == 0.5 and "Planning Time" not in plan
+    assert copy.children is plan.children
+
+
+def test_as_plan_converts_nested_dicts():
+    data = json.loads(EXPLAIN_OUTPUT)[0]["Plan"]
+    plan = as_plan(data)
+    assert isinstance(plan, PlanNode) and all(isinstance(child, PlanNode) for child in plan.children)
+    assert json.loads(plantree.dumps(plan)) == data
+    assert as_plan(plan) is plan
+
+
+def test_as_plan_handles_deep_plans():
+    data = {"Node Type": "Seq Scan", "Relation Name": "t", "Total Cost": 1.0}
+    for _ in range(5000):  # deeper than the recursion limit
+        data = {"Node Type": "Limit", "Total Cost": 1.0, "Plans": [data]}
+    plan = as_plan(data)
+    assert sum(1 for _ in plan.walk()) == 5001
+
+
+def test_layouts_are_shared():
+    plan = plantree.loads(EXPLAIN_OUTPUT)[0]["Plan"]
+    first, second, third = plan.children
+    assert first._layout is second._layout
+    assert first._layout is not third._layout
+
+
+def test_inputs_are_converted_when_first_read():
+    plan = plantree.loads(EXPLAIN_OUTPUT)[0]["Plan"]
+    assert isinstance(plan._values[plan._layout.plans], list)
+    children = plan.children
+    assert all(isinstance(child, PlanNode) for child in children)
+    assert plan.children is children and plan["Plans"] is children
+
+
+def test_layout_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(plantree, "_LAYOUTS", {})
+    monkeypatch.setattr(plantree, "MAX_LAYOUTS", 2)
+    nodes = [PlanNode({"Node Type": "Result", f"Field {i}": i}) for i in range(5)]
+    assert len(plantree._LAYOUTS) == 2
+    assert [node[f"Field {i}"] for i, node in enumerate(nodes)] == list(range(5))
@@ -0,0 +1,47 @@
+import plantree
+from preprocessing import cached_plan, count_parameters, fingerprint_query, tokenize_query
+
+
+def test_fingerprint_ignores_whitespace_comments_case_and_semicolon():
+    assert fingerprint_query("select *\n  from Customer -- all of them\n where c_custkey = 5;") == fingerprint_query("SELECT * FROM customer WHERE c_custkey = 5")
+
+
+def test_fingerprint_keeps_literals_and_quoted_identifiers():
+    assert fingerprint_query("SELECT * FROM t WHERE a = 'X'") != fingerprint_query("SELECT * FROM t WHERE a = 'x'")
+    assert fingerprint_query("SELECT * FROM t WHERE a = 1") != fingerprint_query("SELECT * FROM t WHERE a = 2")
+    assert fingerprint_query('SELECT "Col" FROM t') != fingerprint_query('SELECT "col" FROM t')
+
+
+def test_fingerprint_keeps_planner_hints():
+    hinted = fingerprint_query("/*+ SeqScan(t) */ SELECT * FROM t WHERE a = 1")
+    assert hinted != fingerprint_query("SELECT * FROM t WHERE a = 1")
+    assert hinted != fingerprint_query("/*+ IndexScan(t) */ SELECT * FROM t WHERE a = 1")
+    assert fingerprint_query("/* plain */ SELECT * FROM t WHERE a = 1") == fingerprint_query("SELECT * FROM t WHERE a = 1")
+
+
+def test_fingerprint_strip_literals():
+    fingerprint = fingerprint_query("SELECT * FROM t WHERE a = 'x' AND b IN (1, 2, 3) AND c = $1", strip_literals=True)
+    assert fingerprint == "SELECT * FROM T WHERE A = ? AND B IN ( ? ) AND C = ?"
+    assert fingerprint_query("SELECT * FROM t WHERE b IN (7)", strip_literals=True) == fingerprint_query("select * from t where b in (8, 9)", strip_literals=True)
+
+
+def test_fingerprint_strip_literals_folds_unary_signs():
+    assert fingerprint_query("SELECT * FROM t WHERE b IN (-1, -2)", strip_literals=True) == fingerprint_query("SELECT * FROM t WHERE b IN (1, 2)", strip_literals=True)
+    assert fingerprint_query("SELECT * FROM t WHERE b = -1.5", strip_literals=True) == fingerprint_query("SELECT * FROM t WHERE b = 3", strip_literals=True)
+    assert fingerprint_query("SELECT a - 1 FROM t", strip_literals=True) == "SELECT A - ? FROM T"  # a subtraction is kept
+
+
+def test_tokenize_query_drops_terminating_semicolons():
+    assert [token.text for token in tokenize_query("SELECT ';' ;")] == ["SELECT", "';'"]
+
+
+def test_count_parameters():
+    assert count_parameters("SELECT $1, $3, '$9'") == 3
+    assert count_parameters("SELECT 1") == 0
+
+
+def test_cached_plan_is_a_marked_copy():
+    plan = plantree.PlanNode({"Node Type": "Result", "Total Cost": 0.01, "Planning Time": 0.5})
+    cached = cached_plan(plan)
+    assert cached["From Cache"] is True and cached["Planning Time"] == 0.5
+    assert "From Cache" not in plan
@@ -0,0 +1,117 @@
+import asyncio
+import json
+import os
+import threading
+
+from plansource import ReplaySource
+from service import AnnotationService
+
+TPCH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks", "tpch")
+
+
+# class to stand in for a connection, released by Cancellation.cancel:
+class FakeConnection:
+
+    def __init__(self):
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+
+# class to stand in for a QueryProcessor whose EXPLAINs run until they are cancelled:
+class BlockingProcessor:
+    metrics = None
+
+    def process_query(self, query, cancellation=None, timeout=None, analyze=False, settings=None):
+        conn = FakeConnection()
+        cancellation.attach(conn)
+        try:
+            conn.cancelled.wait(5)
+            raise Exception("canceling statement due to user request")
+        finally:
+            cancellation.detach(conn)
+
+
+def request(service, path, body, method="POST"):
+    return service.handle(method, path, json.dumps(body).encode("utf-8"))
+
+
+async def settle(service):
+    for _ in range(100):
+        if service.pending == 0:
+            return
+        await asyncio.sleep(0.01)
+
+
+def test_annotate_and_batch():
+    with ReplaySource(TPCH) as processor:
+        service = AnnotationService(processor, workers=2)
+        try:
+            with open(os.path.join(TPCH, "queries", "q03.sql")) as f:
+                query = f.read()
+
+            async def run():
+                status, record = await request(service, "/annotate", {"query": query})
+                assert status == 200 and "error" not in record and len(record["annotations"]) != 0
+                status, response = await request(service, "/batch", {"queries": [query, "SELECT 1"]})
+                assert status == 200 and [("error" in record) for record in response["records"]] == [False, True]
+                await settle(service)
+                status, health = await service.handle("GET", "/health", b"")
+                assert status == 200 and health["pending"] == 0
+
+            asyncio.run(run())
+        finally:
+            service.close()
+
+
+def test_bad_requests():
+    service = AnnotationService(BlockingProcessor())
+    try:
+        async def run():
+            assert (await service.handle("POST", "/annotate", b"{"))[0] == 400
+            assert (await request(service, "/annotate", ["SELECT 1"]))[0] == 400
+            assert (await request(service, "/annotate", {"query": 1}))[0] == 400
+            assert (await request(service, "/batch", {"queries": ["SELECT 1", 2]}))[0] == 400
+            for timeout in (True, 0, -1, "1"):
+                assert (await request(service, "/annotate", {"query": "SELECT 1", "timeout": timeout}))[0] == 400
+            assert (await request(service, "/other", {}))[0] == 404
+            assert (await request(service, "/annotate", {}, method="GET"))[0] == 405
+            assert service.pending == 0
+
+        asyncio.run(run())
+    finally:
+        service.close()
+
+
+def test_timeout_cancels_every_statement():
+    service = AnnotationService(BlockingProcessor(), workers=2)
+    try:
+        async def run():
+            status, response = await request(service, "/batch", {"queries": ["SELECT 1", "SELECT 2"], "timeout": 0.1})
+            assert status == 504
+            await settle(service)  # both workers were released by the cancellation
+            assert service.pending == 0
+
+        asyncio.run(run())
+    finally:
+        service.close()
+
+
+def test_every_query_counts_toward_max_pending():
+    service = AnnotationService(BlockingProcessor(), workers=2, max_pending=3, timeout=0.5)
+    try:
+        async def run():
+            assert (await request(service, "/batch", {"queries": ["SELECT 1"] * 4}))[0] == 413
+            first = asyncio.ensure_future(request(service, "/batch", {"queries": ["SELECT 1", "SELECT 2"]}))
+            await asyncio.sleep(0.05)
+            assert service.pending == 2
+            status, response = await request(service, "/batch", {"queries": ["SELECT 3", "SELECT 4"]})
+            assert status == 503
+            assert (await first)[0] == 504
+            await settle(service)
+            assert service.pending == 0
+
+        asyncio.run(run())
+    finally:
+        service.close()
@@ -0,0 +1,57 @@
+import argparse
+
+import pytest
+
+import sweep
+from annotation import JOIN, SCAN, SORT, Annotation, AnnotationIndex
+from sweep import SettingsSweep, annotation_changes, configurations, parse_setting
+
+
+def test_parse_setting():
+    assert parse_setting(" work_mem = 4MB, 64MB ,") == ("work_mem", ["4MB", "64MB"])
+    for text in ("work_mem", "=4MB", "work_mem=", "work_mem= , "):
+        with pytest.raises(argparse.ArgumentTypeError):
+            parse_setting(text)
+
+
+def test_bad_setting_is_a_usage_error(capsys):
+    with pytest.raises(SystemExit) as exit_info:
+        sweep.main(["query.sql", "--set", "work_mem"])
+    assert exit_info.value.code == 2
+    assert "expected a setting as name=value1,value2,...: work_mem" in capsys.readouterr().err
+
+
+def test_configurations():
+    assert configurations({"a": ["1", "2"], "b": ["x"]}) == [{"a": "1", "b": "x"}, {"a": "2", "b": "x"}]
+
+
+def test_annotation_changes():
+    def index(*annotations):
+        return AnnotationIndex([Annotation(category, start, end, start, end, (0,), text) for category, start, end, text in annotations], "", {})
+
+    baseline = index((JOIN, 2, 3, "hash join"), (SCAN, 4, 5, "seq scan"), (SORT, 8, 9, "sort"))
+    annotations = index((JOIN, 2, 3, "nested loop"), (SCAN, 6, 7, "index scan"), (SORT, 8, 9, "incremental sort"))
+    assert annotation_changes(baseline, annotations) == [
+        {"category": JOIN, "tokens": [2, 3], "before": "hash join", "after": "nested loop"},
+        {"category": SCAN, "tokens": [4, 5], "before": "seq scan", "after": None},
+        {"category": SCAN, "tokens": [6, 7], "before": None, "after": "index scan"},
+    ]
+    assert annotation_changes(baseline, baseline) == []
+
+
+# class to stand in for a QueryProcessor that cannot plan the query:
+class FailingProcessor:
+    metrics = None
+    pool_size = 2
+
+    def process_query(self, query, cancellation=None, timeout=None, analyze=False, settings=None):
+        raise Exception("relation \"t\" does not exist")
+
+    def tokenize_query(self, query):
+        return []
+
+
+def test_failed_baseline_is_returned_as_an_error_record():
+    baseline, results = SettingsSweep(FailingProcessor()).sweep("SELECT * FROM t")
+    assert baseline == {"settings": {}, "error": "relation \"t\" does not exist"}
+    assert results == []
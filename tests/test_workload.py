@@ -0,0 +1,34 @@
+from workload import collect_shapes, read_csvlog
+
+
+def test_collect_shapes_merges_queries_differing_in_their_values():
+    entries = [
+        ("SELECT * FROM t WHERE a = 1", 2, 10.0),
+        ("select * from t where a = 42", 3, None),
+        ("SELECT * FROM t WHERE a IN (-1, -2)", 1, 1.5),
+        ("SELECT * FROM t WHERE a IN (5)", 1, 0.5),
+    ]
+    shapes, skipped = collect_shapes(entries)
+    assert skipped == 0
+    assert [(shape["query"], shape["calls"], shape["total_time"]) for shape in shapes.values()] == [
+        ("SELECT * FROM t WHERE a = 1", 5, 10.0),
+        ("SELECT * FROM t WHERE a IN (-1, -2)", 2, 2.0),
+    ]
+
+
+def test_collect_shapes_skips_unexplainable_and_unreadable_statements():
+    shapes, skipped = collect_shapes([("SET work_mem = '64MB'", 1, None), ("SELECT 'cut off", 1, None), ("SELECT 1", 1, None)])
+    assert list(shapes) == ["SELECT ?"]
+    assert skipped == 1
+
+
+def test_read_csvlog(tmp_path):
+    path = tmp_path / "postgresql.csv"
+    prefix = ",".join(['""'] * 13)
+    path.write_text(
+        prefix + ',"duration: 1.5 ms  statement: SELECT 1; SELECT 2"\n'
+        + prefix + ',"execute S_1: SELECT \'cut off"\n'
+        + prefix + ',"connection authorized"\n',
+        encoding="utf-8",
+    )
+    assert list(read_csvlog(str(path))) == [("SELECT 1", 1, 1.5), ("SELECT 2", 1, 1.5), ("SELECT 'cut off", 1, None)]
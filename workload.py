@@ -0,0 +1,224 @@
+import argparse
+import csv
+import os
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from annotation import ThreadAnnotators
+from catalog import CatalogCache
+from lexer import LexerError, split_statements, tokenize, WORD
+from metrics import Metrics
+from preprocessing import QueryProcessor, fingerprint_query
+
+# statements logged by log_statement / log_min_duration_statement, e.g. "duration: 1.5 ms  execute S_1: SELECT ..."
+LOG_STATEMENT = re.compile(r"(?:duration: ([\d.]+) ms\s+)?(?:statement|execute [^:]*): (.*)", re.DOTALL)
+CSVLOG_MESSAGE = 13  # column of the message in Postgres' csvlog format
+
+# statements that can be explained
+EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "VALUES", "TABLE")
+
+csv.field_size_limit(2**31 - 1)  # logged queries can be long
+
+def read_csvlog(path):
+    '''
+    Yields (query, calls, total time in ms or None) for every statement logged in a Postgres csvlog file.
+    A message that cannot be split into statements (e.g. cut off by the log) is yielded whole, and skipped by collect_shapes
+    '''
+    with open(path, newline="", encoding="utf-8", errors="replace") as f:
+        for row in csv.reader(f):
+            if len(row) <= CSVLOG_MESSAGE:
+                continue
+            match = LOG_STATEMENT.match(row[CSVLOG_MESSAGE])
+            if match is None:
+                continue
+            duration = float(match.group(1)) if match.group(1) else None
+            try:
+                statements = split_statements(match.group(2))
+            except LexerError:
+                yield match.group(2), 1, duration
+                continue
+            for _, statement in statements:
+                yield statement, 1, duration
+
+def read_pg_stat_statements(path):
+    '''
+    Yields (query, calls, total time in ms) for every row of a CSV export of pg_stat_statements (with a header row)
+    '''
+    with open(path, newline="", encoding="utf-8", errors="replace") as f:
+        for row in csv.DictReader(f):
+            total_time = row.get("total_exec_time", row.get("total_time"))
+            yield row["query"], int(row.get("calls") or 1), float(total_time) if total_time else None
+
+def read_workload(path, log_format="auto"):
+    '''
+    :param log_format: "csvlog", "pg_stat_statements", or "auto" to tell them apart by the header row
+    '''
+    if log_format == "auto":
+        with open(path, newline="", encoding="utf-8", errors="replace") as f:
+            header = next(csv.reader(f), [])
+        log_format = "pg_stat_statements" if "query" in header and "calls" in header else "csvlog"
+    if log_format == "pg_stat_statements":
+        return read_pg_stat_statements(path)
+    return read_csvlog(path)
+
+def is_explainable(query):
+    for token in tokenize(query):
+        return token.kind == WORD and token.upper in EXPLAINABLE
+    return False
+
+def collect_shapes(entries):
+    '''
+    Collapses (query, calls, total time) entries by literal-stripped fingerprint, keeping only the totals of each shape
+    :returns: (shapes, skipped): dict of {fingerprint: {"fingerprint", "query", "calls", "total_time"}}, where query is the first one seen,
+    and the number of entries that could not be tokenized
+    '''
+    shapes = {}
+    skipped = 0
+    for query, calls, total_time in entries:
+        try:
+            fingerprint = fingerprint_query(query, strip_literals=True)
+        except LexerError:  # e.g. a statement cut off by the log
+            skipped += 1
+            continue
+        shape = shapes.get(fingerprint)
+        if shape is None:
+            if not is_explainable(query):
+                continue
+            shape = shapes[fingerprint] = {"fingerprint": fingerprint, "query": query, "calls": 0, "total_time": None}
+        shape["calls"] += calls
+        if total_time is not None:
+            shape["total_time"] = (shape["total_time"] or 0.0) + total_time
+    return shapes, skipped
+
+def plan_findings(query_plan, relation_rows, large_rows):
+    '''
+    :returns: {"seq_scans": [{"table", "rows"}] of tables of at least large_rows rows, "joins": {join type: count}, "sorts": [sort keys]}
+    '''
+    findings = {"seq_scans": [], "joins": {}, "sorts": []}
+    stack = [query_plan]
+    while len(stack) != 0:
+        curr_plan = stack.pop()
+        stack.extend(curr_plan.get("Plans", []))
+        node_type = curr_plan["Node Type"]
+        if node_type == "Seq Scan" and relation_rows.get(curr_plan.get("Relation Name"), 0) >= large_rows:
+            findings["seq_scans"].append({"table": curr_plan["Relation Name"], "rows": relation_rows[curr_plan["Relation Name"]]})
+        elif node_type in ("Hash Join", "Nested Loop", "Merge Join"):
+            findings["joins"][node_type] = findings["joins"].get(node_type, 0) + 1
+        elif node_type in ("Sort", "Incremental Sort"):
+            findings["sorts"].append(curr_plan.get("Sort Key", []))
+    return findings
+
+def relations_of(query_plan):
+    relations = set()
+    stack = [query_plan]
+    while len(stack) != 0:
+        curr_plan = stack.pop()
+        stack.extend(curr_plan.get("Plans", []))
+        if "Relation Name" in curr_plan:
+            relations.add(curr_plan["Relation Name"])
+    return relations
+
+# class to explain and annotate each distinct shape of a workload once:
+class WorkloadAnalyzer:
+
+    def __init__(self, processor, workers=4, large_rows=100000, catalog=None):
+        '''
+        :param processor: QueryProcessor shared by all workers
+        :param large_rows: estimated rows from which a sequentially scanned table is reported
+        :param catalog: catalog.CatalogCache the row estimates are read from, also adding catalog statistics to the annotations;
+        one is made for the processor if not given
+        '''
+        self.processor = processor
+        self.workers = max(1, workers)
+        self.large_rows = large_rows
+        self.catalog = catalog if catalog is not None else CatalogCache(processor)
+        self.annotators = ThreadAnnotators(processor.metrics, self.catalog)
+
+    def annotate_shape(self, shape):
+        try:
+            query_plan = self.processor.process_query(shape["query"])
+            annotations = self.annotators.get().annotate(query_plan, self.processor.tokenize_query(shape["query"]))
+            shape["plan"] = query_plan
+            shape["total_cost"] = query_plan["Total Cost"]
+            shape["weight"] = shape["calls"] * query_plan["Total Cost"]
+            shape["annotations"] = [annotation.text for annotation in annotations]
+        except Exception as e:
+            shape["error"] = str(e)
+        return shape
+
+    def analyze(self, shapes):
+        '''
+        Explains and annotates each shape once, concurrently
+        :param shapes: iterable of shapes, as from collect_shapes
+        :returns: the shapes ranked by calls x total cost, failed ones last
+        '''
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            shapes = list(executor.map(self.annotate_shape, shapes))
+
+        relations = set()
+        for shape in shapes:
+            if "plan" in shape:
+                relations |= relations_of(shape["plan"])
+        statistics = self.catalog.lookup(sorted(relations)) if relations else {}
+        relation_rows = {name: stats["rows"] for name, stats in statistics.items() if stats["rows"] is not None}
+        for shape in shapes:
+            if "plan" in shape:
+                shape["findings"] = plan_findings(shape.pop("plan"), relation_rows, self.large_rows)
+
+        shapes.sort(key=lambda shape: shape.get("weight", -1), reverse=True)
+        return shapes
+
+def format_report(shapes, top=None):
+    '''
+    :returns: the report as text, one section per shape
+    '''
+    lines = []
+    for rank, shape in enumerate(shapes[:top], 1):
+        lines.append(f"#{rank}  calls: {shape['calls']}" + (f"  total cost: {shape['total_cost']}  calls x cost: {shape['weight']:.0f}" if "weight" in shape else "")
+                     + (f"  total time: {shape['total_time']:.1f} ms" if shape["total_time"] is not None else ""))
+        lines.append("    " + " ".join(shape["query"].split()))
+        if "error" in shape:
+            lines.append(f"    error: {shape['error']}")
+        else:
+            findings = shape["findings"]
+            for scan in findings["seq_scans"]:
+                lines.append(f"    Seq Scan on large table {scan['table']} (~{scan['rows']:.0f} rows)")
+            if findings["joins"]:
+                lines.append("    joins: " + ", ".join(f"{count} {join_type}" for join_type, count in sorted(findings["joins"].items())))
+            for keys in findings["sorts"]:
+                lines.append(f"    sort on {', '.join(keys)}")
+            for text in shape["annotations"]:
+                lines.append("    - " + text)
+        lines.append("")
+    return "\n".join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="project.py workload", description="Rank the query shapes of a Postgres csvlog or pg_stat_statements export by calls x plan cost.")
+    parser.add_argument("paths", nargs="+", help="csvlog files or CSV exports of pg_stat_statements")
+    parser.add_argument("--format", dest="log_format", choices=["auto", "csvlog", "pg_stat_statements"], default="auto")
+    parser.add_argument("--username", default=os.environ.get("PGUSER", "postgres"))
+    parser.add_argument("--password", default=os.environ.get("PGPASSWORD", ""))
+    parser.add_argument("--host", default=os.environ.get("PGHOST", "localhost"))
+    parser.add_argument("--database", default=os.environ.get("PGDATABASE", "postgres"))
+    parser.add_argument("--workers", type=int, default=4, help="number of shapes explained concurrently (default: 4)")
+    parser.add_argument("--top", type=int, default=50, help="number of shapes in the report (default: 50)")
+    parser.add_argument("--large-rows", type=float, default=100000, help="estimated rows from which a sequentially scanned table is reported (default: 100000)")
+    parser.add_argument("--metrics", metavar="FILE", help="write the time spent in each stage to FILE: Prometheus text format if it ends with .prom, JSON lines otherwise")
+    args = parser.parse_args(argv)
+
+    entries = (entry for path in args.paths for entry in read_workload(path, args.log_format))
+    shapes, skipped = collect_shapes(entries)
+    print(f"{len(shapes)} distinct shapes" + (f", {skipped} statement(s) skipped as unreadable" if skipped else ""), file=sys.stderr)
+
+    metrics = Metrics() if args.metrics else None
+    with QueryProcessor(args.username, args.password, args.host, args.database, pool_size=args.workers, cache_size=0, metrics=metrics) as processor:
+        shapes = WorkloadAnalyzer(processor, args.workers, args.large_rows).analyze(shapes.values())
+    print(format_report(shapes, args.top))
+    if metrics is not None:
+        metrics.write(args.metrics)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())